@@ -0,0 +1 @@
+"""Benchmarks on synthetic data; see bench/run.py."""
@@ -0,0 +1,259 @@
+"""
+Benchmark suite: builds a synthetic datalake in a scratch directory, times the hot
+paths of the pipeline against it and writes the results as JSON.
+
+    python -m bench.run --days 3 --events-per-day 100000
+    python -m bench.run --compare bench/results/old.json bench/results/new.json
+"""
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, 'bench', 'results')
+
+# Results that changed by less than this fraction are reported as unchanged
+COMPARE_THRESHOLD = 0.05
+
+sys.path.insert(0, REPO_ROOT)
+
+import polars as pl
+
+from bench.stubs import GammaStub, GoldskyStub, StubProcess
+from bench.synth import DEFAULT_START, generate, synth_events
+from poly_utils.metrics import RssSampler
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def measure(fn, rows=None, verbose=False):
+    """Run fn once; returns (result, {seconds, peak_rss_mb, rows, rows_per_sec})."""
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    sampler = RssSampler().start()
+    started = time.perf_counter()
+    with output:
+        result = fn()
+    seconds = time.perf_counter() - started
+    peak = sampler.stop()
+    stats = {'seconds': round(seconds, 4), 'peak_rss_mb': round(peak / 2**20, 1)}
+    rows = rows(result) if callable(rows) else rows
+    if rows is not None:
+        stats['rows'] = rows
+        stats['rows_per_sec'] = round(rows / seconds) if seconds else None
+    return result, stats
+
+
+def best_of(repeat, fn, rows=None, verbose=False):
+    """Fastest of `repeat` runs of a side-effect-free benchmark."""
+    runs = [measure(fn, rows, verbose)[1] for _ in range(repeat)]
+    return min(runs, key=lambda r: r['seconds'])
+
+
+def reset_processed():
+    for path in ['processed', 'metrics']:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+LAKE_DIRS = ['goldsky', 'processed', 'markets_partitioned']
+
+
+def save_lake(dest: str):
+    shutil.rmtree(dest, ignore_errors=True)
+    for path in LAKE_DIRS:
+        if os.path.isdir(path):
+            shutil.copytree(path, os.path.join(dest, path))
+
+
+def restore_lake(src: str):
+    for path in LAKE_DIRS:
+        shutil.rmtree(path, ignore_errors=True)
+        if os.path.isdir(os.path.join(src, path)):
+            shutil.copytree(os.path.join(src, path), path)
+
+
+def run_suite(args) -> dict:
+    workdir = args.workdir or tempfile.mkdtemp(prefix='poly-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    print(f"Generating synthetic datalake in {workdir}...")
+    started = time.perf_counter()
+    markets = generate('.', days=args.days, events_per_day=args.events_per_day, n_markets=args.markets,
+                       n_wallets=args.wallets, files_per_day=args.files_per_day,
+                       drift_fraction=args.drift_fraction, seed=args.seed)
+    print(f"  done in {time.perf_counter() - started:.1f}s")
+    total_events = args.days * args.events_per_day
+
+    # Pipeline modules use paths relative to the datalake (and update_goldsky creates
+    # goldsky/ on import), so they are imported once the working directory is set
+    from poly_utils.utils import get_markets
+    from poly_utils.markets import SNAPSHOT_DIR
+    from poly_utils.dictionary import TokenDictionary
+    from poly_utils.markets import load_market_tokens
+    from update_utils import process_live as live
+    from update_utils.update_goldsky import get_latest_timestamp, scrape
+    from update_utils.update_markets import update_markets
+    from update_utils.pipeline import run_pipeline
+
+    results = {}
+    verbose = args.verbose
+
+    def run(name, fn, rows=None, repeat=1):
+        if args.only and name not in args.only:
+            return
+        print(f"  {name}...", end=' ', flush=True)
+        stats = best_of(repeat, fn, rows, verbose)
+        results[name] = stats
+        print(f"{stats['seconds']:.3f}s" + (f", {stats['rows_per_sec']:,} rows/s" if stats.get('rows_per_sec') else ''))
+
+    print("Running benchmarks:")
+
+    def markets_cold():
+        shutil.rmtree(os.path.join('markets_partitioned', SNAPSHOT_DIR), ignore_errors=True)
+        return get_markets()
+
+    run('get_markets_cold', markets_cold, rows=lambda df: df.height, repeat=args.repeat)
+    run('get_markets_warm', get_markets, rows=lambda df: df.height, repeat=args.repeat)
+    run('get_latest_timestamp', get_latest_timestamp, repeat=args.repeat)
+
+    # get_processed_df on the first day, already read and encoded
+    dictionary = TokenDictionary()
+    dictionary.sync_tokens(load_market_tokens())
+    first_day = sorted(
+        os.path.join(root, f) for root, _, files in os.walk('goldsky/orderFilled') for f in files
+        if f.endswith('.parquet')
+    )[:args.files_per_day]
+    live.register_raw_tokens(first_day, dictionary)
+    raw = live.prepare_raw(live.scan_encoded(first_day, dictionary, False)).collect()
+    lookup = dictionary.lookup_frame()
+    run('get_processed_df', lambda: live.get_processed_df(raw, lookup), rows=raw.height, repeat=args.repeat)
+
+    def process(streaming):
+        reset_processed()
+        shutil.rmtree('goldsky/token_dictionary', ignore_errors=True)
+        live.process_live(streaming=streaming, resolve_missing=False)
+
+    run('process_live_chunks', lambda: process(False), rows=total_events)
+    run('process_live_streaming', lambda: process(True), rows=total_events)
+
+    # Scrape one more day from the Goldsky stand-in, and the markets from the gamma one
+    next_day = DEFAULT_START + timedelta(days=args.days)
+    stub_events = synth_events(markets, next_day, args.scrape_events, args.wallets, seed=args.seed)
+    goldsky = StubProcess(GoldskyStub, stub_events, latency=args.latency, error_rate=args.error_rate).start()
+    gamma = StubProcess(GammaStub, markets, latency=args.latency, error_rate=args.error_rate).start()
+    baseline = os.path.join(workdir, '_baseline')
+    save_lake(baseline)
+    try:
+        # A whole update_all run, stage after stage and pipelined, from the same datalake
+        def update_all_sequential():
+            restore_lake(baseline)
+            update_markets(base_url=gamma.url)
+            scrape(url=goldsky.url)
+            live.process_live(resolve_missing=False)
+
+        def update_all_pipelined():
+            restore_lake(baseline)
+            run_pipeline(goldsky_url=goldsky.url, markets_url=gamma.url, resolve_missing=False)
+
+        run('update_all_sequential', update_all_sequential, rows=stub_events.height)
+        run('update_all_pipelined', update_all_pipelined, rows=stub_events.height)
+        restore_lake(baseline)
+
+        run('scrape', lambda: scrape(url=goldsky.url), rows=stub_events.height)
+
+        def fetch_markets():
+            shutil.rmtree('markets_partitioned', ignore_errors=True)
+            update_markets(base_url=gamma.url)
+
+        run('update_markets', fetch_markets, rows=len(markets))
+    finally:
+        goldsky.stop()
+        gamma.stop()
+
+    if not args.keep and not args.workdir:
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'commit': git_commit(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'polars': pl.__version__,
+        'machine': {'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'config': {
+            'days': args.days, 'events_per_day': args.events_per_day, 'markets': args.markets,
+            'wallets': args.wallets, 'files_per_day': args.files_per_day,
+            'drift_fraction': args.drift_fraction, 'scrape_events': args.scrape_events,
+            'latency': args.latency, 'error_rate': args.error_rate, 'seed': args.seed,
+        },
+        'results': results,
+    }
+
+
+def compare(old_path: str, new_path: str):
+    """Print the change of every benchmark between two result files."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    if old['config'] != new['config']:
+        print("⚠️  Result files were produced with different configs")
+    print(f"{'benchmark':<26}{old['commit']:>12}{new['commit']:>12}{'change':>10}")
+    for name in sorted(set(old['results']) | set(new['results'])):
+        before = old['results'].get(name, {}).get('seconds')
+        after = new['results'].get(name, {}).get('seconds')
+        if before is None or after is None:
+            print(f"{name:<26}{before if before is not None else '-':>12}{after if after is not None else '-':>12}")
+            continue
+        change = (after - before) / before if before else 0.0
+        marker = '' if abs(change) < COMPARE_THRESHOLD else (' slower' if change > 0 else ' faster')
+        print(f"{name:<26}{before:>11.3f}s{after:>11.3f}s{change:>+9.1%}{marker}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic data")
+    parser.add_argument('--days', type=int, default=3)
+    parser.add_argument('--events-per-day', type=int, default=50_000)
+    parser.add_argument('--markets', type=int, default=2_000)
+    parser.add_argument('--wallets', type=int, default=50_000)
+    parser.add_argument('--files-per-day', type=int, default=24)
+    parser.add_argument('--drift-fraction', type=float, default=0.3)
+    parser.add_argument('--scrape-events', type=int, default=20_000, help="Events served by the Goldsky stand-in")
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds added to every stand-in request")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of stand-in requests answered with 429")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs of the read-only benchmarks (fastest is kept)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='*', help="Run only these benchmarks")
+    parser.add_argument('--workdir', help="Build the datalake here instead of a temporary directory (kept)")
+    parser.add_argument('--keep', action='store_true', help="Keep the temporary datalake")
+    parser.add_argument('--out', help="Result file (default: bench/results/<commit>-<time>.json)")
+    parser.add_argument('--verbose', action='store_true', help="Show the pipeline's own output")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="Compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    out = os.path.abspath(args.out) if args.out else None
+    report = run_suite(args)
+    out = out or os.path.join(RESULTS_DIR, f"{report['commit']}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {out}")
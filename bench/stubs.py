@@ -0,0 +1,224 @@
+"""
+Local stand-ins for the Goldsky orderbook subgraph and the gamma-api markets endpoint.
+
+Both serve synthetic data (see bench.synth) with a configurable per-request latency
+and fraction of HTTP 429 responses, so scraping and market fetching can be measured
+without touching the real APIs.
+
+    python -m bench.stubs --days 1 --latency 0.05 --error-rate 0.02
+"""
+import bisect
+import json
+import multiprocessing
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+import polars as pl
+
+_FIRST = re.compile(r'first:\s*(\d+)')
+_TIMESTAMP_GT = re.compile(r'timestamp_gt:\s*"(\d+)"')
+_TIMESTAMP_LT = re.compile(r'timestamp_lt:\s*"(\d+)"')
+_ID_GT = re.compile(r'id_gt:\s*"([^"]*)"')
+
+
+class StubServer:
+    """
+    Threaded HTTP server on 127.0.0.1 running in the background.
+
+    Args:
+        latency: Seconds added to every request.
+        error_rate: Fraction of requests answered with HTTP 429.
+        port: Port to bind (0 picks a free one).
+    """
+
+    path = '/'
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, port: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._rng = random.Random(0)
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub._serve(self, lambda: stub.handle_get(urlparse(self.path)))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                stub._serve(self, lambda: stub.handle_post(json.loads(body or b'{}')))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}{self.path}"
+
+    def _serve(self, handler, respond):
+        with self._lock:
+            self.requests += 1
+            throttle = self._rng.random() < self.error_rate
+            self.throttled += throttle
+        if self.latency:
+            time.sleep(self.latency)
+        if throttle:
+            handler.send_response(429)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+        body = json.dumps(respond()).encode()
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def handle_get(self, url):
+        raise NotImplementedError
+
+    def handle_post(self, payload):
+        raise NotImplementedError
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class GoldskyStub(StubServer):
+    """
+    orderFilledEvents GraphQL endpoint answering the keyset queries GoldskyClient builds
+    (timestamp_gt / timestamp_lt, ties broken by id_gt) from a table of events.
+
+    Args:
+        events: Events as returned by bench.synth.synth_events (all String columns).
+    """
+
+    path = '/subgraphs/orderbook-subgraph/gn'
+
+    def __init__(self, events: pl.DataFrame, **kwargs):
+        super().__init__(**kwargs)
+        events = events.sort([pl.col('timestamp').cast(pl.Int64), 'id'])
+        self.rows = events.to_dicts()
+        self.keys = [(int(r['timestamp']), r['id']) for r in self.rows]
+
+    def handle_post(self, payload):
+        query = payload.get('query', '')
+        first = int(_FIRST.search(query).group(1))
+        after = int(_TIMESTAMP_GT.search(query).group(1))
+        before = _TIMESTAMP_LT.search(query)
+        after_id = _ID_GT.search(query)
+        if after_id is not None:
+            start = bisect.bisect_right(self.keys, (after, after_id.group(1)))
+        else:
+            start = bisect.bisect_left(self.keys, (after + 1, ''))
+        page = self.rows[start:start + first]
+        if before is not None:
+            page = [r for r in page if int(r['timestamp']) < int(before.group(1))]
+        return {'data': {'orderFilledEvents': page}}
+
+
+class GammaStub(StubServer):
+    """
+    gamma-api `/markets` endpoint: createdAt-ordered pages (order/ascending/limit/offset)
+    and lookups by repeated `clob_token_ids` parameters.
+
+    Args:
+        markets: gamma-api style market dicts (see bench.synth.synth_markets).
+    """
+
+    path = '/markets'
+
+    def __init__(self, markets: List[Dict], **kwargs):
+        super().__init__(**kwargs)
+        self.markets = sorted(markets, key=lambda m: m['createdAt'])
+        self.by_token = {t: m for m in self.markets for t in json.loads(m['clobTokenIds'])}
+
+    def handle_get(self, url):
+        params = parse_qs(url.query)
+        if 'clob_token_ids' in params:
+            found = {self.by_token[t]['id']: self.by_token[t] for t in params['clob_token_ids'] if t in self.by_token}
+            return list(found.values())
+        markets = self.markets if params.get('ascending', ['true'])[0] == 'true' else self.markets[::-1]
+        offset = int(params.get('offset', ['0'])[0])
+        limit = int(params.get('limit', ['500'])[0])
+        return markets[offset:offset + limit]
+
+
+def _serve(stub_class, args, kwargs, conn):
+    stub = stub_class(*args, **kwargs).start()
+    conn.send(stub.url)
+    conn.recv()
+    stub.stop()
+
+
+class StubProcess:
+    """
+    Runs a stub in a child process, so serving requests does not compete with the
+    measured code for the GIL. Same url/start()/stop() interface as the stub itself.
+
+    Args:
+        stub_class: StubServer subclass, constructed in the child with `*args, **kwargs`.
+    """
+
+    def __init__(self, stub_class, *args, **kwargs):
+        # Spawned, not forked: forking a process running Polars' thread pool can deadlock
+        context = multiprocessing.get_context('spawn')
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(target=_serve, args=(stub_class, args, kwargs, child_conn), daemon=True)
+        self.url = None
+
+    def start(self):
+        self._process.start()
+        self.url = self._conn.recv()
+        return self
+
+    def stop(self):
+        self._conn.send('stop')
+        self._process.join()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from bench.synth import DEFAULT_START, synth_events, synth_markets
+
+    parser = argparse.ArgumentParser(description="Serve synthetic Goldsky and gamma-api stand-ins")
+    parser.add_argument('--markets', type=int, default=2_000)
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--events-per-day', type=int, default=50_000)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--goldsky-port', type=int, default=8001)
+    parser.add_argument('--gamma-port', type=int, default=8002)
+    args = parser.parse_args()
+
+    from datetime import timedelta
+
+    markets = synth_markets(args.markets)
+    events = pl.concat([synth_events(markets, DEFAULT_START + timedelta(days=i), args.events_per_day)
+                        for i in range(args.days)])
+    goldsky = GoldskyStub(events, latency=args.latency, error_rate=args.error_rate, port=args.goldsky_port).start()
+    gamma = GammaStub(markets, latency=args.latency, error_rate=args.error_rate, port=args.gamma_port).start()
+    print(f"Goldsky: {goldsky.url}\nGamma:   {gamma.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        goldsky.stop()
+        gamma.stop()
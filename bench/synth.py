@@ -0,0 +1,175 @@
+"""
+Synthetic datalake generator for benchmarks.
+
+Builds `markets_partitioned/` and `goldsky/orderFilled/` trees shaped like production:
+Zipf-distributed market and wallet activity, many small files per day partition, and
+the String/Int64 `timestamp` drift of files written by older scraper versions.
+
+    python -m bench.synth --out /tmp/poly-bench --days 7 --events-per-day 200000
+"""
+import json
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+from typing import Dict, Iterator, List
+
+import polars as pl
+
+from poly_utils.schema import RAW_SCHEMA, DERIVED_RAW_COLUMNS
+
+USDC_ASSET = '0'
+
+# Days start here unless another start date is given
+DEFAULT_START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+RAW_COLUMNS = [c for c in RAW_SCHEMA if c not in DERIVED_RAW_COLUMNS]
+
+
+def _zipf_weights(n: int, exponent: float = 1.1) -> List[float]:
+    return list(accumulate(1.0 / (rank ** exponent) for rank in range(1, n + 1)))
+
+
+def _token_id(rng: random.Random) -> str:
+    # CLOB token IDs are 76-78 digit decimal strings
+    return str(rng.randrange(10**75, 10**77))
+
+
+def synth_markets(n_markets: int, start: datetime = DEFAULT_START, days: int = 30, seed: int = 0) -> List[Dict]:
+    """gamma-api style market dicts created over `days` before `start`, oldest first."""
+    rng = random.Random(seed)
+    markets = []
+    for i in range(n_markets):
+        created = start - timedelta(seconds=rng.randrange(days * 86400))
+        markets.append({
+            'id': str(500000 + i),
+            'createdAt': created.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'question': f"Synthetic market {i}?",
+            'outcomes': json.dumps(['Yes', 'No']),
+            'clobTokenIds': json.dumps([_token_id(rng), _token_id(rng)]),
+            'negRiskAugmented': rng.random() < 0.1,
+            'slug': f"synthetic-market-{i}",
+            'conditionId': f"0x{rng.getrandbits(256):064x}",
+            'volume': f"{rng.random() * 1e6:.2f}",
+            'closedTime': None,
+            'events': [{'ticker': f"synthetic-event-{i // 5}"}],
+        })
+    markets.sort(key=lambda m: m['createdAt'])
+    return markets
+
+
+def write_markets(markets: List[Dict], root: str, batch_size: int = 500):
+    """Write markets the way update_markets always has: one small file per fetched page."""
+    from update_utils.update_markets import transform_markets
+
+    for i in range(0, len(markets), batch_size):
+        df = transform_markets(markets[i:i + batch_size])
+        for (year, month), part in df.partition_by(['year', 'month'], as_dict=True).items():
+            directory = os.path.join(root, f"year={year}", f"month={month}")
+            os.makedirs(directory, exist_ok=True)
+            part.write_parquet(os.path.join(directory, f"markets-{i // batch_size:06d}.parquet"))
+
+
+def synth_events(markets: List[Dict], day: datetime, n_events: int, n_wallets: int = 50_000,
+                 unknown_fraction: float = 0.0, seed: int = 0) -> pl.DataFrame:
+    """
+    One day of orderFilled events as the Goldsky subgraph returns them (all strings),
+    sorted by (timestamp, id). A fraction of fills can reference tokens that are in no
+    market, to exercise market resolution.
+    """
+    rng = random.Random(f"{seed}-{day.date()}")
+    tokens = [json.loads(m['clobTokenIds']) for m in markets]
+    market_weights = _zipf_weights(len(markets))
+    wallet_weights = _zipf_weights(n_wallets, 1.05)
+    wallets = [f"0x{rng.getrandbits(160):040x}" for _ in range(n_wallets)]
+    unknown = [_token_id(rng) for _ in range(16)]
+
+    market_idx = rng.choices(range(len(markets)), cum_weights=market_weights, k=n_events)
+    makers = rng.choices(wallets, cum_weights=wallet_weights, k=n_events)
+    takers = rng.choices(wallets, cum_weights=wallet_weights, k=n_events)
+    day_start = int(day.timestamp())
+    timestamps = sorted(day_start + rng.randrange(86400) for _ in range(n_events))
+
+    rows = {c: [] for c in RAW_COLUMNS}
+    for i in range(n_events):
+        if unknown_fraction and rng.random() < unknown_fraction:
+            token = rng.choice(unknown)
+        else:
+            token = tokens[market_idx[i]][rng.random() < 0.5]
+        price = rng.uniform(0.01, 0.99)
+        shares = int(rng.lognormvariate(3.5, 1.5) * 10**6) + 10**4
+        usdc = max(1, int(shares * price))
+        maker_buys = rng.random() < 0.5
+        tx_hash = f"0x{rng.getrandbits(256):064x}"
+        rows['id'].append(f"{tx_hash}_0x{rng.getrandbits(256):064x}")
+        rows['timestamp'].append(str(timestamps[i]))
+        rows['maker'].append(makers[i])
+        rows['taker'].append(takers[i])
+        rows['makerAssetId'].append(USDC_ASSET if maker_buys else token)
+        rows['makerAmountFilled'].append(str(usdc if maker_buys else shares))
+        rows['takerAssetId'].append(token if maker_buys else USDC_ASSET)
+        rows['takerAmountFilled'].append(str(shares if maker_buys else usdc))
+        rows['transactionHash'].append(tx_hash)
+    return pl.DataFrame(rows, schema={c: pl.Utf8 for c in RAW_COLUMNS}).sort(['timestamp', 'id'])
+
+
+def write_raw_day(events: pl.DataFrame, root: str, day: datetime, files: int = 24,
+                  drift_fraction: float = 0.3, seed: int = 0):
+    """
+    Write one day of events as `files` small files in its day partition. About
+    `drift_fraction` of them keep `timestamp` as a String, like files from older scrapers;
+    the rest use the current Int64 columns.
+    """
+    rng = random.Random(f"{seed}-{day.date()}-files")
+    directory = os.path.join(root, f"year={day.year}", f"month={day.month}", f"day={day.day}")
+    os.makedirs(directory, exist_ok=True)
+    size = max(1, -(-events.height // files))
+    for i, offset in enumerate(range(0, events.height, size)):
+        part = events.slice(offset, size).with_columns([
+            pl.col('makerAmountFilled').cast(pl.Int64),
+            pl.col('takerAmountFilled').cast(pl.Int64),
+        ])
+        if rng.random() >= drift_fraction:
+            part = part.with_columns(pl.col('timestamp').cast(pl.Int64))
+        part.write_parquet(os.path.join(directory, f"orderFilled-{i:05d}.parquet"))
+
+
+def iter_days(start: datetime, days: int) -> Iterator[datetime]:
+    for i in range(days):
+        yield start + timedelta(days=i)
+
+
+def generate(out: str, days: int = 3, events_per_day: int = 50_000, n_markets: int = 2_000,
+             n_wallets: int = 50_000, files_per_day: int = 24, drift_fraction: float = 0.3,
+             unknown_fraction: float = 0.0, start: datetime = DEFAULT_START, seed: int = 0) -> List[Dict]:
+    """
+    Generate a synthetic datalake under `out` and return its markets (gamma-api dicts),
+    e.g. to serve them from a GammaStub.
+    """
+    markets = synth_markets(n_markets, start, seed=seed)
+    write_markets(markets, os.path.join(out, 'markets_partitioned'))
+    raw_root = os.path.join(out, 'goldsky', 'orderFilled')
+    for day in iter_days(start, days):
+        events = synth_events(markets, day, events_per_day, n_wallets, unknown_fraction, seed)
+        write_raw_day(events, raw_root, day, files_per_day, drift_fraction, seed)
+    return markets
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic Polymarket datalake")
+    parser.add_argument('--out', required=True)
+    parser.add_argument('--days', type=int, default=3)
+    parser.add_argument('--events-per-day', type=int, default=50_000)
+    parser.add_argument('--markets', type=int, default=2_000)
+    parser.add_argument('--wallets', type=int, default=50_000)
+    parser.add_argument('--files-per-day', type=int, default=24)
+    parser.add_argument('--drift-fraction', type=float, default=0.3)
+    parser.add_argument('--unknown-fraction', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate(args.out, args.days, args.events_per_day, args.markets, args.wallets, args.files_per_day,
+             args.drift_fraction, args.unknown_fraction, seed=args.seed)
+    print(f"Wrote {args.days} days x {args.events_per_day:,} events and {args.markets:,} markets to {args.out}")
@@ -1,2 +1,7 @@
 """Utility helpers shared across update scripts."""
-from .utils import *
\ No newline at end of file
+from .utils import *
+from .writer import PartitionWriter
+from .markets import scan_markets
+from .trade_index import load_trades
+from .wallet_index import scan_wallet_trades
+from .feed import subscribe
@@ -0,0 +1,225 @@
+import os
+import shutil
+import time
+from datetime import datetime
+from typing import Dict, List
+
+import polars as pl
+
+from poly_utils.compaction import exchange_dirs
+from poly_utils.schema import decode_compact
+from poly_utils.utils import load_json_state, parquet_files, save_json_state
+from poly_utils.writer import PartitionWriter
+
+BARS_ROOT = 'processed/bars'
+BARS_STATE = '_state.json'
+
+# Bar resolution -> truncation interval and the partitioning of its dataset
+RESOLUTIONS = {
+    '1m': {'every': '1m', 'partition_cols': ['year', 'month', 'day']},
+    '1h': {'every': '1h', 'partition_cols': ['year', 'month']},
+    '1d': {'every': '1d', 'partition_cols': ['year']},
+}
+
+BAR_KEYS = ['market_id', 'nonusdc_side', 'bucket']
+
+# A partition holding more delta files than this is merged into one file
+MAX_DELTA_FILES = 8
+
+# Partial bars buffered in memory before they are merged down
+MERGE_EVERY_ROWS = 1_000_000
+
+
+def trade_bars(trades, every: str):
+    """
+    Aggregate processed trades into partial bars per market, side and `every` bucket.
+
+    Besides OHLC, volumes and the trade count each bar keeps the timestamps of its open
+    and close trade, so bars built from different batches (including late data) can be
+    merged exactly by merge_bars(). Trades of any processed schema version give bars
+    with string market ids and sides and Float64 prices (see decode_compact).
+    """
+    return (
+        decode_compact(trades)
+        .filter(pl.col('market_id').is_not_null())
+        .with_columns(pl.col('timestamp').dt.truncate(every).alias('bucket'))
+        .group_by(BAR_KEYS)
+        .agg([
+            pl.col('price').sort_by('timestamp').first().alias('open'),
+            pl.col('price').max().alias('high'),
+            pl.col('price').min().alias('low'),
+            pl.col('price').sort_by('timestamp').last().alias('close'),
+            pl.col('timestamp').min().alias('open_ts'),
+            pl.col('timestamp').max().alias('close_ts'),
+            pl.col('token_amount').sum().alias('volume'),
+            pl.col('usd_amount').sum().alias('usd_volume'),
+            pl.len().cast(pl.Int64).alias('trades'),
+        ])
+        .with_columns((pl.col('usd_volume') / pl.col('volume')).alias('vwap'))
+    )
+
+
+def merge_bars(bars):
+    """Combine partial bars of the same market, side and bucket into one bar each."""
+    return (
+        bars
+        .group_by(BAR_KEYS)
+        .agg([
+            pl.col('open').sort_by('open_ts').first(),
+            pl.col('high').max(),
+            pl.col('low').min(),
+            pl.col('close').sort_by('close_ts').last(),
+            pl.col('open_ts').min(),
+            pl.col('close_ts').max(),
+            pl.col('volume').sum(),
+            pl.col('usd_volume').sum(),
+            pl.col('trades').sum(),
+        ])
+        .with_columns((pl.col('usd_volume') / pl.col('volume')).alias('vwap'))
+    )
+
+
+def _add_partition_columns(bars: pl.DataFrame, partition_cols: List[str]) -> pl.DataFrame:
+    parts = {
+        'year': pl.col('bucket').dt.year().alias('year'),
+        'month': pl.col('bucket').dt.month().alias('month'),
+        'day': pl.col('bucket').dt.day().alias('day'),
+    }
+    return bars.with_columns([parts[c] for c in partition_cols])
+
+
+def bars_initialized(root: str = BARS_ROOT) -> bool:
+    """True once the bar datasets cover the whole processed history (see update_bars)."""
+    return load_json_state(os.path.join(root, BARS_STATE), default={}).get('initialized', False)
+
+
+def mark_bars_initialized(root: str = BARS_ROOT, through=None):
+    save_json_state(os.path.join(root, BARS_STATE), {
+        'initialized': True,
+        'through': str(through) if through is not None else None,
+        'updated_at': datetime.now().isoformat(),
+    })
+
+
+def mark_bars_stale(root: str = BARS_ROOT, reason: str = None):
+    """
+    Flag the bar datasets as missing trades: updates skip them until they are rebuilt
+    (`python -m update_utils.update_bars --rebuild`).
+    """
+    save_json_state(os.path.join(root, BARS_STATE), {
+        'initialized': False,
+        'stale_reason': reason,
+        'updated_at': datetime.now().isoformat(),
+    })
+    print(f"⚠️  Bar datasets marked for rebuild ({reason}); run `python -m update_utils.update_bars --rebuild`")
+
+
+def merge_partition(directory: str, staging_dir: str, merge=merge_bars, keys: List[str] = BAR_KEYS,
+                    prefix: str = 'bars'):
+    """
+    Merge every delta file of one partition into a single file and swap it in.
+
+    `merge` combines the rows of all deltas (merge_bars for bar datasets) and the result
+    is sorted by `keys`.
+    """
+    files = parquet_files(directory)
+    merged = merge(pl.concat([pl.read_parquet(f, hive_partitioning=False) for f in files], how='vertical_relaxed'))
+    merged = merged.sort(keys)
+
+    new_dir = os.path.join(staging_dir, os.path.relpath(directory, '/').replace(os.sep, '__'))
+    if os.path.exists(new_dir):
+        shutil.rmtree(new_dir)
+    os.makedirs(new_dir)
+    merged.write_parquet(os.path.join(new_dir, f"{prefix}-{time.time_ns()}.parquet"), compression='zstd')
+    exchange_dirs(new_dir, directory)
+    shutil.rmtree(new_dir)
+
+
+class BarWriter:
+    """
+    Incrementally maintained OHLCV/VWAP bars for every market and outcome side, at the
+    resolutions in RESOLUTIONS, under `<root>/<resolution>/`.
+
+    Each batch of processed trades passed to write() is aggregated into partial bars
+    for the buckets it touches. On close() the partials are merged and appended to their
+    partitions as one delta file each; partitions that accumulated more than
+    MAX_DELTA_FILES deltas are merged into one file. Readers always merge with
+    merge_bars() (see load_bars), so a bucket that received late trades in a later run
+    is still reported as one correct bar.
+
+    Args:
+        root: Root of the bar datasets.
+        resolutions: Keys of RESOLUTIONS to maintain.
+    """
+
+    def __init__(self, root: str = BARS_ROOT, resolutions: List[str] = None):
+        self.root = root
+        self.resolutions = resolutions or list(RESOLUTIONS)
+        self._partials: Dict[str, List[pl.DataFrame]] = {r: [] for r in self.resolutions}
+        self._rows: Dict[str, int] = {r: 0 for r in self.resolutions}
+        self.bars_written = 0
+
+    def write(self, trades: pl.DataFrame):
+        """Fold a batch of processed trades (get_processed_df output) into the bars."""
+        if trades.is_empty():
+            return
+        for resolution in self.resolutions:
+            bars = trade_bars(trades, RESOLUTIONS[resolution]['every'])
+            self._partials[resolution].append(bars)
+            self._rows[resolution] += bars.height
+            if self._rows[resolution] > MERGE_EVERY_ROWS:
+                merged = merge_bars(pl.concat(self._partials[resolution]))
+                self._partials[resolution] = [merged]
+                self._rows[resolution] = merged.height
+
+    def close(self):
+        """Append the merged bars of every resolution and merge crowded partitions."""
+        for resolution in self.resolutions:
+            if not self._partials[resolution]:
+                continue
+            partition_cols = RESOLUTIONS[resolution]['partition_cols']
+            bars = merge_bars(pl.concat(self._partials[resolution])).sort(BAR_KEYS)
+            self._partials[resolution] = []
+            self._rows[resolution] = 0
+
+            dataset = os.path.join(self.root, resolution)
+            writer = PartitionWriter(dataset, partition_cols, prefix='bars',
+                                     target_rows=10_000_000, target_bytes=1024 * 2**20, memory_budget=2048 * 2**20)
+            writer.write(_add_partition_columns(bars, partition_cols))
+            writer.close()
+            self.bars_written += bars.height
+
+            touched = {os.path.dirname(path) for path in writer.files_written}
+            crowded = [d for d in sorted(touched) if len(parquet_files(d)) > MAX_DELTA_FILES]
+            if crowded:
+                staging_dir = f"{os.path.realpath(dataset)}.merge"
+                os.makedirs(staging_dir, exist_ok=True)
+                for directory in crowded:
+                    merge_partition(os.path.realpath(directory), staging_dir)
+                shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def mark_stale(self, reason: str = None):
+        mark_bars_stale(self.root, reason)
+
+
+def load_bars(resolution: str = '1h', market_id=None, start=None, end=None,
+              root: str = BARS_ROOT) -> pl.DataFrame:
+    """
+    Bars for one resolution, optionally for one market (or list of markets) and a
+    [start, end] bucket range. Only the partitions overlapping the range are read.
+    """
+    dataset = os.path.join(root, resolution)
+    if not os.path.isdir(dataset):
+        return pl.DataFrame()
+    lf = pl.scan_parquet(os.path.join(dataset, '**', '*.parquet'), hive_partitioning=True)
+    if start is not None:
+        start = start if isinstance(start, datetime) else datetime.fromisoformat(str(start))
+        lf = lf.filter((pl.col('year') >= start.year) & (pl.col('bucket') >= start))
+    if end is not None:
+        end = end if isinstance(end, datetime) else datetime.fromisoformat(str(end))
+        lf = lf.filter((pl.col('year') <= end.year) & (pl.col('bucket') <= end))
+    if market_id is not None:
+        ids = [market_id] if isinstance(market_id, str) else list(market_id)
+        lf = lf.filter(pl.col('market_id').is_in(ids))
+    bars = lf.drop(RESOLUTIONS[resolution]['partition_cols']).collect()
+    return merge_bars(bars).sort(BAR_KEYS)
@@ -0,0 +1,210 @@
+import json
+import os
+import threading
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+import polars as pl
+import pyarrow.parquet as pq
+
+from poly_utils.schema import SCHEMA_VERSION_KEY
+from poly_utils.utils import parquet_files, partition_dirs
+
+CATALOG_FILE = '_catalog.jsonl'
+
+# Dataset root -> (partition depth, column whose min/max is recorded per file)
+DATASET_STATS = {
+    'goldsky/orderFilled': (3, 'timestamp'),
+    'processed/trades': (2, 'timestamp'),
+    'markets_partitioned': (2, 'createdAt'),
+}
+
+
+def _normalize(value):
+    """Stats are stored as JSON: ints stay ints, datetimes become ISO strings (which sort correctly)."""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, str) and value.isdigit():
+        # Legacy raw files store epoch timestamps as strings
+        return int(value)
+    return value
+
+
+def _footer_stats(path: str, column: str):
+    """Min/max of `column` from a parquet footer, without reading any data pages."""
+    metadata = pq.read_metadata(path)
+    if column not in metadata.schema.names:
+        return None, None
+    index = metadata.schema.names.index(column)
+    lo = hi = None
+    for i in range(metadata.num_row_groups):
+        stats = metadata.row_group(i).column(index).statistics
+        if stats is None or not stats.has_min_max:
+            return None, None
+        lo = stats.min if lo is None else min(lo, stats.min)
+        hi = stats.max if hi is None else max(hi, stats.max)
+    return _normalize(lo), _normalize(hi)
+
+
+class Catalog:
+    """
+    Small on-disk catalog of the files in one dataset, kept in `<root>/_catalog.jsonl`.
+
+    Each committed file gets one appended line with its partition, min/max of the
+    dataset's stats column, row count, schema version and byte size; removed files get
+    a tombstone line. Loading replays the log, so finding the latest watermark or the
+    files overlapping a time range never touches the data files.
+
+    A catalog is `complete` when it was built by rebuild() or started on an empty
+    dataset; an incomplete catalog can still answer latest_watermark() for append-only
+    data, but range queries fall back to listing files.
+
+    Args:
+        root: Dataset root, e.g. 'goldsky/orderFilled'.
+        stats_column: Column whose min/max is recorded (defaults from DATASET_STATS).
+    """
+
+    def __init__(self, root: str, stats_column: str = None):
+        self.root = root
+        self.depth, default_column = DATASET_STATS.get(root.rstrip('/'), (2, 'timestamp'))
+        self.stats_column = stats_column or default_column
+        self.path = os.path.join(root, CATALOG_FILE)
+        self.files: Dict[str, Dict] = {}
+        self.complete = False
+        self._lock = threading.Lock()
+        self._load()
+        if not self.exists:
+            # Starting on an empty dataset means every file will pass through this catalog
+            self.complete = not os.path.isdir(root) or not partition_dirs(root, 1)
+
+    @property
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def _load(self):
+        if not self.exists:
+            return
+        with open(self.path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                op = entry.pop('op')
+                if op == 'init':
+                    self.complete = entry.get('complete', False)
+                elif op == 'add':
+                    self.files[entry['path']] = entry
+                elif op == 'remove':
+                    self.files.pop(entry['path'], None)
+
+    def _append(self, entries: List[Dict]):
+        with self._lock:
+            if not self.exists:
+                entries = [{'op': 'init', 'complete': self.complete}] + entries
+            with open(self.path, 'a') as f:
+                f.write(''.join(json.dumps(e) + '\n' for e in entries))
+
+    def _relpath(self, path: str) -> str:
+        return os.path.relpath(path, self.root)
+
+    def entry_for(self, path: str, df: pl.DataFrame = None, schema_version: int = None, size: int = None) -> Dict:
+        """
+        Describe a file for the catalog. Stats come from `df` when given (the writer
+        still has the rows in memory), else from the file's footer.
+        """
+        rel = self._relpath(path)
+        if df is not None and self.stats_column in df.columns:
+            lo, hi = _normalize(df[self.stats_column].min()), _normalize(df[self.stats_column].max())
+            rows = df.height
+        else:
+            metadata = pq.read_metadata(path)
+            lo, hi = _footer_stats(path, self.stats_column)
+            rows = metadata.num_rows
+            if schema_version is None:
+                version = (metadata.metadata or {}).get(SCHEMA_VERSION_KEY)
+                schema_version = int(version) if version is not None else None
+        return {
+            'path': rel,
+            'partition': os.path.dirname(rel),
+            'min': lo,
+            'max': hi,
+            'rows': rows,
+            'schema_version': schema_version,
+            'bytes': size if size is not None else os.path.getsize(path),
+        }
+
+    def add_entries(self, entries: List[Dict]):
+        """Record committed files described by entry_for()."""
+        if not entries:
+            return
+        for entry in entries:
+            self.files[entry['path']] = entry
+        self._append([{'op': 'add', **entry} for entry in entries])
+
+    def add_file(self, path: str, df: pl.DataFrame = None, schema_version: int = None):
+        """Record one committed file."""
+        self.add_entries([self.entry_for(path, df, schema_version)])
+
+    def remove_files(self, paths: List[str]):
+        rels = [self._relpath(p) for p in paths]
+        for rel in rels:
+            self.files.pop(rel, None)
+        self._append([{'op': 'remove', 'path': rel} for rel in rels])
+
+    def latest_watermark(self):
+        """Largest recorded value of the stats column, or None if nothing is cataloged."""
+        values = [e['max'] for e in self.files.values() if e['max'] is not None]
+        return max(values) if values else None
+
+    def files_overlapping(self, start=None, end=None) -> List[str]:
+        """Paths of files whose [min, max] overlaps [start, end] (either bound may be None)."""
+        start, end = _normalize(start), _normalize(end)
+        if not self.complete:
+            return sorted(f for d in partition_dirs(self.root, self.depth) for f in parquet_files(d))
+        return sorted(
+            os.path.join(self.root, e['path'])
+            for e in self.files.values()
+            if e['min'] is None
+            or ((end is None or e['min'] <= end) and (start is None or e['max'] >= start))
+        )
+
+    def scan(self, start=None, end=None) -> Optional[pl.LazyFrame]:
+        """Lazy scan of only the files that can contain rows in [start, end]."""
+        files = self.files_overlapping(start, end)
+        if not files:
+            return None
+        lf = pl.scan_parquet(files)
+        if start is not None:
+            lf = lf.filter(pl.col(self.stats_column) >= start)
+        if end is not None:
+            lf = lf.filter(pl.col(self.stats_column) <= end)
+        return lf
+
+    def rebuild(self):
+        """Recreate the catalog from the footers of every file currently in the dataset."""
+        entries = [{'op': 'init', 'complete': True}]
+        self.files = {}
+        for directory in partition_dirs(self.root, self.depth):
+            for path in parquet_files(directory):
+                entry = self.entry_for(path)
+                self.files[entry['path']] = entry
+                entries.append({'op': 'add', **entry})
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(''.join(json.dumps(e) + '\n' for e in entries))
+        os.replace(tmp_path, self.path)
+        self.complete = True
+        print(f"Cataloged {len(self.files)} files under {self.root}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Rebuild the per-dataset file catalogs")
+    parser.add_argument('roots', nargs='*', default=list(DATASET_STATS))
+    args = parser.parse_args()
+
+    for dataset_root in args.roots:
+        if os.path.isdir(dataset_root):
+            Catalog(dataset_root).rebuild()
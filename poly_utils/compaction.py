@@ -0,0 +1,493 @@
+import ctypes
+import os
+import shutil
+import time
+from typing import Dict, List
+
+import polars as pl
+import pyarrow.parquet as pq
+
+from poly_utils.catalog import CATALOG_FILE, Catalog
+from poly_utils.manifest import DEFAULT_MANIFEST_PATH, ProcessingManifest
+from poly_utils.dictionary import TokenDictionary, WalletDictionary, encode_raw, encode_wallets
+from poly_utils.schema import conform_processed, dataset_version, schema_metadata
+from poly_utils.trade_index import market_index, write_market_index
+from poly_utils.utils import load_json_state, parquet_files, partition_dirs, save_json_state
+
+# Storage profiles for rewritten partitions
+COMPACTION_PROFILES = {
+    'default': {
+        'row_group_size': 1_000_000,
+        'compression': 'zstd',
+        'compression_level': 3,
+        'use_dictionary': True,
+        'write_page_index': True,
+        'write_statistics': True,
+    },
+    # Smaller files for cold history that is rarely rewritten
+    'archive': {
+        'row_group_size': 1_000_000,
+        'compression': 'zstd',
+        'compression_level': 9,
+        'use_dictionary': True,
+        'write_page_index': True,
+        'write_statistics': True,
+    },
+    # Fast to write, for partitions that will be compacted again soon
+    'fast': {
+        'row_group_size': 500_000,
+        'compression': 'zstd',
+        'compression_level': 1,
+        'use_dictionary': True,
+        'write_page_index': False,
+        'write_statistics': True,
+    },
+    # Processed trades clustered by market, in small row groups, with a market index
+    # next to the files so poly_utils.trade_index.load_trades reads one market's rows only
+    'clustered': {
+        'sort_by': ['market_id', 'timestamp'],
+        'market_index': True,
+        'row_group_size': 100_000,
+        'compression': 'zstd',
+        'compression_level': 3,
+        'use_dictionary': True,
+        'write_page_index': True,
+        'write_statistics': True,
+    },
+}
+
+# Profile keys that describe the layout rather than parquet writer options
+LAYOUT_OPTIONS = ('sort_by', 'market_index', 'row_group_size')
+
+# Known datasets: partition depth, the column each partition is sorted by, for
+# datasets with a canonical schema how to tag rewritten files (raw files are also
+# conformed and asset-encoded with the token dictionary; processed trades are
+# wallet-encoded once the dataset has been migrated), and whether process_live
+# tracks consumed files in its processing manifest
+DATASETS = {
+    'goldsky/orderFilled': {'depth': 3, 'sort_by': 'timestamp', 'metadata': schema_metadata(),
+                            'token_dictionary': True, 'processing_manifest': True},
+    'processed/trades': {'depth': 2, 'sort_by': 'timestamp', 'wallet_dictionary': True},
+    'markets_partitioned': {'depth': 2, 'sort_by': 'createdAt'},
+}
+
+STATE_FILE = '_compaction_state.json'
+
+# Approximate peak memory of compacting one partition; larger partitions are sorted
+# externally through runs in the staging directory
+COMPACTION_MEMORY_BUDGET = 2048 * 2**20
+
+# Fewest rows sorted at once, however small the budget
+MIN_RUN_ROWS = 100_000
+
+# Row groups of the sorted runs: small enough for their statistics to skip most of a
+# run when one key range is read back
+RUN_ROW_GROUP_SIZE = 100_000
+
+# merge_small_files(): files below this size are merged together once a partition has
+# more than MAX_SMALL_FILES of them; larger files are left alone
+MERGE_MAX_BYTES = 256 * 2**20
+MAX_SMALL_FILES = 8
+
+_AT_FDCWD = -100
+_RENAME_EXCHANGE = 2
+
+
+def exchange_dirs(a: str, b: str):
+    """
+    Swap two directories. Uses Linux renameat2(RENAME_EXCHANGE) so readers see either
+    the old or the new partition, never neither; falls back to two renames elsewhere.
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.renameat2(_AT_FDCWD, a.encode(), _AT_FDCWD, b.encode(), _RENAME_EXCHANGE) == 0:
+            return
+    except (AttributeError, OSError):
+        pass
+    aside = f"{b}.swap"
+    os.rename(b, aside)
+    os.rename(a, b)
+    os.rename(aside, a)
+
+
+def _restore_late_files(old_dir: str, directory: str, replaced: List[str]) -> List[str]:
+    """
+    Move parquet files committed between a partition's last listing and its swap back
+    from the swapped-out `old_dir` into `directory`. Returns their new paths.
+    """
+    replaced_names = {os.path.basename(f) for f in replaced}
+    restored = []
+    for path in parquet_files(old_dir):
+        name = os.path.basename(path)
+        if name not in replaced_names and not os.path.exists(os.path.join(directory, name)):
+            os.replace(path, os.path.join(directory, name))
+            restored.append(os.path.join(directory, name))
+    return restored
+
+
+def _scan_seconds(files: List[str], column: str) -> float:
+    started = time.perf_counter()
+    # Per-file scans so legacy partitions with drifted dtypes can still be timed
+    scans = [pl.scan_parquet(f, hive_partitioning=False).select(column) for f in files]
+    pl.concat(scans, how='vertical_relaxed').select(pl.col(column).max()).collect()
+    return time.perf_counter() - started
+
+
+def _row_bytes(files: List[str]) -> float:
+    """Average uncompressed bytes per row of parquet files, from their footers."""
+    rows, size = 0, 0
+    for path in files:
+        footer = pq.read_metadata(path)
+        rows += footer.num_rows
+        size += sum(footer.row_group(g).total_byte_size for g in range(footer.num_row_groups))
+    return size / rows if rows else 0.0
+
+
+def _file_chunks(path: str, rows: int):
+    """A parquet file as DataFrames of about `rows` rows (whole row groups)."""
+    total = pq.read_metadata(path).num_rows
+    if total <= rows:
+        yield pl.read_parquet(path, hive_partitioning=False)
+        return
+    for offset in range(0, total, rows):
+        yield pl.scan_parquet(path, hive_partitioning=False).slice(offset, rows).collect()
+
+
+def _sorted_runs(files: List[str], run_dir: str, sort_cols: List[str], run_rows: int, conform=None) -> List[str]:
+    """Read `files` in chunks of about `run_rows` rows, sort each chunk and write it to `run_dir`."""
+    runs, frames, buffered = [], [], 0
+
+    def spill():
+        path = os.path.join(run_dir, f"run-{len(runs):05d}.parquet")
+        pl.concat(frames, how='diagonal_relaxed').sort(sort_cols).write_parquet(
+            path, compression='lz4', statistics=True, row_group_size=min(RUN_ROW_GROUP_SIZE, run_rows))
+        runs.append(path)
+
+    for path in files:
+        for frame in _file_chunks(path, run_rows):
+            frames.append(conform(frame) if conform is not None else frame)
+            buffered += frame.height
+            if buffered >= run_rows:
+                spill()
+                frames, buffered = [], 0
+    if frames:
+        spill()
+    return runs
+
+
+def _key_ranges(runs: List[str], column: str, range_rows: int) -> List[pl.Expr]:
+    """
+    Filters splitting sorted runs into ranges of about `range_rows` rows of `column`
+    (nulls first), from an evenly spaced sample of every run. Rows sharing one value
+    always fall into the same range.
+    """
+    step = max(1, range_rows // 100)
+    samples = [pl.read_parquet(path, columns=[column]).gather_every(step) for path in runs]
+    values = pl.concat(samples, how='vertical_relaxed')[column].drop_nulls().sort()
+    boundaries = values.gather_every(max(1, range_rows // step))[1:].unique(maintain_order=True).to_list()
+    if not boundaries:
+        return [pl.lit(True)]
+    col = pl.col(column)
+    ranges = [col.is_null() | (col < boundaries[0])]
+    ranges += [(col >= lo) & (col < hi) for lo, hi in zip(boundaries, boundaries[1:])]
+    ranges.append(col >= boundaries[-1])
+    return ranges
+
+
+def compact_partition(directory: str, staging_dir: str, profile: Dict, sort_by,
+                      file_rows: int = 10_000_000, conform=None, metadata: Dict = None,
+                      memory_budget: int = COMPACTION_MEMORY_BUDGET) -> Dict:
+    """
+    Rewrite one partition as a few files sorted by `sort_by` (a column or list of
+    columns) and atomically swap them in. Profiles with `market_index` also get a
+    market index written into the new partition before the swap.
+
+    A partition larger than `memory_budget` is sorted externally: its files are read
+    in bounded chunks, each sorted into a run in the staging directory, and the runs
+    are merged one key range (of the first sort column) at a time, so only about one
+    budget's worth of rows is in memory at once.
+
+    Returns a dict with files/bytes/scan seconds before and after, and `late_files`:
+    files committed while the partition was being swapped, which are left as they are.
+    Raises RuntimeError if the partition's files changed during the compaction.
+    """
+    files = parquet_files(directory)
+    sort_cols = [sort_by] if isinstance(sort_by, str) else list(sort_by)
+    stats = {
+        'files_before': len(files),
+        'bytes_before': sum(os.path.getsize(f) for f in files),
+        'scan_before': _scan_seconds(files, sort_cols[0]),
+    }
+
+    new_dir = os.path.join(staging_dir, os.path.relpath(directory, '/').replace(os.sep, '__'))
+    if os.path.exists(new_dir):
+        shutil.rmtree(new_dir)
+    os.makedirs(new_dir)
+
+    # Rows held at once: a chunk, its sorted copy and the Arrow table being written
+    total_rows = sum(pq.read_metadata(f).num_rows for f in files)
+    budget_rows = max(MIN_RUN_ROWS, int(memory_budget / 3 / max(_row_bytes(files), 1.0)))
+    writer_options = {k: v for k, v in profile.items() if k not in LAYOUT_OPTIONS}
+    indexes = []
+    written = 0
+
+    def write_sorted(df: pl.DataFrame):
+        nonlocal written
+        for offset in range(0, df.height, file_rows):
+            part = df.slice(offset, file_rows)
+            table = part.to_arrow()
+            if metadata:
+                table = table.replace_schema_metadata({**(table.schema.metadata or {}), **metadata})
+            path = os.path.join(new_dir, f"compacted-{int(time.time())}-{written:05d}.parquet")
+            written += 1
+            sorting = [pq.SortingColumn(table.schema.get_field_index(c), nulls_first=True) for c in sort_cols]
+            with pq.ParquetWriter(path, table.schema, sorting_columns=sorting, **writer_options) as pw:
+                pw.write_table(table, row_group_size=profile['row_group_size'])
+            if profile.get('market_index'):
+                footer = pq.read_metadata(path)
+                row_groups = [footer.row_group(g).num_rows for g in range(footer.num_row_groups)]
+                indexes.append(market_index(part, os.path.basename(path), row_groups))
+
+    if total_rows <= budget_rows:
+        frames = [pl.read_parquet(f, hive_partitioning=False) for f in files]
+        if conform is not None:
+            frames = [conform(frame) for frame in frames]
+        write_sorted(pl.concat(frames, how='diagonal_relaxed').sort(sort_cols))
+    else:
+        run_dir = f"{new_dir}.runs"
+        shutil.rmtree(run_dir, ignore_errors=True)
+        os.makedirs(run_dir)
+        try:
+            runs = _sorted_runs(files, run_dir, sort_cols, budget_rows, conform)
+            for keys in _key_ranges(runs, sort_cols[0], budget_rows):
+                # Runs are sorted, so their row-group statistics skip most of each run
+                frames = [pl.scan_parquet(run, hive_partitioning=False).filter(keys).collect() for run in runs]
+                write_sorted(pl.concat(frames, how='diagonal_relaxed').sort(sort_cols))
+        finally:
+            shutil.rmtree(run_dir, ignore_errors=True)
+    if profile.get('market_index'):
+        write_market_index(new_dir, indexes)
+
+    # A file committed meanwhile (e.g. by a backfill of an old month) would be lost in
+    # the swap, so the partition is left alone and compacted on a later run
+    if parquet_files(directory) != files:
+        shutil.rmtree(new_dir)
+        raise RuntimeError("files were added or removed while compacting")
+    # After the exchange `new_dir` holds the old files and can be removed
+    exchange_dirs(new_dir, directory)
+    late_files = _restore_late_files(new_dir, directory, files)
+    shutil.rmtree(new_dir)
+
+    new_files = [f for f in parquet_files(directory) if f not in late_files]
+    stats.update({
+        'late_files': late_files,
+        'files_after': len(new_files),
+        'bytes_after': sum(os.path.getsize(f) for f in new_files),
+        'scan_after': _scan_seconds(new_files, sort_cols[0]),
+    })
+    return stats
+
+
+def merge_small_files(directory: str, staging_dir: str, sort_by, prefix: str = 'merged', match: str = None,
+                      max_bytes: int = MERGE_MAX_BYTES, max_small_files: int = MAX_SMALL_FILES,
+                      row_group_size: int = None, metadata: Dict = None):
+    """
+    Merge the small files of one partition into a single file sorted by `sort_by`.
+
+    Everything else in the partition (large files, sidecars) is hard-linked into the
+    new partition unchanged, so a merge costs the size of the small files, not of the
+    partition; the partition is then swapped in.
+
+    Args:
+        directory: Partition directory.
+        staging_dir: Where the new partition is assembled (same filesystem).
+        sort_by: Column or list of columns the merged file is sorted by.
+        prefix: Name prefix of the merged file.
+        match: Only merge files whose name starts with this (e.g. one writer's files).
+        max_bytes: Files smaller than this count as small.
+        max_small_files: Merge only once there are more small files than this.
+        row_group_size: Rows per row group of the merged file.
+        metadata: Parquet key/value metadata for the merged file's footer.
+
+    Returns:
+        (merged file paths, new file path), or None if the partition was left alone.
+    """
+    small = [
+        f for f in parquet_files(directory)
+        if os.path.getsize(f) < max_bytes and (match is None or os.path.basename(f).startswith(match))
+    ]
+    if len(small) <= max_small_files:
+        return None
+
+    new_dir = os.path.join(staging_dir, os.path.relpath(directory, '/').replace(os.sep, '__'))
+    if os.path.exists(new_dir):
+        shutil.rmtree(new_dir)
+    os.makedirs(new_dir)
+    merged_names = {os.path.basename(f) for f in small}
+    linked = set()
+    for name in os.listdir(directory):
+        if name not in merged_names and not name.startswith('.'):
+            os.link(os.path.join(directory, name), os.path.join(new_dir, name))
+            linked.add(name)
+
+    sort_cols = [sort_by] if isinstance(sort_by, str) else list(sort_by)
+    merged = pl.concat([pl.read_parquet(f, hive_partitioning=False) for f in small],
+                       how='vertical_relaxed').sort(sort_cols)
+    table = merged.to_arrow()
+    if metadata:
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), **metadata})
+    name = f"{prefix}-{time.time_ns()}.parquet"
+    pq.write_table(table, os.path.join(new_dir, name), compression='zstd', row_group_size=row_group_size)
+
+    # Files committed meanwhile are not in the new partition; leave it alone this time
+    if {n for n in os.listdir(directory) if not n.startswith('.')} != linked | merged_names:
+        shutil.rmtree(new_dir)
+        return None
+    exchange_dirs(new_dir, directory)
+    _restore_late_files(new_dir, directory, small)
+    shutil.rmtree(new_dir)
+    return small, os.path.join(directory, name)
+
+
+def compact_dataset(root: str, depth: int = None, sort_by: str = None, profile: str = 'default',
+                    min_age_seconds: int = 3600, force: bool = False,
+                    memory_budget: int = COMPACTION_MEMORY_BUDGET):
+    """
+    Compact every partition of a dataset that changed since the last compaction.
+
+    Each leaf partition is merged into a few files sorted by `sort_by`, written with the
+    chosen storage profile and swapped in atomically. Partition directory mtimes are
+    recorded in `<root>/_compaction_state.json`, so re-running only touches partitions
+    that gained or lost files since; partitions modified within `min_age_seconds` are
+    left alone because a writer may still be appending to them.
+
+    Args:
+        root: Dataset root, e.g. 'goldsky/orderFilled'.
+        depth: Partition depth (defaults from DATASETS).
+        sort_by: Column(s) to sort each partition by (defaults from the profile, then DATASETS).
+        profile: Key of COMPACTION_PROFILES.
+        min_age_seconds: Skip partitions modified more recently than this.
+        force: Recompact every partition regardless of state.
+        memory_budget: Approximate peak memory per partition (see compact_partition).
+    """
+    defaults = DATASETS.get(root.rstrip('/'), {})
+    depth = depth or defaults.get('depth', 2)
+    profile_options = COMPACTION_PROFILES[profile]
+    sort_by = sort_by or profile_options.get('sort_by') or defaults.get('sort_by', 'timestamp')
+
+    state_path = os.path.join(root, STATE_FILE)
+    state = {} if force else load_json_state(state_path, default={})
+
+    # Staging lives next to the resolved root so the swap stays on one filesystem
+    real_root = os.path.realpath(root)
+    staging_dir = f"{real_root}.compaction"
+    os.makedirs(staging_dir, exist_ok=True)
+
+    # Raw partitions are only compacted once process_live has consumed all of their
+    # files; the manifest then learns the new file names so nothing is reprocessed
+    manifest = None
+    if defaults.get('processing_manifest') and os.path.exists(DEFAULT_MANIFEST_PATH):
+        manifest = ProcessingManifest(DEFAULT_MANIFEST_PATH, raw_root=root)
+
+    catalog = Catalog(root) if os.path.exists(os.path.join(root, CATALOG_FILE)) else None
+
+    conform, metadata = None, defaults.get('metadata')
+    if defaults.get('token_dictionary'):
+        dictionary = TokenDictionary()
+        conform = lambda frame: encode_raw(frame, dictionary)
+    version = dataset_version(root)
+    if defaults.get('wallet_dictionary') and version is not None:
+        wallets = WalletDictionary()
+        conform = lambda frame: conform_processed(encode_wallets(frame, wallets), version)
+        metadata = schema_metadata(version)
+
+    print(f"Compacting {root} (depth={depth}, sort_by={sort_by}, profile={profile})")
+    totals = {'partitions': 0, 'files_before': 0, 'files_after': 0, 'bytes_before': 0,
+              'bytes_after': 0, 'scan_before': 0.0, 'scan_after': 0.0}
+    now = time.time()
+
+    for directory in partition_dirs(root, depth):
+        key = os.path.relpath(directory, root)
+        mtime = os.stat(directory).st_mtime_ns
+        if state.get(key) == mtime:
+            continue
+        if now - mtime / 1e9 < min_age_seconds:
+            print(f"  Skipping {key}: modified recently")
+            continue
+        files = parquet_files(directory)
+        if not files:
+            continue
+        if manifest is not None and not manifest.is_consumed(key, [os.path.basename(f) for f in files]):
+            print(f"  Skipping {key}: has files not yet processed")
+            continue
+
+        try:
+            stats = compact_partition(os.path.realpath(directory), staging_dir, profile_options, sort_by,
+                                      conform=conform, metadata=metadata, memory_budget=memory_budget)
+        except Exception as e:
+            print(f"  Failed to compact {key}: {e}")
+            continue
+
+        late_files = stats.pop('late_files')
+        if late_files:
+            print(f"  {key}: kept {len(late_files)} files committed during the swap")
+        state[key] = os.stat(directory).st_mtime_ns
+        save_json_state(state_path, state)
+        new_files = [f for f in parquet_files(directory) if f not in late_files]
+        if manifest is not None:
+            manifest.replace_files(key, new_files, state[key])
+            manifest.save()
+        if catalog is not None:
+            catalog.remove_files(files)
+            for path in new_files:
+                catalog.add_file(path)
+
+        totals['partitions'] += 1
+        for k in stats:
+            totals[k] += stats[k]
+        print(f"  {key}: {stats['files_before']} -> {stats['files_after']} files, "
+              f"{stats['bytes_before'] / 2**20:.1f} -> {stats['bytes_after'] / 2**20:.1f} MB, "
+              f"scan {stats['scan_before']:.3f}s -> {stats['scan_after']:.3f}s")
+
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+    print(f"Compacted {totals['partitions']} partitions: "
+          f"{totals['files_before']} -> {totals['files_after']} files, "
+          f"{totals['bytes_before'] / 2**20:.1f} -> {totals['bytes_after'] / 2**20:.1f} MB, "
+          f"scan {totals['scan_before']:.2f}s -> {totals['scan_after']:.2f}s")
+    return totals
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Compact small parquet files in the datalake")
+    parser.add_argument('roots', nargs='*', default=list(DATASETS), help="Dataset roots (default: all known datasets)")
+    parser.add_argument('--profile', default='default', choices=sorted(COMPACTION_PROFILES))
+    parser.add_argument('--depth', type=int, default=None)
+    parser.add_argument('--sort-by', default=None)
+    parser.add_argument('--min-age', type=int, default=3600, help="Skip partitions modified within this many seconds")
+    parser.add_argument('--force', action='store_true', help="Ignore compaction state and rewrite every partition")
+    parser.add_argument('--memory-budget-mb', type=int, default=COMPACTION_MEMORY_BUDGET // 2**20,
+                        help="Approximate peak memory per partition; larger ones are sorted externally")
+    args = parser.parse_args()
+
+    # Partitions are swapped out from under writers, and raw partitions rewrite the
+    # processing manifest, so run alone like update_utils.reprocess
+    from update_utils.daemon import UPDATE_LOCK, acquire_lock, fetcher_busy, release_lock
+    if not acquire_lock(UPDATE_LOCK):
+        print(f"❌ {UPDATE_LOCK} exists: another update is running (stop the daemon with "
+              f"`python -m update_utils.daemon --stop`)")
+        sys.exit(1)
+    try:
+        with fetcher_busy():
+            for dataset_root in args.roots:
+                if not os.path.isdir(dataset_root):
+                    print(f"Skipping {dataset_root}: not found")
+                    continue
+                compact_dataset(dataset_root, depth=args.depth, sort_by=args.sort_by, profile=args.profile,
+                                min_age_seconds=args.min_age, force=args.force,
+                                memory_budget=args.memory_budget_mb * 2**20)
+    finally:
+        release_lock(UPDATE_LOCK)
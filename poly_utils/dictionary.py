@@ -0,0 +1,321 @@
+import os
+import threading
+import time
+from typing import Dict, Iterable
+
+import polars as pl
+
+from poly_utils.markets import market_tokens
+from poly_utils.schema import PROCESSED_SCHEMA, column_names, conform_raw
+from poly_utils.utils import parquet_files
+
+TOKEN_DICTIONARY_DIR = 'goldsky/token_dictionary'
+WALLET_DICTIONARY_DIR = 'processed/wallets'
+
+# USDC appears as asset id "0" on one side of every fill and is always index 0
+USDC_TOKEN = '0'
+USDC_IDX = 0
+
+# Segments are merged into one once there are more than this many
+MAX_SEGMENTS = 64
+
+
+class SegmentedDictionary:
+    """
+    Persistent, append-only mapping from string keys to compact UInt32 indices.
+
+    An index, once assigned, always names the same key, so data files can store the
+    integer and never need rewriting. The dictionary is kept as a directory of small
+    parquet segments, each written atomically; a segment may also re-state an existing
+    index with new attribute values, and the last statement wins on load.
+
+    Only one process should add to a dictionary at a time; within a process it is
+    thread-safe. Subclasses set `KEY` and `SCHEMA` (`idx`, the key and any attributes).
+
+    Args:
+        root: Directory holding the dictionary segments.
+    """
+
+    KEY = 'key'
+    SCHEMA = {'idx': pl.UInt32, 'key': pl.Utf8}
+
+    def __init__(self, root: str):
+        self.root = root
+        self._lock = threading.RLock()
+        self._pending = []
+        # key -> idx, built on first use and extended as rows are added (see _index)
+        self._by_key: Dict[str, int] = None
+        self._load()
+
+    def _segments(self):
+        return parquet_files(self.root) if os.path.isdir(self.root) else []
+
+    def _load(self):
+        segments = self._segments()
+        if segments:
+            self.frame = (
+                pl.concat([pl.read_parquet(s) for s in segments])
+                .unique(subset='idx', keep='last', maintain_order=True)
+                .sort('idx')
+            )
+        else:
+            self.frame = pl.DataFrame(schema=self.SCHEMA)
+        self._by_key = None
+
+    def __len__(self):
+        return self.frame.height
+
+    def _append(self, rows: pl.DataFrame, restate: bool = False):
+        """Add rows (or re-state existing indices) in memory; they are persisted by save()."""
+        self.frame = pl.concat([self.frame, rows])
+        if restate:
+            self.frame = self.frame.unique(subset='idx', keep='last', maintain_order=True).sort('idx')
+        self._pending.append(rows)
+        if self._by_key is not None:
+            self._by_key.update(zip(rows[self.KEY].to_list(), rows['idx'].to_list()))
+
+    def _index(self) -> Dict[str, int]:
+        """
+        key -> idx of the whole dictionary. Kept across calls so encoding a batch costs
+        a lookup per distinct key, not a hash map over every key in the dictionary.
+        """
+        if self._by_key is None:
+            self._by_key = dict(zip(self.frame[self.KEY].to_list(), self.frame['idx'].to_list()))
+        return self._by_key
+
+    def _normalize(self, keys: pl.Series) -> pl.Series:
+        return keys
+
+    def add(self, keys: Iterable[str]) -> int:
+        """Assign indices to any keys not in the dictionary yet. Returns how many were new."""
+        if not isinstance(keys, pl.Series):
+            keys = pl.Series(list(keys), dtype=pl.Utf8)
+        with self._lock:
+            index = self._index()
+            candidates = self._normalize(keys.cast(pl.Utf8)).drop_nulls().unique(maintain_order=True)
+            new = pl.Series([k for k in candidates.to_list() if k not in index], dtype=pl.Utf8)
+            if new.is_empty():
+                return 0
+            start = self.frame['idx'].max() + 1 if self.frame.height else 0
+            rows = pl.DataFrame({
+                'idx': pl.arange(start, start + new.len(), eager=True).cast(pl.UInt32),
+                self.KEY: new,
+            }).with_columns([
+                pl.lit(None, dtype=dtype).alias(name)
+                for name, dtype in self.SCHEMA.items() if name not in ('idx', self.KEY)
+            ]).select(list(self.SCHEMA))
+            self._append(rows)
+            return new.len()
+
+    def encode(self, column: str, keys: pl.Series = None) -> pl.Expr:
+        """
+        Expression mapping a key column to its UInt32 index (null if unknown).
+
+        Pass the values the column holds as `keys` (e.g. one batch's) to map only
+        those; otherwise the mapping covers the whole dictionary, which suits one-off
+        lazy queries rather than per-batch encoding.
+        """
+        if keys is None:
+            known, idx = self.frame[self.KEY], self.frame['idx']
+        else:
+            with self._lock:
+                index = self._index()
+                found = [k for k in self._normalize(keys.cast(pl.Utf8)).drop_nulls().unique().to_list() if k in index]
+                known = pl.Series(found, dtype=pl.Utf8)
+                idx = pl.Series([index[k] for k in found], dtype=pl.UInt32)
+        return self._normalize_expr(pl.col(column)).replace_strict(
+            known, idx, default=None, return_dtype=pl.UInt32
+        )
+
+    def _normalize_expr(self, expr: pl.Expr) -> pl.Expr:
+        return expr
+
+    def decode(self, column: str) -> pl.Expr:
+        """Expression mapping a UInt32 index column back to its key."""
+        return pl.col(column).replace_strict(
+            self.frame['idx'], self.frame[self.KEY], default=None, return_dtype=pl.Utf8
+        )
+
+    def save(self):
+        """Persist rows added since the last save as one new segment."""
+        with self._lock:
+            if not self._pending:
+                return
+            os.makedirs(self.root, exist_ok=True)
+            segments = self._segments()
+            if len(segments) >= MAX_SEGMENTS:
+                # Merge: one segment holding the whole dictionary replaces all others
+                rows, obsolete = self.frame, segments
+            else:
+                rows, obsolete = pl.concat(self._pending), []
+            name = f"segment-{time.time_ns()}.parquet"
+            tmp_path = os.path.join(self.root, f".{name}.tmp")
+            rows.write_parquet(tmp_path, compression='zstd')
+            os.replace(tmp_path, os.path.join(self.root, name))
+            for path in obsolete:
+                os.remove(path)
+            self._pending = []
+
+
+class TokenDictionary(SegmentedDictionary):
+    """
+    Dictionary of CLOB token IDs (77-digit decimal strings), with each token's market ID
+    and outcome side ("token1"/"token2"). Index 0 is always USDC.
+
+    Tokens seen in fills before their market is synced get an index with a null market;
+    sync_markets() fills it in later.
+
+    Args:
+        root: Directory holding the dictionary segments.
+    """
+
+    KEY = 'token_id'
+    SCHEMA = {
+        'idx': pl.UInt32,
+        'token_id': pl.Utf8,
+        'market_id': pl.Utf8,
+        'side': pl.Utf8,
+    }
+
+    def __init__(self, root: str = TOKEN_DICTIONARY_DIR):
+        super().__init__(root)
+        if self.frame.is_empty() or self.frame['idx'][0] != USDC_IDX:
+            self._append(pl.DataFrame(
+                {'idx': [USDC_IDX], 'token_id': [USDC_TOKEN], 'market_id': [None], 'side': [None]},
+                schema=self.SCHEMA,
+            ), restate=True)
+
+    def sync_markets(self, markets_df: pl.DataFrame) -> int:
+        """
+        Record the market and side of every token1/token2 in a markets DataFrame
+        (as returned by get_markets()). Returns the number of tokens added or updated.
+        """
+        return self.sync_tokens(market_tokens(markets_df))
+
+    def sync_tokens(self, tokens: pl.DataFrame) -> int:
+        """
+        Record market and side from a `token_id, market_id, side` table (e.g.
+        poly_utils.markets.load_market_tokens()), adding tokens that are new. Returns
+        the number of tokens added or updated.
+        """
+        with self._lock:
+            self.add(tokens['token_id'])
+            changed = (
+                tokens
+                .join(self.frame, on='token_id', how='inner', suffix='_known')
+                .filter(
+                    pl.col('market_id_known').is_null()
+                    | (pl.col('market_id') != pl.col('market_id_known'))
+                    | (pl.col('side') != pl.col('side_known'))
+                )
+                .select(list(self.SCHEMA))
+            )
+            if not changed.is_empty():
+                self._append(changed, restate=True)
+            return changed.height
+
+    def lookup_frame(self) -> pl.DataFrame:
+        """
+        `asset_idx -> market_id, side` table used to enrich trades with an integer join,
+        with market_id and side typed as in the processed schema.
+        """
+        return self.frame.select([
+            pl.col('idx').alias('asset_idx'),
+            pl.col('market_id').cast(PROCESSED_SCHEMA['market_id']),
+            pl.col('side').cast(PROCESSED_SCHEMA['nonusdc_side']),
+        ])
+
+
+class WalletDictionary(SegmentedDictionary):
+    """
+    Dimension table of wallet addresses: each lower-cased 0x address gets a stable
+    UInt32 id the first time it appears in a trade.
+
+    Args:
+        root: Directory holding the dictionary segments.
+    """
+
+    KEY = 'address'
+    SCHEMA = {'idx': pl.UInt32, 'address': pl.Utf8}
+
+    def __init__(self, root: str = WALLET_DICTIONARY_DIR):
+        super().__init__(root)
+
+    def _normalize(self, keys: pl.Series) -> pl.Series:
+        return keys.str.to_lowercase()
+
+    def _normalize_expr(self, expr: pl.Expr) -> pl.Expr:
+        return expr.str.to_lowercase()
+
+    def lookup(self, address: str):
+        """Wallet id of one address, or None if it never traded."""
+        with self._lock:
+            return self._index().get(address.lower())
+
+
+def encode_raw(frame, dictionary: TokenDictionary, assign: bool = True):
+    """
+    Conform a raw orderFilled DataFrame/LazyFrame and fill its makerAssetIdx/takerAssetIdx.
+
+    Rows that already carry indices keep them. With `assign=True` (DataFrames only) unseen
+    tokens get new indices and the dictionary is saved before returning, so a raw file
+    written afterwards never references an index that is not on disk.
+    """
+    frame = conform_raw(frame)
+    keys = None
+    if isinstance(frame, pl.DataFrame):
+        keys = pl.concat([frame['makerAssetId'], frame['takerAssetId']])
+        if assign and dictionary.add(keys):
+            dictionary.save()
+    return frame.with_columns([
+        pl.coalesce(pl.col('makerAssetIdx'), dictionary.encode('makerAssetId', keys)).alias('makerAssetIdx'),
+        pl.coalesce(pl.col('takerAssetIdx'), dictionary.encode('takerAssetId', keys)).alias('takerAssetIdx'),
+    ])
+
+
+def tx_hash_to_binary(column: str = 'transactionHash') -> pl.Expr:
+    """Expression turning a 0x-prefixed hex transaction hash into 32 raw bytes."""
+    return pl.col(column).str.strip_prefix('0x').str.decode('hex').alias(column)
+
+
+def tx_hash_to_hex(column: str = 'transactionHash') -> pl.Expr:
+    """Expression turning a binary transaction hash back into its 0x-prefixed hex string."""
+    return pl.concat_str([pl.lit('0x'), pl.col(column).bin.encode('hex')]).alias(column)
+
+
+def encode_wallets(frame, wallets: WalletDictionary, assign: bool = True):
+    """
+    Convert processed trades with string maker/taker/transactionHash (schema v1) to
+    wallet ids and a binary hash (schema v2). maker_id/taker_id take the place of
+    maker/taker and the other columns are left alone. Frames that already have wallet
+    ids are returned as is.
+
+    With `assign=True` (DataFrames only) new addresses get ids and the wallet dictionary
+    is saved before returning, so trades written afterwards only reference saved ids.
+    """
+    if 'maker' not in column_names(frame):
+        return frame
+    keys = None
+    if isinstance(frame, pl.DataFrame):
+        keys = pl.concat([frame['maker'], frame['taker']])
+        if assign and wallets.add(keys):
+            wallets.save()
+    encoded = {
+        'maker': wallets.encode('maker', keys).alias('maker_id'),
+        'taker': wallets.encode('taker', keys).alias('taker_id'),
+        'transactionHash': tx_hash_to_binary('transactionHash'),
+    }
+    return frame.select([encoded.get(c, pl.col(c)) for c in column_names(frame)])
+
+
+def with_addresses(frame, wallets: WalletDictionary = None):
+    """
+    Translate processed trades back to readable form: maker/taker addresses instead of
+    wallet ids and hex transaction hashes. Works on DataFrames and LazyFrames.
+    """
+    wallets = wallets or WalletDictionary()
+    return frame.with_columns([
+        wallets.decode('maker_id').alias('maker'),
+        wallets.decode('taker_id').alias('taker'),
+        tx_hash_to_hex('transactionHash'),
+    ]).drop(['maker_id', 'taker_id'])
@@ -0,0 +1,229 @@
+"""
+Per-day index of the orderFilled event ids stored in goldsky/orderFilled, so writers
+can drop events that are already on disk.
+
+Each event id is reduced to a 64-bit fingerprint (see event_fingerprints). For every
+day partition, `goldsky/event_index/year=/month=/day=/` holds small parquet segments of
+sorted fingerprints, written atomically like the dictionary segments. Each segment's
+footer lists the raw files it covers. Loading a day reconciles it with the partition:
+files no segment covers (written without the index, or before a crash) are indexed
+from their `id` column. If a covered file has gone, e.g. after compaction, the day is
+rebuilt from its files. Either way only the `id` column of one day is read.
+
+PartitionWriter consults the index (its `event_index` argument): write() drops events
+already stored or already buffered, and each committed file's fingerprints are added.
+Overlapping fetches, retried pages and re-run windows then write nothing.
+"""
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from poly_utils.utils import parquet_files
+
+EVENT_INDEX_DIR = 'goldsky/event_index'
+
+# A day's segments are merged into one once there are more than this many
+MAX_SEGMENTS = 64
+
+# Days kept in memory; days with nothing left to save are evicted oldest first
+MAX_LOADED_DAYS = 4
+
+# Parquet footer key listing the raw files a segment covers
+FILES_KEY = b'poly_event_files'
+
+PARTITION_COLS = ['year', 'month', 'day']
+
+
+def event_fingerprints(ids) -> pl.Series:
+    """
+    64-bit fingerprints of orderFilled event ids (`0x<tx hash>_0x<order hash>`): the
+    first 16 hex digits of both hashes, XORed. Both are keccak hashes, so the
+    fingerprint is as good as a random 64-bit hash, and it is stable across versions
+    of anything. Ids of any other shape (or null) get a null fingerprint and are never
+    treated as duplicates.
+    """
+    ids = ids if isinstance(ids, pl.Series) else pl.Series(list(ids), dtype=pl.Utf8)
+    parts = ids.cast(pl.Utf8).str.extract_groups(r'^0x([0-9a-fA-F]{16})[0-9a-fA-F]*_0x([0-9a-fA-F]{16})')
+    tx = parts.struct.field('1').str.to_integer(base=16, dtype=pl.UInt64, strict=False)
+    order = parts.struct.field('2').str.to_integer(base=16, dtype=pl.UInt64, strict=False)
+    return (tx ^ order).alias('fingerprint')
+
+
+def _contains(sorted_values: pl.Series, values: pl.Series) -> pl.Series:
+    """Boolean mask of `values` found in the sorted, null-free `sorted_values`."""
+    if sorted_values.is_empty() or values.is_empty():
+        return pl.Series([False] * values.len(), dtype=pl.Boolean)
+    filled = values.fill_null(0)
+    idx = sorted_values.search_sorted(filled).clip(upper_bound=sorted_values.len() - 1)
+    return (sorted_values.gather(idx) == filled) & values.is_not_null()
+
+
+class _Day:
+    def __init__(self):
+        self.fingerprints = pl.Series('fingerprint', [], dtype=pl.UInt64)
+        self.files = set()
+        self.segments = 0
+        self.in_flight: List[pl.Series] = []
+        self.staged: List[pl.Series] = []
+        self.staged_files = set()
+        self.rewrite = False
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self.in_flight or self.staged or self.staged_files or self.rewrite)
+
+
+class EventIndex:
+    """
+    Event-id index of one raw dataset (see the module docstring). Thread-safe; only
+    one process should write to a dataset at a time.
+
+    Args:
+        raw_root: Raw dataset root, partitioned by year/month/day.
+        root: Directory holding the index segments.
+    """
+
+    def __init__(self, raw_root: str = 'goldsky/orderFilled', root: str = EVENT_INDEX_DIR):
+        self.raw_root = raw_root
+        self.root = root
+        self.duplicates_dropped = 0
+        self._days: Dict[Tuple, _Day] = {}
+        self._lock = threading.RLock()
+
+    def _relpath(self, key: Tuple) -> str:
+        return os.path.join(*[f"{col}={value}" for col, value in zip(PARTITION_COLS, key)])
+
+    def _key_for(self, path: str) -> Tuple:
+        directory = os.path.relpath(os.path.dirname(path), self.raw_root)
+        return tuple(int(part.split('=', 1)[1]) for part in directory.split(os.sep))
+
+    def _read_ids(self, paths: List[str]) -> pl.Series:
+        fingerprints = [
+            event_fingerprints(pl.read_parquet(path, columns=['id'], hive_partitioning=False)['id'])
+            for path in paths if 'id' in pq.read_schema(path).names
+        ]
+        if not fingerprints:
+            return pl.Series('fingerprint', [], dtype=pl.UInt64)
+        return pl.concat(fingerprints).drop_nulls()
+
+    def _load(self, key: Tuple) -> _Day:
+        day = _Day()
+        index_dir = os.path.join(self.root, self._relpath(key))
+        segments = parquet_files(index_dir) if os.path.isdir(index_dir) else []
+        frames = []
+        for path in segments:
+            table = pq.read_table(path)
+            day.files.update(json.loads((table.schema.metadata or {}).get(FILES_KEY, b'[]')))
+            frames.append(pl.from_arrow(table)['fingerprint'])
+        day.segments = len(segments)
+        if frames:
+            day.fingerprints = pl.concat(frames).unique().sort()
+
+        partition = os.path.join(self.raw_root, self._relpath(key))
+        present = {os.path.basename(f): f for f in parquet_files(partition)} if os.path.isdir(partition) else {}
+        if day.files - set(present):
+            # Files were rewritten or removed: rebuild the day from what is on disk
+            day.fingerprints = self._read_ids(list(present.values())).unique().sort()
+            day.files = set(present)
+            day.rewrite = True
+        elif set(present) - day.files:
+            missing = sorted(set(present) - day.files)
+            day.staged.append(self._read_ids([present[name] for name in missing]))
+            day.staged_files.update(missing)
+        return day
+
+    def _day(self, key: Tuple) -> _Day:
+        day = self._days.get(key)
+        if day is None:
+            day = self._days[key] = self._load(key)
+            for old in list(self._days):
+                if len(self._days) <= MAX_LOADED_DAYS:
+                    break
+                if old != key and not self._days[old].dirty:
+                    del self._days[old]
+        return day
+
+    def _known(self, day: _Day, fingerprints: pl.Series) -> pl.Series:
+        known = _contains(day.fingerprints, fingerprints)
+        pending = day.staged + day.in_flight
+        if pending:
+            known = known | fingerprints.is_in(pl.concat(pending))
+        return known
+
+    def filter_new(self, df: pl.DataFrame) -> pl.DataFrame:
+        """
+        Rows of `df` (raw events with year/month/day columns) whose event is neither
+        stored nor already passed by an earlier call, deduplicated within `df` too.
+        """
+        if df.is_empty() or 'id' not in df.columns:
+            return df
+        with self._lock:
+            df = df.with_columns(event_fingerprints(df['id']).alias('_fingerprint'))
+            kept = []
+            for key, group in df.partition_by(PARTITION_COLS, as_dict=True, maintain_order=True).items():
+                day = self._day(tuple(int(k) for k in key))
+                fingerprints = group['_fingerprint']
+                new = fingerprints.is_null() | (fingerprints.is_first_distinct() & ~self._known(day, fingerprints))
+                group = group.filter(new)
+                day.in_flight.append(group['_fingerprint'].drop_nulls())
+                kept.append(group)
+            new_df = pl.concat(kept) if kept else df.clear()
+            self.duplicates_dropped += df.height - new_df.height
+            return new_df.drop('_fingerprint')
+
+    def record(self, path: str, fingerprints: pl.Series):
+        """Add the fingerprints of a committed raw file."""
+        with self._lock:
+            day = self._day(self._key_for(path))
+            day.staged.append(fingerprints.drop_nulls())
+            day.staged_files.add(os.path.basename(path))
+
+    def replace_files(self, old_paths: List[str], new_path: str):
+        """Note that `old_paths` were merged into `new_path` (same events, new file)."""
+        with self._lock:
+            day = self._day(self._key_for(new_path))
+            day.files.difference_update(os.path.basename(p) for p in old_paths)
+            day.staged_files.difference_update(os.path.basename(p) for p in old_paths)
+            day.files.add(os.path.basename(new_path))
+            day.rewrite = True
+
+    def discard(self):
+        """Forget events passed by filter_new() that were never committed."""
+        with self._lock:
+            for day in self._days.values():
+                day.in_flight = []
+
+    def save(self):
+        """Persist the committed files' fingerprints as one new segment per day."""
+        with self._lock:
+            for key, day in self._days.items():
+                if not (day.staged or day.staged_files or day.rewrite):
+                    day.in_flight = []
+                    continue
+                staged = pl.concat(day.staged) if day.staged else day.fingerprints.clear()
+                day.fingerprints = pl.concat([day.fingerprints, staged]).unique().sort()
+                day.files.update(day.staged_files)
+                index_dir = os.path.join(self.root, self._relpath(key))
+                os.makedirs(index_dir, exist_ok=True)
+                segments = parquet_files(index_dir)
+                if day.rewrite or len(segments) >= MAX_SEGMENTS:
+                    # One segment covering the whole day replaces all others
+                    values, files, obsolete = day.fingerprints, day.files, segments
+                else:
+                    values, files, obsolete = staged.unique().sort(), day.staged_files, []
+                table = pa.table({'fingerprint': values.to_arrow()})
+                table = table.replace_schema_metadata({FILES_KEY: json.dumps(sorted(files)).encode()})
+                name = f"segment-{time.time_ns()}.parquet"
+                tmp_path = os.path.join(index_dir, f".{name}.tmp")
+                pq.write_table(table, tmp_path, compression='zstd')
+                os.replace(tmp_path, os.path.join(index_dir, name))
+                for path in obsolete:
+                    os.remove(path)
+                day.segments = len(segments) - len(obsolete) + 1
+                day.staged, day.staged_files, day.in_flight, day.rewrite = [], set(), [], False
@@ -0,0 +1,312 @@
+"""
+Live trade feed: processed trades published as an Arrow IPC stream on a Unix socket.
+
+TradeFeed is a processing consumer (write/close, like BarWriter). Every enriched batch
+handed to it is sent to each connected subscriber as Arrow record batches, right after
+get_processed_df and a few seconds before the batch is committed to `processed/trades`.
+Subscribers read the stream with pyarrow directly and never touch the datalake:
+
+    for trades in subscribe(since='2025-01-01T00:00:00'):
+        ...
+
+A subscriber may ask to replay trades from a timestamp first. Older trades come from
+`processed/trades` (files picked through its catalog), the most recent ones from the
+batches the feed still holds in memory, and then the live stream continues without a
+gap or duplicate.
+
+Once its replay is sent, each subscriber has a bounded queue. A slow subscriber holds back processing (and with
+it the Goldsky fetch) for up to `block_seconds`; one that is still stuck after that is
+disconnected, so a dead client cannot stall ingestion. It can reconnect with `since`
+set to the last timestamp it saw.
+
+Batches use the schema of processed/trades: wallet ids and binary transaction hashes
+(see with_addresses), and integer amounts and Enum columns (see decode_compact) once
+it is migrated to v3.
+
+    python -m poly_utils.feed --since 2025-01-01T00:00:00
+"""
+import json
+import os
+import queue
+import socket
+import threading
+from datetime import datetime, timezone
+from typing import Iterator, List
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from poly_utils.catalog import Catalog
+from poly_utils.metrics import METRICS
+
+FEED_SOCKET = '/tmp/poly-trades.sock'
+
+# Batches queued per subscriber before publishing blocks, and how long it blocks
+# before the subscriber is disconnected
+SUBSCRIBER_QUEUE_BATCHES = 64
+BLOCK_SECONDS = 5.0
+
+# Rows of the latest published batches kept in memory for replays; everything older
+# is replayed from processed/trades
+RECENT_ROWS = 1_000_000
+
+# Rows per record batch when replaying from the datalake
+REPLAY_BATCH_ROWS = 65_536
+
+_CLOSE = object()
+
+
+def _parse_since(value):
+    """Epoch seconds or an ISO timestamp (naive means UTC) to a naive UTC datetime."""
+    if value is None or isinstance(value, datetime):
+        return value
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, timezone.utc).replace(tzinfo=None)
+    since = datetime.fromisoformat(value)
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return since
+
+
+class _Subscriber:
+    def __init__(self, conn: socket.socket):
+        self.conn = conn
+        # Unbounded while the replay is sent, so live batches pile up instead of
+        # getting the subscriber disconnected; bounded once it is live
+        self.queue = queue.Queue()
+        self.dropped = False
+
+    def disconnect(self):
+        self.dropped = True
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class TradeFeed:
+    """
+    Publishes processed trade batches to subscribers of a Unix socket (see the module
+    docstring). start() begins accepting subscribers, stop() disconnects them.
+
+    Args:
+        path: Socket path.
+        dataset: processed trades dataset used for replays.
+        queue_batches: Batches queued per subscriber before publishing blocks.
+        block_seconds: How long publishing waits on a full subscriber before
+            disconnecting it.
+        recent_rows: Rows of recent batches kept in memory for replays.
+    """
+
+    def __init__(self, path: str = FEED_SOCKET, dataset: str = 'processed/trades',
+                 queue_batches: int = SUBSCRIBER_QUEUE_BATCHES, block_seconds: float = BLOCK_SECONDS,
+                 recent_rows: int = RECENT_ROWS):
+        self.path = path
+        self.dataset = dataset
+        self.queue_batches = queue_batches
+        self.block_seconds = block_seconds
+        self.recent_rows = recent_rows
+        self._recent: List[pa.Table] = []
+        self._recent_height = 0
+        self._subscribers: List[_Subscriber] = []
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                os.remove(self.path)  # left behind by a process that is gone
+            else:
+                probe.close()
+                raise RuntimeError(f"Another feed is already serving {self.path}")
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.path)
+        self._server.listen()
+        threading.Thread(target=self._accept, name='feed', daemon=True).start()
+        print(f"📡 Publishing trades on {self.path}")
+        return self
+
+    def stop(self):
+        """End every subscriber's stream after what is queued, and stop listening."""
+        if self._server is None:
+            return
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)  # wakes the accept thread
+        except OSError:
+            pass
+        self._server.close()
+        self._server = None
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, []
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put(_CLOSE, timeout=self.block_seconds)
+            except queue.Full:
+                subscriber.disconnect()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def write(self, trades: pl.DataFrame):
+        """Publish a batch of processed trades to every subscriber."""
+        if trades.is_empty():
+            return
+        # Converted once, here: subscribers share the immutable Arrow table (Polars can
+        # deadlock converting one DataFrame from several threads at once)
+        table = trades.to_arrow()
+        with self._lock:
+            self._recent.append(table)
+            self._recent_height += table.num_rows
+            while len(self._recent) > 1 and self._recent_height - self._recent[0].num_rows >= self.recent_rows:
+                self._recent_height -= self._recent.pop(0).num_rows
+            for subscriber in self._subscribers:
+                try:
+                    subscriber.queue.put(table, timeout=self.block_seconds)
+                except queue.Full:
+                    print(f"⚠️  Feed subscriber fell {self.queue_batches} batches behind; disconnecting it")
+                    subscriber.disconnect()
+            self._subscribers = [s for s in self._subscribers if not s.dropped]
+            METRICS.set_gauge('feed_subscribers', len(self._subscribers))
+        METRICS.count('feed_rows_published', trades.height)
+
+    def close(self):
+        """Nothing is buffered; the feed stays up across commits until stop()."""
+
+    def _accept(self):
+        server = self._server
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return  # stop() closed the socket
+            threading.Thread(target=self._serve, args=(conn,), name='feed-subscriber', daemon=True).start()
+
+    def _serve(self, conn: socket.socket):
+        subscriber = _Subscriber(conn)
+        try:
+            conn.settimeout(10)
+            with conn.makefile('rb') as f:
+                request = json.loads(f.readline() or b'{}')
+            conn.settimeout(None)
+            since = _parse_since(request.get('since'))
+
+            # Registering and copying the recent batches under one lock means every
+            # batch is either in the copy or queued for the subscriber, never both
+            with self._lock:
+                recent = list(self._recent)
+                self._subscribers.append(subscriber)
+                METRICS.set_gauge('feed_subscribers', len(self._subscribers))
+
+            with conn.makefile('wb') as sink:
+                stream = _Stream(sink)
+                if since is not None:
+                    cutoff = min(pc.min(t['timestamp']).as_py() for t in recent) if recent else None
+                    for table in self._replay(since, cutoff):
+                        stream.send(table)
+                    for table in recent:
+                        stream.send(table.filter(pc.field('timestamp') >= pa.scalar(since, table.schema.field('timestamp').type)))
+                with subscriber.queue.mutex:
+                    subscriber.queue.maxsize = self.queue_batches
+                while not subscriber.dropped:
+                    table = subscriber.queue.get()
+                    if table is _CLOSE:
+                        break
+                    stream.send(table)
+                stream.close()
+        except Exception as e:
+            if not subscriber.dropped:
+                print(f"Feed subscriber disconnected: {e}")
+        finally:
+            subscriber.dropped = True
+            with self._lock:
+                if subscriber in self._subscribers:
+                    self._subscribers.remove(subscriber)
+            conn.close()
+
+    def _replay(self, since: datetime, cutoff=None) -> Iterator[pa.Table]:
+        """Trades in [since, cutoff) from the datalake, oldest first, one month at a time."""
+        if not os.path.isdir(self.dataset):
+            return
+        catalog = Catalog(self.dataset, stats_column='timestamp')
+        files = catalog.files_overlapping(since, cutoff)
+        for partition in sorted({os.path.dirname(f) for f in files}, key=_partition_order):
+            lf = pl.scan_parquet([f for f in files if os.path.dirname(f) == partition], hive_partitioning=False)
+            lf = lf.filter(pl.col('timestamp') >= since)
+            if cutoff is not None:
+                lf = lf.filter(pl.col('timestamp') < cutoff)
+            df = lf.sort('timestamp').collect()
+            for offset in range(0, df.height, REPLAY_BATCH_ROWS):
+                yield df.slice(offset, REPLAY_BATCH_ROWS).to_arrow()
+
+
+def _partition_order(directory: str):
+    """year=2024/month=10 after year=2024/month=9."""
+    return [int(part.split('=', 1)[1]) for part in directory.split(os.sep) if '=' in part]
+
+
+class _Stream:
+    """Arrow IPC stream whose schema is taken from the first table; later tables are conformed to it."""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.schema = None
+        self.writer = None
+
+    def send(self, table: pa.Table):
+        if table.num_rows == 0:
+            return
+        if self.writer is None:
+            self.schema = table.schema
+            self.writer = pa.ipc.new_stream(self.sink, self.schema)
+        elif table.schema != self.schema:
+            table = table.select(self.schema.names).cast(self.schema)
+        self.writer.write_table(table)
+        self.sink.flush()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def subscribe(since=None, path: str = FEED_SOCKET) -> Iterator[pl.DataFrame]:
+    """
+    Yield processed trade batches from a running feed as they are published.
+
+    Args:
+        since: Replay trades from this timestamp first (datetime, ISO string or epoch
+            seconds; naive means UTC). None starts with the next live batch.
+        path: Socket path of the feed.
+    """
+    if isinstance(since, datetime):
+        since = since.isoformat()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps({'since': since}).encode() + b'\n')
+        with sock.makefile('rb') as source:
+            try:
+                reader = pa.ipc.open_stream(source)
+            except pa.ArrowInvalid:
+                return  # the feed stopped before sending anything
+            for batch in reader:
+                yield pl.from_arrow(batch)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Print trades from the live feed as they arrive")
+    parser.add_argument('--since', help="Replay trades from this timestamp (ISO or epoch seconds) first")
+    parser.add_argument('--path', default=FEED_SOCKET)
+    args = parser.parse_args()
+
+    since = float(args.since) if args.since and args.since.replace('.', '', 1).isdigit() else args.since
+    try:
+        for trades in subscribe(since, args.path):
+            print(trades)
+    except KeyboardInterrupt:
+        pass
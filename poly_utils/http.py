@@ -0,0 +1,62 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from poly_utils.metrics import record_response
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket shared by concurrent workers.
+
+    Every call to acquire() takes one token, blocking until one is available,
+    so N workers together never exceed `rate` requests per second.
+
+    Args:
+        rate: Sustained requests per second across all callers.
+        burst: Maximum number of tokens that can accumulate (default: rate, at least 1).
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.burst = float(burst) if burst else max(1.0, self.rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def make_session(pool_size: int = 10):
+    """
+    Create a keep-alive requests.Session with a connection pool sized for `pool_size`
+    concurrent callers. Retries are left to the caller so backoff can be jittered.
+    Every response's latency and status are recorded in poly_utils.metrics.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+    session.hooks['response'].append(record_response)
+    return session
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 60.0) -> float:
+    """Full-jitter exponential backoff: a random delay in [0, min(cap, base * 2**attempt)]."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
@@ -0,0 +1,126 @@
+import os
+from datetime import date
+from typing import Dict, List, Set, Tuple
+
+import pyarrow.parquet as pq
+
+from poly_utils.utils import load_json_state, parquet_files, partition_dirs, save_json_state
+
+MANIFEST_FILE = '_manifest.json'
+DEFAULT_MANIFEST_PATH = os.path.join('processed/trades', MANIFEST_FILE)
+
+
+def raw_file_stats(path: str) -> Tuple[int, int]:
+    """Row count and max `timestamp` of a raw file, read from its parquet footer only."""
+    metadata = pq.read_metadata(path)
+    column = metadata.schema.names.index('timestamp')
+    max_ts = None
+    for i in range(metadata.num_row_groups):
+        stats = metadata.row_group(i).column(column).statistics
+        if stats is not None and stats.has_min_max:
+            value = int(stats.max)
+            max_ts = value if max_ts is None else max(max_ts, value)
+    return metadata.num_rows, max_ts
+
+
+def _partition_date(key: str) -> date:
+    parts = dict(p.split('=', 1) for p in key.split(os.sep))
+    return date(int(parts['year']), int(parts['month']), int(parts['day']))
+
+
+class ProcessingManifest:
+    """
+    Record of which raw goldsky partitions and files process_live has consumed.
+
+    For every `year=/month=/day=` partition it stores the directory mtime seen when the
+    partition was last fully consumed, plus the row count and max timestamp of each
+    consumed file. Partitions whose mtime is unchanged are not listed again, so finding
+    new input costs a directory walk instead of a glob over every file in the dataset.
+
+    Args:
+        path: Manifest JSON file (kept next to the processed output).
+        raw_root: Raw dataset root the manifest describes.
+    """
+
+    def __init__(self, path: str = DEFAULT_MANIFEST_PATH, raw_root: str = 'goldsky/orderFilled'):
+        self.path = path
+        self.raw_root = raw_root
+        self.partitions: Dict[str, Dict] = load_json_state(path, default={}).get('partitions', {})
+        # Partitions listed by pending_files(): mtime seen and files still to be recorded
+        self._listed: Dict[str, Tuple[int, Set[str]]] = {}
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.partitions
+
+    def _entry(self, key: str) -> Dict:
+        return self.partitions.setdefault(key, {'mtime_ns': None, 'files': {}})
+
+    def bootstrap(self, before: date):
+        """
+        Mark every partition dated before `before` as consumed without reading it.
+
+        Used once when upgrading an existing datalake: earlier runs already processed
+        everything up to the processed-trades watermark.
+        """
+        for directory in partition_dirs(self.raw_root, 3):
+            key = os.path.relpath(directory, self.raw_root)
+            if _partition_date(key) < before:
+                self.partitions[key] = {
+                    'mtime_ns': os.stat(directory).st_mtime_ns,
+                    'files': {os.path.basename(f): {'rows': None, 'max_ts': None} for f in parquet_files(directory)},
+                }
+        self.save()
+
+    def pending_files(self) -> List[Tuple[str, str]]:
+        """(partition key, file path) of every raw file not consumed yet, oldest partition first."""
+        pending = []
+        if not os.path.isdir(self.raw_root):
+            return pending
+        for directory in partition_dirs(self.raw_root, 3):
+            key = os.path.relpath(directory, self.raw_root)
+            mtime = os.stat(directory).st_mtime_ns
+            entry = self.partitions.get(key)
+            if entry and entry['mtime_ns'] == mtime:
+                continue
+            consumed = entry['files'] if entry else {}
+            new_files = [f for f in parquet_files(directory) if os.path.basename(f) not in consumed]
+            if new_files:
+                self._listed[key] = (mtime, {os.path.basename(f) for f in new_files})
+                pending.extend((key, f) for f in new_files)
+            elif entry:
+                # Files were only rewritten in place (e.g. by the schema migration)
+                entry['mtime_ns'] = mtime
+        return pending
+
+    def record(self, files: List[Tuple[str, str]]):
+        """
+        Mark files as consumed, with stats from their footers. A partition's mtime is
+        stored only once all of its pending files are recorded, so files skipped after
+        an error are listed again on the next run.
+        """
+        for key, path in files:
+            rows, max_ts = raw_file_stats(path)
+            name = os.path.basename(path)
+            self._entry(key)['files'][name] = {'rows': rows, 'max_ts': max_ts}
+            if key in self._listed:
+                mtime, remaining = self._listed[key]
+                remaining.discard(name)
+                if not remaining:
+                    self._entry(key)['mtime_ns'] = mtime
+                    del self._listed[key]
+
+    def is_consumed(self, key: str, filenames: List[str]) -> bool:
+        """True if every file in `filenames` has been consumed from partition `key`."""
+        consumed = self.partitions.get(key, {}).get('files', {})
+        return all(name in consumed for name in filenames)
+
+    def replace_files(self, key: str, new_files: List[str], mtime_ns: int):
+        """Swap a consumed partition's file list after it was rewritten (e.g. compacted)."""
+        self.partitions[key] = {
+            'mtime_ns': mtime_ns,
+            'files': {os.path.basename(f): dict(zip(('rows', 'max_ts'), raw_file_stats(f))) for f in new_files},
+        }
+
+    def save(self):
+        save_json_state(self.path, {'raw_root': self.raw_root, 'partitions': self.partitions})
@@ -0,0 +1,142 @@
+import os
+from typing import Dict, List
+
+import polars as pl
+
+from poly_utils.utils import load_json_state, save_json_state
+
+# Materialized markets snapshot, kept inside the markets dataset root
+SNAPSHOT_DIR = '_snapshot'
+SNAPSHOT_MARKETS = 'markets.arrow'
+SNAPSHOT_TOKENS = 'tokens.arrow'
+SNAPSHOT_STATE = 'state.json'
+
+# Markets found by poly_utils.resolver for tokens update_markets had not seen yet
+RESOLVED_DIR = '_resolved'
+
+
+def market_tokens(markets_df: pl.DataFrame) -> pl.DataFrame:
+    """token_id -> (market_id, side) for the token1/token2 of every market."""
+    return (
+        markets_df
+        .select([pl.col('id').cast(pl.Utf8).alias('market_id'), 'token1', 'token2'])
+        .unpivot(index='market_id', on=['token1', 'token2'], variable_name='side', value_name='token_id')
+        .filter(pl.col('token_id').is_not_null() & (pl.col('token_id') != ''))
+        .unique(subset='token_id', keep='first', maintain_order=True)
+        .select(['token_id', 'market_id', 'side'])
+    )
+
+
+def _source_files(main_dir: str, missing_file: str) -> List[str]:
+    files = []
+    if os.path.isdir(main_dir):
+        for root, dirs, names in os.walk(main_dir):
+            dirs[:] = sorted(d for d in dirs if not d.startswith(('.', '_')))
+            files.extend(os.path.join(root, f) for f in names if f.endswith('.parquet') and not f.startswith(('.', '_')))
+    files.sort()
+    resolved_dir = os.path.join(main_dir, RESOLVED_DIR)
+    if os.path.isdir(resolved_dir):
+        files.extend(sorted(
+            os.path.join(resolved_dir, f) for f in os.listdir(resolved_dir)
+            if f.endswith('.parquet') and not f.startswith('.')
+        ))
+    if os.path.exists(missing_file):
+        files.append(missing_file)
+    return files
+
+
+def _fingerprints(files: List[str]) -> Dict[str, List[int]]:
+    fingerprints = {}
+    for path in files:
+        st = os.stat(path)
+        fingerprints[path] = [st.st_size, st.st_mtime_ns]
+    return fingerprints
+
+
+def _read_markets(files: List[str], missing_file: str) -> pl.DataFrame:
+    """Load, combine, dedup by id (first occurrence wins) and sort by createdAt."""
+    dfs = []
+    main_files = [f for f in files if f != missing_file]
+    if main_files:
+        main_df = pl.concat([pl.scan_parquet(f) for f in main_files], how='diagonal_relaxed').collect()
+        dfs.append(main_df)
+        print(f"Loaded {len(main_df)} markets from {len(main_files)} files")
+    if missing_file in files:
+        missing_df = pl.read_parquet(missing_file)
+        dfs.append(missing_df)
+        print(f"Loaded {len(missing_df)} markets from {missing_file}")
+    if not dfs:
+        return pl.DataFrame()
+    return pl.concat(dfs, how='diagonal_relaxed').unique(subset=['id'], keep='first').sort('createdAt')
+
+
+def _write_ipc(df: pl.DataFrame, path: str):
+    tmp_path = f"{path}.tmp"
+    # Uncompressed so readers can memory-map the columns without decoding
+    df.write_ipc(tmp_path, compression='uncompressed')
+    os.replace(tmp_path, path)
+
+
+def refresh_markets_snapshot(main_dir: str = "markets_partitioned",
+                             missing_file: str = "missing_markets.parquet") -> str:
+    """
+    Bring the materialized markets snapshot up to date and return its directory.
+
+    The snapshot stores the combined markets table and its token -> (market_id, side)
+    lookup as uncompressed Arrow IPC files, plus the size and mtime of every source file
+    it was built from. If no source changed, nothing is read. If the only change is new
+    files (e.g. update_markets appended a partition), only those are read and merged;
+    any other change rebuilds the snapshot from scratch.
+    """
+    snapshot_dir = os.path.join(main_dir, SNAPSHOT_DIR)
+    state_path = os.path.join(snapshot_dir, SNAPSHOT_STATE)
+    markets_path = os.path.join(snapshot_dir, SNAPSHOT_MARKETS)
+
+    files = _source_files(main_dir, missing_file)
+    current = _fingerprints(files)
+    previous = load_json_state(state_path, default={}).get('files')
+    have_snapshot = previous is not None and os.path.exists(markets_path)
+
+    if have_snapshot and previous == current:
+        return snapshot_dir
+
+    new_files = [f for f in files if f not in (previous or {})]
+    incremental = have_snapshot and all(current.get(f) == fp for f, fp in previous.items())
+    if incremental:
+        print(f"Markets snapshot: merging {len(new_files)} new files")
+        new_df = _read_markets(new_files, missing_file)
+        markets_df = pl.read_ipc(markets_path, memory_map=False)
+        if not new_df.is_empty():
+            markets_df = (
+                pl.concat([markets_df, new_df], how='diagonal_relaxed')
+                .unique(subset=['id'], keep='first')
+                .sort('createdAt')
+            )
+    else:
+        print(f"Markets snapshot: rebuilding from {len(files)} files")
+        markets_df = _read_markets(files, missing_file)
+
+    os.makedirs(snapshot_dir, exist_ok=True)
+    _write_ipc(markets_df, markets_path)
+    tokens_df = market_tokens(markets_df) if not markets_df.is_empty() else pl.DataFrame(
+        schema={'token_id': pl.Utf8, 'market_id': pl.Utf8, 'side': pl.Utf8})
+    _write_ipc(tokens_df, os.path.join(snapshot_dir, SNAPSHOT_TOKENS))
+    # State last: a crash before this point just triggers another refresh
+    save_json_state(state_path, {'files': current, 'markets': markets_df.height})
+    return snapshot_dir
+
+
+def scan_markets(main_dir: str = "markets_partitioned", missing_file: str = "missing_markets.parquet") -> pl.LazyFrame:
+    """
+    Lazy, memory-mapped scan of the markets snapshot (refreshed first if stale), so
+    selecting a few columns only touches those columns.
+    """
+    snapshot_dir = refresh_markets_snapshot(main_dir, missing_file)
+    return pl.scan_ipc(os.path.join(snapshot_dir, SNAPSHOT_MARKETS), memory_map=True)
+
+
+def load_market_tokens(main_dir: str = "markets_partitioned",
+                       missing_file: str = "missing_markets.parquet") -> pl.DataFrame:
+    """Memory-mapped token_id -> (market_id, side) lookup from the markets snapshot."""
+    snapshot_dir = refresh_markets_snapshot(main_dir, missing_file)
+    return pl.read_ipc(os.path.join(snapshot_dir, SNAPSHOT_TOKENS), memory_map=True)
@@ -0,0 +1,255 @@
+import bisect
+import cProfile
+import io
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse
+
+METRICS_DIR = 'metrics'
+METRICS_LOG = 'metrics.jsonl'
+PROMETHEUS_FILE = 'poly_data.prom'
+PROMETHEUS_PREFIX = 'poly_'
+
+# Upper bounds (seconds) of the HTTP latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# How often a running stage samples the resident set size
+RSS_SAMPLE_SECONDS = 0.05
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes (the lifetime peak where /proc is missing)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class RssSampler:
+    """Background thread tracking the peak RSS between start() and stop()."""
+
+    def __init__(self):
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(RSS_SAMPLE_SECONDS):
+            self.peak = max(self.peak, current_rss())
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self) -> int:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak
+
+
+def _labels_key(labels: Dict) -> Tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: Tuple, extra: Dict = None) -> str:
+    items = list(key) + sorted((extra or {}).items())
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+
+class Metrics:
+    """
+    Process-wide counters, latency histograms and timed stages.
+
+    Code reports what it did with count() and observe(); work is wrapped in stage()
+    (a context manager that also works as a function decorator), which times it and
+    samples its peak RSS. When a stage ends it appends one JSON line (duration, peak
+    RSS and the counters and histograms that moved during the stage) to
+    `<directory>/metrics.jsonl` and rewrites a Prometheus textfile with the totals,
+    for node_exporter's textfile collector.
+
+    With profiling enabled (profile()), stages also record the Polars query plans
+    passed to record_plan(), and the profiled code's cProfile stats are written out.
+
+    Args:
+        directory: Where the JSON lines, the Prometheus textfile and profiles go.
+    """
+
+    def __init__(self, directory: str = METRICS_DIR):
+        self.directory = directory
+        self.counters: Dict[Tuple[str, Tuple], float] = {}
+        self.histograms: Dict[Tuple[str, Tuple], List] = {}
+        self.gauges: Dict[Tuple[str, Tuple], float] = {}
+        self.profiling = False
+        self._lock = threading.Lock()
+
+    def count(self, name: str, value: float = 1, **labels):
+        """Add `value` to a counter."""
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """Record one observation (e.g. a request latency in seconds) in a histogram."""
+        key = (name, _labels_key(labels))
+        with self._lock:
+            # [per-bucket counts (last one is +Inf), sum, count]
+            hist = self.histograms.setdefault(key, [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0])
+            hist[0][bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self.gauges[(name, _labels_key(labels))] = value
+
+    def files_written(self, dataset: str, paths: List[str]):
+        """Count files and bytes a writer committed for `dataset`."""
+        self.count('files_written', len(paths), dataset=dataset)
+        self.count('bytes_written', sum(os.path.getsize(p) for p in paths if os.path.exists(p)), dataset=dataset)
+
+    def _snapshot(self):
+        with self._lock:
+            return dict(self.counters), {k: (v[1], v[2]) for k, v in self.histograms.items()}
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a pipeline stage and log what it did when it ends (also when it fails)."""
+        counters_before, histograms_before = self._snapshot()
+        sampler = RssSampler().start()
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            yield self
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            peak_rss = sampler.stop()
+            counters_after, histograms_after = self._snapshot()
+
+            counters = {}
+            for (metric, labels), value in counters_after.items():
+                delta = value - counters_before.get((metric, labels), 0)
+                if delta:
+                    counters[metric + _format_labels(labels)] = delta
+            histograms = {}
+            for (metric, labels), (total, n) in histograms_after.items():
+                total_before, n_before = histograms_before.get((metric, labels), (0.0, 0))
+                if n > n_before:
+                    histograms[metric + _format_labels(labels)] = {
+                        'count': n - n_before, 'mean': (total - total_before) / (n - n_before)}
+
+            self.set_gauge('stage_seconds', seconds, stage=name)
+            self.set_gauge('stage_peak_rss_bytes', peak_rss, stage=name)
+            self.set_gauge('stage_last_run_timestamp_seconds', time.time(), stage=name)
+            self.count('stage_runs', 1, stage=name, status=status)
+            self.emit({
+                'stage': name,
+                'status': status,
+                'seconds': round(seconds, 3),
+                'peak_rss_mb': round(peak_rss / 2**20, 1),
+                'counters': counters,
+                'histograms': histograms,
+            })
+            self.write_prometheus()
+
+    def emit(self, record: Dict):
+        """Append one compact JSON line to the metrics log."""
+        record = {'ts': datetime.now(timezone.utc).isoformat(timespec='seconds'), **record}
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, METRICS_LOG), 'a') as f:
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def prometheus_text(self) -> str:
+        lines = []
+        typed = set()
+
+        def declare(metric, kind):
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} {kind}")
+
+        with self._lock:
+            for (metric, labels), value in sorted(self.counters.items()):
+                declare(f"{PROMETHEUS_PREFIX}{metric}_total", 'counter')
+                lines.append(f"{PROMETHEUS_PREFIX}{metric}_total{_format_labels(labels)} {value}")
+            for (metric, labels), value in sorted(self.gauges.items()):
+                declare(f"{PROMETHEUS_PREFIX}{metric}", 'gauge')
+                lines.append(f"{PROMETHEUS_PREFIX}{metric}{_format_labels(labels)} {value}")
+            for (metric, labels), (buckets, total, n) in sorted(self.histograms.items()):
+                declare(f"{PROMETHEUS_PREFIX}{metric}", 'histogram')
+                cumulative = 0
+                for bound, bucket_count in zip(LATENCY_BUCKETS + ['+Inf'], buckets):
+                    cumulative += bucket_count
+                    lines.append(f"{PROMETHEUS_PREFIX}{metric}_bucket{_format_labels(labels, {'le': bound})} {cumulative}")
+                lines.append(f"{PROMETHEUS_PREFIX}{metric}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{PROMETHEUS_PREFIX}{metric}_count{_format_labels(labels)} {n}")
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self):
+        """Atomically rewrite the Prometheus textfile with the current totals."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, PROMETHEUS_FILE)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+    def record_plan(self, name: str, lf):
+        """Save the optimized query plan of a LazyFrame while profiling; a no-op otherwise."""
+        if not self.profiling:
+            return
+        plans_dir = os.path.join(self.directory, 'plans')
+        os.makedirs(plans_dir, exist_ok=True)
+        with open(os.path.join(plans_dir, f"{name}.txt"), 'w') as f:
+            f.write(lf.explain(optimized=True))
+
+    @contextmanager
+    def profile(self, name: str):
+        """
+        Run the body under cProfile, writing `<name>.prof` (for snakeviz/pstats) and the
+        top functions by cumulative time to `<name>.profile.txt`. Query plans passed
+        to record_plan() meanwhile are saved under `plans/`.
+        """
+        profiler = cProfile.Profile()
+        self.profiling = True
+        profiler.enable()
+        try:
+            yield self
+        finally:
+            profiler.disable()
+            self.profiling = False
+            os.makedirs(self.directory, exist_ok=True)
+            profiler.dump_stats(os.path.join(self.directory, f"{name}.prof"))
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(40)
+            with open(os.path.join(self.directory, f"{name}.profile.txt"), 'w') as f:
+                f.write(out.getvalue())
+            print(f"Profile written to {os.path.join(self.directory, name)}.prof")
+
+
+METRICS = Metrics()
+
+
+def record_response(response, *args, **kwargs):
+    """requests response hook: HTTP latency per host and status code counts."""
+    host = urlparse(response.url).hostname or ''
+    METRICS.observe('http_request_seconds', response.elapsed.total_seconds(), host=host)
+    METRICS.count('http_responses', 1, host=host, status=response.status_code)
@@ -0,0 +1,198 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import polars as pl
+import pyarrow.parquet as pq
+
+from poly_utils.catalog import CATALOG_FILE, Catalog
+from poly_utils.dictionary import (
+    TOKEN_DICTIONARY_DIR, WALLET_DICTIONARY_DIR, TokenDictionary, WalletDictionary, encode_raw, encode_wallets,
+)
+from poly_utils.schema import (
+    PROCESSED_SCHEMA_VERSION, RAW_SCHEMA_VERSION, SCHEMA_MARKER, encode_compact, mark_canonical, read_schema_version,
+    schema_metadata,
+)
+
+
+def _list_parquet(root: str):
+    return sorted(
+        os.path.join(dirpath, f)
+        for dirpath, dirnames, filenames in os.walk(root)
+        for f in filenames
+        if f.endswith('.parquet') and not f.startswith(('.', '_'))
+    )
+
+
+# Dictionaries loaded once per worker process, by root
+_worker_dictionaries = {}
+
+
+def _worker_dictionary(cls, root: str):
+    if root not in _worker_dictionaries:
+        _worker_dictionaries[root] = cls(root)
+    return _worker_dictionaries[root]
+
+
+def _replace_file(path: str, frame: pl.DataFrame, version: int, row_group_size: int = None):
+    table = frame.to_arrow().replace_schema_metadata(schema_metadata(version))
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f".{name}.tmp")
+    pq.write_table(table, tmp_path, compression='zstd', row_group_size=row_group_size)
+    os.replace(tmp_path, path)
+
+
+def raw_file_tokens(path: str):
+    """Distinct asset IDs of a raw file that still needs migrating, or None if it is current."""
+    if read_schema_version(path) == RAW_SCHEMA_VERSION:
+        return None
+    df = pl.read_parquet(path, columns=['makerAssetId', 'takerAssetId'], hive_partitioning=False)
+    return pl.concat([df['makerAssetId'].cast(pl.Utf8), df['takerAssetId'].cast(pl.Utf8)]).unique().to_list()
+
+
+def migrate_raw_file(path: str, dictionary_root: str = TOKEN_DICTIONARY_DIR) -> str:
+    """
+    Rewrite one raw file in the canonical schema, in place and atomically.
+
+    The file's asset IDs must already be in the token dictionary at `dictionary_root`.
+    Returns 'skipped' if the file is already at RAW_SCHEMA_VERSION, else 'migrated'.
+    """
+    if read_schema_version(path) == RAW_SCHEMA_VERSION:
+        return 'skipped'
+
+    dictionary = _worker_dictionary(TokenDictionary, dictionary_root)
+    frame = encode_raw(pl.read_parquet(path, hive_partitioning=False), dictionary, assign=False)
+    _replace_file(path, frame, RAW_SCHEMA_VERSION)
+    return 'migrated'
+
+
+def processed_file_wallets(path: str):
+    """Distinct maker/taker addresses of a processed file that still needs migrating, or None."""
+    if read_schema_version(path) == PROCESSED_SCHEMA_VERSION or 'maker' not in pq.read_schema(path).names:
+        return None
+    df = pl.read_parquet(path, columns=['maker', 'taker'], hive_partitioning=False)
+    return pl.concat([df['maker'], df['taker']]).unique().to_list()
+
+
+def migrate_processed_file(path: str, wallets_root: str = WALLET_DICTIONARY_DIR) -> str:
+    """
+    Rewrite one processed/trades file in the current schema: wallet ids and binary
+    transaction hashes (v2), typed columns and integer amounts (v3).
+
+    A v1 file's addresses must already be in the wallet dictionary at `wallets_root`.
+    Rows and row groups keep their layout, so market indexes of clustered partitions
+    stay valid. Returns 'skipped' if the file is already at PROCESSED_SCHEMA_VERSION,
+    else 'migrated'.
+    """
+    if read_schema_version(path) == PROCESSED_SCHEMA_VERSION:
+        return 'skipped'
+
+    metadata = pq.ParquetFile(path).metadata
+    row_group_size = max((metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)), default=0) or None
+    frame = pl.read_parquet(path, hive_partitioning=False)
+    if 'maker' in frame.columns:
+        frame = encode_wallets(frame, _worker_dictionary(WalletDictionary, wallets_root), assign=False)
+    _replace_file(path, encode_compact(frame), PROCESSED_SCHEMA_VERSION, row_group_size)
+    return 'migrated'
+
+
+def _migrate_dataset(root: str, version: int, dictionary, collect_keys, migrate_file, workers: int = None):
+    """
+    Two passes over every file of a dataset in worker processes: collect the keys the
+    new schema needs from outdated files and add them to `dictionary` here, in one
+    process, then rewrite the files. Each file is replaced atomically and carries its
+    schema version in the parquet footer, so an interrupted run resumes by skipping
+    migrated files. Once every file is current the `_schema.json` marker is written.
+    """
+    files = _list_parquet(root)
+    print(f"Migrating {len(files)} files under {root} to schema v{version}")
+
+    catalog = Catalog(root) if os.path.exists(os.path.join(root, CATALOG_FILE)) else None
+
+    counts = {'migrated': 0, 'skipped': 0, 'failed': 0}
+    # Spawned workers: forking a process that already started polars' thread pool can deadlock
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        key_futures = {executor.submit(collect_keys, f): f for f in files}
+        for future in as_completed(key_futures):
+            try:
+                keys = future.result()
+            except Exception as e:
+                # The rewrite below fails for the same file and is counted there
+                print(f"Could not read {key_futures[future]}: {e}")
+                continue
+            if keys:
+                dictionary.add(keys)
+        dictionary.save()
+        print(f"Dictionary {dictionary.root}: {len(dictionary):,} entries")
+
+        futures = {executor.submit(migrate_file, f, dictionary.root): f for f in files}
+        for i, future in enumerate(as_completed(futures), 1):
+            try:
+                result = future.result()
+                counts[result] += 1
+                if result == 'migrated' and catalog is not None:
+                    catalog.add_file(futures[future])
+            except Exception as e:
+                counts['failed'] += 1
+                print(f"Failed to migrate {futures[future]}: {e}")
+            if i % 1000 == 0:
+                print(f"  {i}/{len(files)} files: {counts}")
+
+    print(f"Migration finished: {counts}")
+    if counts['failed'] == 0:
+        mark_canonical(root, version)
+        print(f"All files canonical; wrote {SCHEMA_MARKER}")
+    return counts
+
+
+def migrate_raw_dataset(root: str = 'goldsky/orderFilled', workers: int = None,
+                        dictionary_root: str = TOKEN_DICTIONARY_DIR):
+    """
+    Migrate every goldsky/orderFilled file to the canonical raw schema.
+
+    The asset IDs of all outdated files are first added to the token dictionary, then
+    files are rewritten in parallel. An interrupted run can simply be restarted. Once
+    every file is canonical, readers switch to a single lazy scan.
+
+    Args:
+        root: Raw dataset root.
+        workers: Number of worker processes (default: CPU count).
+        dictionary_root: Token dictionary the asset indices are taken from.
+    """
+    return _migrate_dataset(root, RAW_SCHEMA_VERSION, TokenDictionary(dictionary_root),
+                            raw_file_tokens, migrate_raw_file, workers)
+
+
+def migrate_processed_dataset(root: str = 'processed/trades', workers: int = None,
+                              wallets_root: str = WALLET_DICTIONARY_DIR):
+    """
+    Migrate processed/trades to the compact schema: maker/taker become wallet ids from
+    the wallet dictionary, transaction hashes become 32-byte binary, amounts become
+    exact integer micro-units and the remaining columns get their integer/Enum types.
+
+    Once every file is migrated, process_live writes new trades in the same schema.
+    The wallet index stores the same columns and has to be rebuilt afterwards
+    (`python -m update_utils.update_wallet_index --rebuild`).
+
+    Args:
+        root: Processed trades root.
+        workers: Number of worker processes (default: CPU count).
+        wallets_root: Wallet dictionary the ids are taken from.
+    """
+    return _migrate_dataset(root, PROCESSED_SCHEMA_VERSION, WalletDictionary(wallets_root),
+                            processed_file_wallets, migrate_processed_file, workers)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Migrate datalake files to the current canonical schema")
+    parser.add_argument('dataset', choices=['raw', 'processed'], help="Dataset to migrate")
+    parser.add_argument('--root', default=None, help="Dataset root (default: goldsky/orderFilled or processed/trades)")
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.dataset == 'raw':
+        migrate_raw_dataset(args.root or 'goldsky/orderFilled', workers=args.workers)
+    else:
+        migrate_processed_dataset(args.root or 'processed/trades', workers=args.workers)
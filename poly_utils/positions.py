@@ -0,0 +1,256 @@
+import os
+import shutil
+from datetime import datetime
+from typing import List
+
+import polars as pl
+import pyarrow.parquet as pq
+
+from poly_utils.bars import MAX_DELTA_FILES, merge_partition
+from poly_utils.dictionary import WalletDictionary
+from poly_utils.schema import decode_compact
+from poly_utils.utils import PLATFORM_WALLETS, load_json_state, parquet_files, partition_dirs, save_json_state
+from poly_utils.writer import PartitionWriter
+
+POSITIONS_ROOT = 'processed/positions'
+POSITIONS_STATE = '_state.json'
+
+POSITION_KEYS = ['wallet_id', 'market_id', 'nonusdc_side']
+
+# Positions are bucketed by wallet id so a wallet's rows live in one small partition
+POSITION_BUCKETS = 32
+
+# Position deltas buffered in memory before they are merged down; a merged buffer
+# larger than half of this is spilled to the staging directory
+MERGE_EVERY_ROWS = 2_000_000
+
+
+def trade_legs(trades):
+    """
+    Split processed trades (with maker_id/taker_id) into one leg per participant:
+    wallet, market, side, direction, amounts and timestamp. v3 trades are decoded to
+    Float64 amounts and string market ids and sides first (see decode_compact).
+    """
+    trades = decode_compact(trades)
+    common = ['market_id', 'nonusdc_side', 'token_amount', 'usd_amount', 'timestamp']
+    return pl.concat([
+        trades.select([pl.col('maker_id').alias('wallet_id'), pl.col('maker_direction').alias('direction'), *common]),
+        trades.select([pl.col('taker_id').alias('wallet_id'), pl.col('taker_direction').alias('direction'), *common]),
+    ]).filter(pl.col('market_id').is_not_null() & pl.col('wallet_id').is_not_null())
+
+
+def position_deltas(legs, exclude_wallets: List[int] = ()):
+    """
+    Aggregate trade legs into position deltas per wallet, market and side.
+
+    Buys add tokens and spend USDC, sells remove tokens and receive USDC. Every column
+    is a sum, count or max, so deltas from any number of batches (in any order,
+    including late data) combine exactly with merge_positions().
+    """
+    is_buy = pl.col('direction') == 'BUY'
+    return (
+        legs
+        .filter(~pl.col('wallet_id').is_in(list(exclude_wallets)))
+        .group_by(POSITION_KEYS)
+        .agg([
+            pl.when(is_buy).then(pl.col('token_amount')).otherwise(-pl.col('token_amount')).sum().alias('position'),
+            pl.when(is_buy).then(pl.col('token_amount')).otherwise(0.0).sum().alias('bought_tokens'),
+            pl.when(is_buy).then(pl.col('usd_amount')).otherwise(0.0).sum().alias('bought_usd'),
+            pl.when(is_buy).then(0.0).otherwise(pl.col('token_amount')).sum().alias('sold_tokens'),
+            pl.when(is_buy).then(0.0).otherwise(pl.col('usd_amount')).sum().alias('sold_usd'),
+            pl.len().cast(pl.Int64).alias('trades'),
+            pl.col('timestamp').max().alias('last_trade_ts'),
+        ])
+    )
+
+
+def merge_positions(positions):
+    """Combine position deltas of the same wallet, market and side into one row each."""
+    return (
+        positions
+        .group_by(POSITION_KEYS)
+        .agg([
+            pl.col('position').sum(),
+            pl.col('bought_tokens').sum(),
+            pl.col('bought_usd').sum(),
+            pl.col('sold_tokens').sum(),
+            pl.col('sold_usd').sum(),
+            pl.col('trades').sum(),
+            pl.col('last_trade_ts').max(),
+        ])
+    )
+
+
+def with_position_metrics(positions):
+    """
+    Add the derived columns of merged positions.
+
+    `avg_cost` is the average price paid over all buys, `cost_basis` the open position
+    valued at that price, `cash_flow` the net USDC received (sells minus buys) and
+    `realized_pnl` the sell proceeds minus the average cost of the tokens sold.
+    Positions can be negative when tokens came from outside the order book (splits).
+    """
+    avg_cost = pl.when(pl.col('bought_tokens') > 0).then(pl.col('bought_usd') / pl.col('bought_tokens'))
+    return (
+        positions
+        .with_columns(avg_cost.alias('avg_cost'))
+        .with_columns([
+            (pl.col('position').clip(lower_bound=0) * pl.col('avg_cost').fill_null(0.0)).alias('cost_basis'),
+            (pl.col('sold_usd') - pl.col('bought_usd')).alias('cash_flow'),
+            (pl.col('sold_usd') - pl.col('sold_tokens') * pl.col('avg_cost').fill_null(0.0)).alias('realized_pnl'),
+        ])
+    )
+
+
+def positions_initialized(root: str = POSITIONS_ROOT) -> bool:
+    """True once the positions cover the whole processed history (see update_positions)."""
+    return load_json_state(os.path.join(root, POSITIONS_STATE), default={}).get('initialized', False)
+
+
+def mark_positions_initialized(root: str = POSITIONS_ROOT, through=None):
+    save_json_state(os.path.join(root, POSITIONS_STATE), {
+        'initialized': True,
+        'through': str(through) if through is not None else None,
+        'updated_at': datetime.now().isoformat(),
+    })
+
+
+def mark_positions_stale(root: str = POSITIONS_ROOT, reason: str = None):
+    """
+    Flag the positions as missing trades: updates skip them until they are rebuilt
+    (`python -m update_utils.update_positions --rebuild`).
+    """
+    save_json_state(os.path.join(root, POSITIONS_STATE), {
+        'initialized': False,
+        'stale_reason': reason,
+        'updated_at': datetime.now().isoformat(),
+    })
+    print(f"⚠️  Positions marked for rebuild ({reason}); run `python -m update_utils.update_positions --rebuild`")
+
+
+def _platform_ids(wallets: WalletDictionary) -> List[int]:
+    return [i for i in (wallets.lookup(a) for a in PLATFORM_WALLETS) if i is not None]
+
+
+class PositionWriter:
+    """
+    Incrementally maintained positions per (wallet, market, side) under `root`,
+    bucketed by wallet id into `bucket=NN` partitions.
+
+    Each batch of processed trades passed to write() is split into maker and taker
+    legs, the platform's own wallets (PLATFORM_WALLETS) are dropped, and the legs are
+    aggregated into additive deltas: net tokens, tokens and USDC bought and sold, trade
+    count and last trade time. Deltas are buffered in memory and spilled to a staging
+    directory next to `root` when the buffer fills up; close() publishes them as one
+    file per bucket, after the trades they come from are committed, and buckets with
+    more than MAX_DELTA_FILES deltas are merged into one file. A run that never
+    reaches close() leaves nothing in `root`, so its trades are not counted twice when
+    they are processed again. Readers always merge with merge_positions() (see
+    load_positions), so the store answers with exact totals after every run.
+
+    Batches may carry maker/taker addresses (new addresses are added to `wallets`) or
+    wallet ids (processed schema v2).
+
+    Args:
+        root: Root of the positions dataset.
+        wallets: Wallet dictionary shared with the trades writer (one is opened if omitted).
+    """
+
+    def __init__(self, root: str = POSITIONS_ROOT, wallets: WalletDictionary = None):
+        self.root = root
+        self.wallets = wallets if wallets is not None else WalletDictionary()
+        self._partials: List[pl.DataFrame] = []
+        self._rows = 0
+        self.rows_written = 0
+        # Deltas of uncommitted trades; whatever a crashed run left here is dropped
+        self.staging_dir = f"{os.path.realpath(root)}.pending"
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+    def write(self, trades: pl.DataFrame):
+        """Fold a batch of processed trades into the positions."""
+        if trades.is_empty():
+            return
+        if 'maker_id' not in trades.columns:
+            addresses = pl.concat([trades['maker'], trades['taker']])
+            if self.wallets.add(addresses):
+                self.wallets.save()
+            trades = trades.with_columns([
+                self.wallets.encode('maker', addresses).alias('maker_id'),
+                self.wallets.encode('taker', addresses).alias('taker_id'),
+            ])
+        deltas = position_deltas(trade_legs(trades), _platform_ids(self.wallets))
+        self._partials.append(deltas)
+        self._rows += deltas.height
+        if self._rows > MERGE_EVERY_ROWS:
+            merged = merge_positions(pl.concat(self._partials))
+            self._partials = [merged]
+            self._rows = merged.height
+            if merged.height > MERGE_EVERY_ROWS // 2:
+                self.spill()
+
+    def spill(self):
+        """Move the buffered deltas to the staging directory, one file per bucket."""
+        if not self._partials:
+            return
+        positions = merge_positions(pl.concat(self._partials)).sort(POSITION_KEYS)
+        self._partials = []
+        self._rows = 0
+
+        writer = PartitionWriter(self.staging_dir, ['bucket'], prefix='positions',
+                                 target_rows=10_000_000, target_bytes=1024 * 2**20, memory_budget=2048 * 2**20)
+        writer.write(positions.with_columns((pl.col('wallet_id') % POSITION_BUCKETS).cast(pl.Int32).alias('bucket')))
+        writer.close()
+
+    def close(self):
+        """Publish the staged and buffered deltas and merge crowded buckets."""
+        self.spill()
+        if not os.path.isdir(self.staging_dir):
+            return
+        touched = []
+        for staged in partition_dirs(self.staging_dir, 1):
+            directory = os.path.join(self.root, os.path.basename(staged))
+            os.makedirs(directory, exist_ok=True)
+            for path in parquet_files(staged):
+                self.rows_written += pq.read_metadata(path).num_rows
+                os.replace(path, os.path.join(directory, os.path.basename(path)))
+            touched.append(directory)
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+        crowded = [d for d in sorted(touched) if len(parquet_files(d)) > MAX_DELTA_FILES]
+        if crowded:
+            staging_dir = f"{os.path.realpath(self.root)}.merge"
+            os.makedirs(staging_dir, exist_ok=True)
+            for directory in crowded:
+                merge_partition(os.path.realpath(directory), staging_dir, merge=merge_positions,
+                                keys=POSITION_KEYS, prefix='positions')
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def mark_stale(self, reason: str = None):
+        mark_positions_stale(self.root, reason)
+
+
+def load_positions(wallet=None, market_id=None, root: str = POSITIONS_ROOT,
+                   wallets: WalletDictionary = None) -> pl.DataFrame:
+    """
+    Current positions, optionally for one wallet address (or list of addresses) and/or
+    one market (or list of markets), with the metrics of with_position_metrics() and
+    the wallet address. A wallet query only reads that wallet's bucket.
+    """
+    if not os.path.isdir(root) or not any(d.startswith('bucket=') for d in os.listdir(root)):
+        return pl.DataFrame()
+    wallets = wallets or WalletDictionary()
+    lf = pl.scan_parquet(os.path.join(root, 'bucket=*', '*.parquet'), hive_partitioning=True)
+    if wallet is not None:
+        addresses = [wallet] if isinstance(wallet, str) else list(wallet)
+        ids = [i for i in (wallets.lookup(a) for a in addresses) if i is not None]
+        buckets = sorted({i % POSITION_BUCKETS for i in ids})
+        lf = lf.filter(pl.col('bucket').is_in(buckets) & pl.col('wallet_id').is_in(ids))
+    if market_id is not None:
+        markets = [market_id] if isinstance(market_id, str) else list(market_id)
+        lf = lf.filter(pl.col('market_id').is_in(markets))
+    positions = merge_positions(lf.drop('bucket').collect())
+    return (
+        with_position_metrics(positions)
+        .with_columns(wallets.decode('wallet_id').alias('address'))
+        .sort(POSITION_KEYS)
+    )
@@ -0,0 +1,160 @@
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set, Tuple
+
+import polars as pl
+
+from poly_utils.http import RateLimiter, backoff_delay, make_session
+from poly_utils.markets import RESOLVED_DIR
+from poly_utils.utils import load_json_state, save_json_state
+
+GAMMA_MARKETS_URL = 'https://gamma-api.polymarket.com/markets'
+
+# Tokens the API had no market for are not asked about again for this long
+UNRESOLVED_RETRY_SECONDS = 24 * 3600
+UNRESOLVED_FILE = '_unresolved.json'
+
+
+def _json_list(value) -> List:
+    if isinstance(value, str):
+        return json.loads(value) if value else []
+    return value or []
+
+
+def market_row(market: Dict) -> Dict:
+    """One gamma-api market as a row with the markets_partitioned columns."""
+    outcomes = _json_list(market.get('outcomes'))
+    tokens = _json_list(market.get('clobTokenIds'))
+    events = market.get('events') or []
+    return {
+        'createdAt': market.get('createdAt', ''),
+        'id': str(market.get('id', '')),
+        'question_text': market.get('question') or market.get('title') or '',
+        'answer1': outcomes[0] if len(outcomes) > 0 else None,
+        'answer2': outcomes[1] if len(outcomes) > 1 else None,
+        'neg_risk': bool(market.get('negRiskAugmented') or market.get('negRiskOther')),
+        'slug': market.get('slug', ''),
+        'token1': tokens[0] if len(tokens) > 0 else None,
+        'token2': tokens[1] if len(tokens) > 1 else None,
+        'conditionId': market.get('conditionId', ''),
+        'volume': str(market.get('volume', '')),
+        'ticker': events[0].get('ticker', '') if events else '',
+        'closedTime': market.get('closedTime', ''),
+    }
+
+
+class MarketResolver:
+    """
+    Looks up the markets of unknown CLOB token IDs on gamma-api.
+
+    Tokens are sent `batch_size` at a time as repeated `clob_token_ids` parameters,
+    batches run on `workers` threads over one pooled session, and every request first
+    takes a token from a shared RateLimiter, so 429s are the exception rather than the
+    pacing mechanism. Failed requests are retried with jittered backoff.
+
+    Resolved markets are appended as a new file in `markets_partitioned/_resolved/`,
+    which the markets snapshot merges incrementally. Tokens the API returns nothing for
+    are remembered in `_unresolved.json` and skipped for UNRESOLVED_RETRY_SECONDS;
+    tokens of requests that kept failing are not, so the next call tries them again.
+
+    Args:
+        main_dir: Markets dataset root.
+        url: gamma-api markets endpoint.
+        batch_size: Token IDs per request.
+        workers: Concurrent requests.
+        max_rps: Requests per second across all workers.
+        max_retries: Attempts per batch.
+    """
+
+    def __init__(self, main_dir: str = 'markets_partitioned', url: str = GAMMA_MARKETS_URL,
+                 batch_size: int = 20, workers: int = 8, max_rps: float = 10.0, max_retries: int = 5):
+        self.main_dir = main_dir
+        self.url = url
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_retries = max_retries
+        self.limiter = RateLimiter(max_rps)
+        self.session = make_session(workers)
+        self.resolved_dir = os.path.join(main_dir, RESOLVED_DIR)
+        self.unresolved_path = os.path.join(self.resolved_dir, UNRESOLVED_FILE)
+
+    def fetch_batch(self, token_ids: List[str]) -> List[Dict]:
+        """Markets (raw API dicts) for up to batch_size token IDs."""
+        for attempt in range(self.max_retries):
+            self.limiter.acquire()
+            try:
+                response = self.session.get(self.url, params={'clob_token_ids': token_ids}, timeout=30)
+                if response.status_code == 200:
+                    return response.json()
+                error = f"HTTP {response.status_code}"
+            except Exception as e:
+                error = str(e)
+            delay = backoff_delay(attempt, base=1.0)
+            print(f"Market lookup error: {error}. Retrying in {delay:.1f}s")
+            time.sleep(delay)
+        raise RuntimeError(f"Market lookup failed after {self.max_retries} attempts")
+
+    def fetch(self, token_ids: List[str]) -> Tuple[List[Dict], Set[str]]:
+        """
+        Markets for many token IDs, fetched in concurrent batches. Failed batches are
+        skipped. Returns the markets and the token IDs the API actually answered for.
+        """
+        batches = [token_ids[i:i + self.batch_size] for i in range(0, len(token_ids), self.batch_size)]
+        markets, queried = [], set()
+
+        def run(batch):
+            try:
+                return self.fetch_batch(batch)
+            except Exception as e:
+                print(f"Skipping {len(batch)} tokens: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for batch, result in zip(batches, executor.map(run, batches)):
+                if result is not None:
+                    markets.extend(result)
+                    queried.update(batch)
+        return markets, queried
+
+    def resolve(self, token_ids: List[str]) -> pl.DataFrame:
+        """
+        Resolve token IDs to markets and append them to the resolved-markets directory.
+
+        Returns the new market rows (markets_partitioned columns), possibly empty.
+        """
+        unresolved = load_json_state(self.unresolved_path, default={})
+        now = time.time()
+        token_ids = sorted({t for t in token_ids if now - unresolved.get(t, 0) > UNRESOLVED_RETRY_SECONDS})
+        if not token_ids:
+            return pl.DataFrame()
+
+        started = time.monotonic()
+        print(f"🔎 Resolving {len(token_ids):,} unknown tokens "
+              f"({self.batch_size} per request, {self.workers} workers)...")
+        rows = {}
+        markets, queried = self.fetch(token_ids)
+        for market in markets:
+            row = market_row(market)
+            if row['id'] and row['token1']:
+                rows[row['id']] = row
+        df = pl.DataFrame(list(rows.values())) if rows else pl.DataFrame()
+
+        # Only tokens the API answered for without a market are unresolved; tokens of
+        # failed requests are retried on the next call
+        found = set(df['token1'].to_list() + df['token2'].to_list()) if rows else set()
+        for token in queried - found:
+            unresolved[token] = now
+        save_json_state(self.unresolved_path, unresolved)
+
+        if rows:
+            name = f"resolved-{int(now)}-{uuid.uuid4().hex[:8]}.parquet"
+            tmp_path = os.path.join(self.resolved_dir, f".{name}.tmp")
+            df.write_parquet(tmp_path)
+            os.replace(tmp_path, os.path.join(self.resolved_dir, name))
+        failed = len(set(token_ids) - queried)
+        print(f"✓ Resolved {len(found & set(token_ids)):,}/{len(token_ids):,} tokens to {len(rows):,} markets "
+              f"in {time.monotonic() - started:.1f}s" + (f" ({failed:,} failed, retried next time)" if failed else ""))
+        return df
@@ -0,0 +1,200 @@
+import os
+from datetime import datetime, timezone
+from typing import List, Optional
+
+import polars as pl
+import pyarrow.parquet as pq
+
+from poly_utils.utils import load_json_state, save_json_state
+
+# Canonical goldsky/orderFilled schema. Bump RAW_SCHEMA_VERSION whenever it changes
+# and teach poly_utils.migrate how to upgrade older files.
+#
+# v2: makerAssetIdx/takerAssetIdx, the poly_utils.dictionary index of each asset ID
+RAW_SCHEMA_VERSION = 2
+RAW_SCHEMA = {
+    'id': pl.Utf8,
+    'timestamp': pl.Int64,
+    'maker': pl.Utf8,
+    'makerAssetId': pl.Utf8,
+    'makerAmountFilled': pl.Int64,
+    'taker': pl.Utf8,
+    'takerAssetId': pl.Utf8,
+    'takerAmountFilled': pl.Int64,
+    'transactionHash': pl.Utf8,
+    'makerAssetIdx': pl.UInt32,
+    'takerAssetIdx': pl.UInt32,
+}
+
+# Columns derived locally rather than fetched from the subgraph
+DERIVED_RAW_COLUMNS = ('makerAssetIdx', 'takerAssetIdx')
+
+# Canonical processed/trades schema. Files written before versioning (v1) store
+# maker/taker as hex address strings and transactionHash as a hex string.
+#
+# v2: maker_id/taker_id from poly_utils.dictionary.WalletDictionary, 32-byte binary transactionHash
+# v3: typed columns. market_id is the integer gamma-api market id, side and directions
+#     are Enums, amounts are exact Int64 micro-units (USDC and outcome tokens both have
+#     6 decimals) with price derived from them on read (trade_price), and timestamps,
+#     whole seconds on chain, are Datetime('ms'), the coarsest unit Polars has
+PROCESSED_SCHEMA_VERSION = 3
+
+SIDE = pl.Enum(['token1', 'token2'])
+DIRECTION = pl.Enum(['BUY', 'SELL'])
+
+# Fixed-point scale of the *_e6 amount columns
+AMOUNT_SCALE = 10**6
+
+PROCESSED_SCHEMA = {
+    'timestamp': pl.Datetime('ms'),
+    'market_id': pl.UInt32,
+    'maker_id': pl.UInt32,
+    'taker_id': pl.UInt32,
+    'nonusdc_side': SIDE,
+    'maker_direction': DIRECTION,
+    'taker_direction': DIRECTION,
+    'usd_amount_e6': pl.Int64,
+    'token_amount_e6': pl.Int64,
+    'transactionHash': pl.Binary,
+    'year': pl.Int32,
+    'month': pl.Int8,
+}
+
+# Column types of processed trades before v3; price, usd_amount and token_amount were
+# Float64 and stood where the *_e6 columns are now
+LEGACY_PROCESSED_TYPES = {
+    'timestamp': pl.Datetime('us'),
+    'market_id': pl.Utf8,
+    'nonusdc_side': pl.Utf8,
+    'maker_direction': pl.Utf8,
+    'taker_direction': pl.Utf8,
+}
+
+# Parquet footer key holding the schema version a file was written with
+SCHEMA_VERSION_KEY = b'poly_schema_version'
+
+# Marker written by the migration once every file in a dataset is canonical
+SCHEMA_MARKER = '_schema.json'
+
+
+def schema_metadata(version: int = RAW_SCHEMA_VERSION) -> dict:
+    """Parquet key/value metadata to attach to files written with the canonical schema."""
+    return {SCHEMA_VERSION_KEY: str(version).encode()}
+
+
+def column_names(frame) -> List[str]:
+    """Column names of a DataFrame or LazyFrame without materializing it."""
+    if isinstance(frame, pl.LazyFrame):
+        return frame.collect_schema().names()
+    return frame.columns
+
+
+def conform_raw(frame):
+    """
+    Cast a raw orderFilled DataFrame/LazyFrame to RAW_SCHEMA.
+
+    Missing columns (e.g. `id` in files written before it was kept) are filled with
+    nulls, extra columns are dropped and the columns come out in canonical order.
+    """
+    present = set(column_names(frame))
+    return frame.select([
+        pl.col(name).cast(dtype) if name in present else pl.lit(None, dtype=dtype).alias(name)
+        for name, dtype in RAW_SCHEMA.items()
+    ])
+
+
+def trade_price() -> pl.Expr:
+    """Expression for the price of v3 trades: USDC paid per outcome token."""
+    return (pl.col('usd_amount_e6') / pl.col('token_amount_e6')).alias('price')
+
+
+def encode_compact(frame):
+    """
+    Convert processed trades to the v3 column types: Float64 usd_amount/token_amount
+    become Int64 micro-units, price is dropped, market_id, side and directions are cast
+    to their integer and Enum types. Other columns (maker/taker strings of v1 included)
+    keep their place. Frames already in v3 are returned as is.
+    """
+    names = column_names(frame)
+    if 'usd_amount_e6' in names:
+        return frame
+    columns = []
+    for name in names:
+        if name == 'price':
+            continue
+        if name in ('usd_amount', 'token_amount'):
+            columns.append((pl.col(name) * AMOUNT_SCALE).round().cast(pl.Int64).alias(f"{name}_e6"))
+        elif name in PROCESSED_SCHEMA:
+            columns.append(pl.col(name).cast(PROCESSED_SCHEMA[name]))
+        else:
+            columns.append(pl.col(name))
+    return frame.select(columns)
+
+
+def decode_compact(frame):
+    """
+    Convert v3 processed trades back to the column types of earlier versions: Float64
+    price, usd_amount and token_amount, string market_id, side and directions, and
+    microsecond timestamps. Works on DataFrames and LazyFrames; older frames are
+    returned as is.
+    """
+    names = column_names(frame)
+    if 'usd_amount_e6' not in names:
+        return frame
+    columns = []
+    for name in names:
+        if name == 'usd_amount_e6':
+            columns += [trade_price(), (pl.col(name) / AMOUNT_SCALE).alias('usd_amount')]
+        elif name == 'token_amount_e6':
+            columns.append((pl.col(name) / AMOUNT_SCALE).alias('token_amount'))
+        elif name in LEGACY_PROCESSED_TYPES:
+            columns.append(pl.col(name).cast(LEGACY_PROCESSED_TYPES[name]))
+        else:
+            columns.append(pl.col(name))
+    return frame.select(columns)
+
+
+def conform_processed(frame, version: Optional[int]):
+    """Processed trades in the column types of schema `version` (None for legacy v1)."""
+    if version is not None and version >= 3:
+        return encode_compact(frame)
+    return decode_compact(frame)
+
+
+def read_schema_version(path: str) -> Optional[int]:
+    """Schema version stored in a parquet footer, or None for legacy files."""
+    metadata = pq.read_schema(path).metadata or {}
+    version = metadata.get(SCHEMA_VERSION_KEY)
+    return int(version) if version is not None else None
+
+
+def is_canonical_dataset(root: str, version: int = RAW_SCHEMA_VERSION) -> bool:
+    """True once the migration has confirmed every file under `root` uses `version`."""
+    marker = load_json_state(os.path.join(root, SCHEMA_MARKER), default={})
+    return marker.get('version') == version
+
+
+def dataset_version(root: str) -> Optional[int]:
+    """Schema version every file under `root` uses per its marker, or None if unmarked."""
+    return load_json_state(os.path.join(root, SCHEMA_MARKER), default={}).get('version')
+
+
+def mark_canonical(root: str, version: int = RAW_SCHEMA_VERSION):
+    """Write the marker telling readers every file under `root` uses schema `version`."""
+    save_json_state(os.path.join(root, SCHEMA_MARKER), {
+        'version': version,
+        'migrated_at': datetime.now(timezone.utc).isoformat(),
+    })
+
+
+def scan_raw(files: List[str], canonical: bool = False) -> pl.LazyFrame:
+    """
+    Lazily scan raw orderFilled files as RAW_SCHEMA.
+
+    With `canonical=True` this is a single scan_parquet over all files, so filters and
+    projections are pushed down into the reader. Otherwise each file is scanned and cast
+    separately to tolerate the legacy String/Int64 drift.
+    """
+    if canonical:
+        return pl.scan_parquet(files)
+    return pl.concat([conform_raw(pl.scan_parquet(f)) for f in files], how='vertical')
@@ -0,0 +1,152 @@
+import os
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List
+
+import polars as pl
+import pyarrow.parquet as pq
+
+from poly_utils.catalog import Catalog
+
+# Per-partition market index, written by market-clustered compaction next to the files
+# it describes (IPC rather than parquet so dataset globs never pick it up)
+MARKET_INDEX_FILE = '_market_index.arrow'
+
+MARKET_INDEX_SCHEMA = {
+    'market_id': pl.UInt32,
+    'file': pl.Utf8,
+    'row_group': pl.Int32,
+    'offset': pl.Int64,
+    'rows': pl.Int64,
+    'start_ts': pl.Datetime('us'),
+    'end_ts': pl.Datetime('us'),
+}
+
+
+def market_index(df: pl.DataFrame, file_name: str, row_group_rows: List[int]) -> pl.DataFrame:
+    """
+    Index of one file written from `df` (sorted by market_id, timestamp) with row groups
+    of `row_group_rows` rows: for every market and row group holding its trades, the
+    row range inside the row group and the first/last trade time.
+    """
+    starts = pl.Series([0] + list(row_group_rows[:-1])).cum_sum()
+    row = pl.int_range(0, df.height, dtype=pl.Int64, eager=True)
+    row_group = starts.search_sorted(row, side='right') - 1
+    return (
+        df.select(['market_id', 'timestamp'])
+        .with_columns([
+            pl.Series('row_group', row_group).cast(pl.Int32),
+            (row - starts.gather(row_group)).alias('offset'),
+        ])
+        .filter(pl.col('market_id').is_not_null())
+        .group_by(['market_id', 'row_group'])
+        .agg([
+            pl.col('offset').min().cast(pl.Int64),
+            pl.len().cast(pl.Int64).alias('rows'),
+            pl.col('timestamp').min().cast(pl.Datetime('us')).alias('start_ts'),
+            pl.col('timestamp').max().cast(pl.Datetime('us')).alias('end_ts'),
+        ])
+        .with_columns(pl.lit(file_name).alias('file'))
+        .select(list(MARKET_INDEX_SCHEMA))
+        .sort(['market_id', 'row_group'])
+    )
+
+
+def write_market_index(directory: str, indexes: List[pl.DataFrame]):
+    """Write the market index of one partition directory."""
+    index = pl.concat(indexes) if indexes else pl.DataFrame(schema=MARKET_INDEX_SCHEMA)
+    tmp_path = os.path.join(directory, f".{MARKET_INDEX_FILE}.tmp")
+    index.write_ipc(tmp_path, compression='uncompressed')
+    os.replace(tmp_path, os.path.join(directory, MARKET_INDEX_FILE))
+
+
+def load_market_index(directory: str):
+    """The market index of a partition directory, or None if it was not clustered."""
+    path = os.path.join(directory, MARKET_INDEX_FILE)
+    if not os.path.exists(path):
+        return None
+    return pl.read_ipc(path, memory_map=False)
+
+
+def _as_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+
+def _market_filter(ids: list, dtype) -> pl.Expr:
+    """market_id filter for ids given as strings or integers, whatever the column's type."""
+    return pl.col('market_id').is_in(pl.Series([str(i) for i in ids]).cast(dtype, strict=False).drop_nulls().to_list())
+
+
+def _read_indexed(path: str, entries: pl.DataFrame, columns: List[str] = None) -> List[pl.DataFrame]:
+    """Read only the row ranges listed in `entries` from one clustered file."""
+    parquet_file = pq.ParquetFile(path)
+    frames = []
+    for row_group, ranges in entries.group_by('row_group', maintain_order=True):
+        table = parquet_file.read_row_group(row_group[0], columns=columns)
+        for offset, rows in ranges.select(['offset', 'rows']).iter_rows():
+            frames.append(pl.from_arrow(table.slice(offset, rows)))
+    return frames
+
+
+def load_trades(market_ids, start=None, end=None, processed_dir: str = 'processed/trades',
+                columns: List[str] = None) -> pl.DataFrame:
+    """
+    Processed trades of one market (or list of markets), optionally within [start, end].
+
+    Partitions compacted with the `clustered` profile are read through their market
+    index, so only the row groups (and rows) of the requested markets are decoded.
+    Files without an index entry (e.g. appended by process_live since the last
+    compaction) are scanned with a market_id filter. The catalog, when complete,
+    limits both to the files overlapping [start, end].
+
+    Args:
+        market_ids: Market ID or list of market IDs (strings or integers).
+        start: First trade time to include (datetime or ISO string).
+        end: Last trade time to include.
+        processed_dir: Processed trades dataset.
+        columns: Columns to read (default: all).
+    """
+    ids = [market_ids] if isinstance(market_ids, (str, int)) else list(market_ids)
+    start, end = _as_datetime(start), _as_datetime(end)
+    if columns is not None:
+        columns = list(dict.fromkeys(list(columns) + ['market_id', 'timestamp']))
+
+    by_directory: Dict[str, List[str]] = defaultdict(list)
+    for path in Catalog(processed_dir).files_overlapping(start, end):
+        by_directory[os.path.dirname(path)].append(path)
+
+    frames, unindexed = [], []
+    for directory, files in sorted(by_directory.items()):
+        index = load_market_index(directory)
+        if index is None:
+            unindexed.extend(files)
+            continue
+        indexed_files = set(index['file'])
+        unindexed.extend(f for f in files if os.path.basename(f) not in indexed_files)
+        entries = index.filter(_market_filter(ids, index.schema['market_id']))
+        if start is not None:
+            entries = entries.filter(pl.col('end_ts') >= start)
+        if end is not None:
+            entries = entries.filter(pl.col('start_ts') <= end)
+        for file_name, file_entries in entries.group_by('file', maintain_order=True):
+            path = os.path.join(directory, file_name[0])
+            if path in files:
+                frames.extend(_read_indexed(path, file_entries, columns))
+
+    if unindexed:
+        lf = pl.scan_parquet(unindexed, hive_partitioning=False)
+        lf = lf.filter(_market_filter(ids, lf.collect_schema()['market_id']))
+        if columns is not None:
+            lf = lf.select(columns)
+        frames.append(lf.collect())
+
+    if not frames:
+        return pl.DataFrame()
+    trades = pl.concat(frames, how='vertical_relaxed')
+    if start is not None:
+        trades = trades.filter(pl.col('timestamp') >= start)
+    if end is not None:
+        trades = trades.filter(pl.col('timestamp') <= end)
+    return trades.sort(['market_id', 'timestamp'], maintain_order=True)
@@ -1,49 +1,138 @@
 import os
 import json
-import requests
-import time
+import queue
+import tempfile
+import threading
 from typing import List
 import polars as pl
+import pyarrow.parquet as pq
+
+from poly_utils.metrics import METRICS
 
 PLATFORM_WALLETS = ['0xc5d563a36ae78145c45a50134d48a1215220f80a', '0x4bfb41d5b3570defd03c39a9a4d8de6bd8b8982e']
 
 
+def load_json_state(path: str, default=None):
+    """Read a JSON state file, returning `default` if it does not exist yet."""
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json_state(path: str, state):
+    """Atomically replace a JSON state file so a crash never leaves it half-written."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def stream_batches(lf: pl.LazyFrame, chunk_size: int):
+    """
+    Run a LazyFrame on the streaming engine and yield its result in DataFrames of about
+    `chunk_size` rows, so peak memory is bounded by the batch rather than the result.
+    A failing query raises here, in the consumer, rather than ending the batches early.
+
+    The query runs on a helper thread through sink_batches(). Older polars without it
+    sinks the result to a temporary parquet file and reads that back batch by batch.
+    """
+    if not hasattr(lf, 'sink_batches'):
+        yield from _stream_through_file(lf, chunk_size)
+        return
+
+    batches = queue.Queue(maxsize=1)
+    stopped = threading.Event()
+    failure = []
+
+    def put(df):
+        while not stopped.is_set():
+            try:
+                batches.put(df, timeout=0.1)
+                return False
+            except queue.Full:
+                pass
+        return True  # the consumer went away: stop the query
+
+    def run():
+        try:
+            lf.sink_batches(put, chunk_size=chunk_size, engine='streaming')
+        except BaseException as e:
+            failure.append(e)
+        finally:
+            put(_END)
+
+    thread = threading.Thread(target=run, name='stream-batches', daemon=True)
+    thread.start()
+    try:
+        while True:
+            df = batches.get()
+            if df is _END:
+                break
+            yield df
+    finally:
+        stopped.set()
+        thread.join()
+    if failure:
+        raise failure[0]
+
+
+_END = object()
+
+
+def _stream_through_file(lf: pl.LazyFrame, chunk_size: int):
+    with tempfile.TemporaryDirectory(prefix='poly-stream-') as tmp:
+        path = os.path.join(tmp, 'result.parquet')
+        lf.sink_parquet(path, row_group_size=chunk_size)
+        rows = pq.ParquetFile(path).metadata.num_rows
+        for offset in range(0, rows, chunk_size):
+            # One row group per slice, so each read decodes only its own rows
+            yield pl.scan_parquet(path).slice(offset, chunk_size).collect()
+
+
+def partition_dirs(root: str, depth: int) -> List[str]:
+    """List the leaf `key=value` partition directories `depth` levels below `root`."""
+    level = [root]
+    for _ in range(depth):
+        level = [
+            os.path.join(parent, d)
+            for parent in level
+            for d in sorted(os.listdir(parent))
+            if '=' in d and not d.startswith(('.', '_')) and os.path.isdir(os.path.join(parent, d))
+        ]
+    return level
+
+
+def parquet_files(directory: str) -> List[str]:
+    """Visible parquet files in one directory (hidden temp files and `_` metadata are skipped)."""
+    return sorted(
+        os.path.join(directory, f) for f in os.listdir(directory)
+        if f.endswith('.parquet') and not f.startswith(('.', '_'))
+    )
+
+
+@METRICS.stage('get_markets')
 def get_markets(main_dir: str = "markets_partitioned", missing_file: str = "missing_markets.parquet"):
     """
     Load and combine markets from the partitioned parquet dataset and the missing markets parquet file.
     Deduplicates and sorts by createdAt.
     Returns combined Polars DataFrame sorted by creation date.
+
+    The combined table is materialized as a memory-mapped Arrow snapshot
+    (see poly_utils.markets) that is only rebuilt when the source files change, so
+    repeated calls do not re-read the dataset. Use scan_markets() to load only some columns.
     """
-    import polars as pl
-    
-    dfs = []
-    
-    # Load main markets from partitioned parquet dataset
-    if os.path.exists(main_dir) and any(os.scandir(main_dir)):
-        files = sorted([os.path.join(root, f) for root, _, files in os.walk(main_dir) for f in files if f.endswith('.parquet')])
-        if files:
-            scans = [pl.scan_parquet(f) for f in files]
-            main_df = pl.concat(scans, how='diagonal').collect(streaming=True)
-            dfs.append(main_df)
-            print(f"Loaded {len(main_df)} markets from {main_dir}")
-    
-    # Load missing markets file
-    if os.path.exists(missing_file):
-        missing_df = pl.read_parquet(missing_file)
-        dfs.append(missing_df)
-        print(f"Loaded {len(missing_df)} markets from {missing_file}")
-    
-    if not dfs:
+    from poly_utils.markets import scan_markets
+
+    combined_df = scan_markets(main_dir, missing_file).collect()
+    if combined_df.is_empty():
         print("No market files found!")
         return pl.DataFrame()
-    
-    # Combine, deduplicate, and sort
-    combined_df = (
-        pl.concat(dfs)
-        .unique(subset=['id'], keep='first')
-        .sort('createdAt')
-    )
-    
+
+    METRICS.count('markets_loaded', len(combined_df))
     print(f"Combined total: {len(combined_df)} unique markets (sorted by createdAt)")
     return combined_df
 
@@ -74,83 +163,46 @@ def update_missing_tokens(missing_token_ids: List[str], parquet_filename: str =
         except Exception as e:
             print(f"Error reading existing file: {e}")
 
-    for token_id in missing_token_ids:
-        print(f"Fetching market for token: {token_id}")
-        
-        retry_count = 0
-        max_retries = 3
-        
-        while retry_count < max_retries:
-            try:
-                response = requests.get(
-                    'https://gamma-api.polymarket.com/markets',
-                    params={'clob_token_ids': token_id},
-                    timeout=30
-                )
-                
-                if response.status_code == 429:
-                    print(f"Rate limited - waiting 10 seconds...")
-                    time.sleep(10)
-                    continue
-                elif response.status_code != 200:
-                    print(f"API error {response.status_code} for token {token_id}")
-                    retry_count += 1
-                    time.sleep(2)
-                    continue
-                
-                markets = response.json()
-                
-                if not markets:
-                    print(f"No market found for token {token_id}")
-                    break
-                
-                market = markets[0]
-                market_id = market.get('id', '')
-                
-                if market_id in processed_market_ids:
-                    print(f"Market {market_id} already exists - skipping")
-                    break
-                
-                clob_tokens_str = market.get('clobTokenIds', '[]')
-                clob_tokens = json.loads(clob_tokens_str) if isinstance(clob_tokens_str, str) else clob_tokens_str
-                
-                if len(clob_tokens) < 2:
-                    print(f"Invalid token data for {token_id}")
-                    break
-                
-                outcomes_str = market.get('outcomes', '[]')
-                outcomes = json.loads(outcomes_str) if isinstance(outcomes_str, str) else outcomes_str
-                
-                new_markets_data.append({
-                    'createdAt': market.get('createdAt', ''),
-                    'id': market_id,
-                    'question': market.get('question', '') or market.get('title', ''),
-                    'answer1': outcomes[0] if len(outcomes) > 0 else 'YES',
-                    'answer2': outcomes[1] if len(outcomes) > 1 else 'NO',
-                    'neg_risk': market.get('negRiskAugmented', False) or market.get('negRiskOther', False),
-                    'market_slug': market.get('slug', ''),
-                    'token1': clob_tokens[0],
-                    'token2': clob_tokens[1],
-                    'condition_id': market.get('conditionId', ''),
-                    'volume': market.get('volume', ''),
-                    'ticker': market['events'][0].get('ticker', '') if market.get('events') else '',
-                    'closedTime': market.get('closedTime', '')
-                })
-                
-                processed_market_ids.add(market_id)
-                print(f"Successfully fetched market {market_id} for token {token_id}")
-                break
-                
-            except Exception as e:
-                print(f"Error fetching token {token_id}: {e}")
-                retry_count += 1
-                time.sleep(2)
-        
-        if retry_count >= max_retries:
-            print(f"Failed to fetch token {token_id} after {max_retries} retries")
-        
-        time.sleep(0.5)
-    
+    # Tokens are looked up in concurrent, rate-limited batches (see poly_utils.resolver)
+    from poly_utils.resolver import MarketResolver
+
+    markets, _ = MarketResolver().fetch(list(missing_token_ids))
+    for market in markets:
+        market_id = market.get('id', '')
+
+        if market_id in processed_market_ids:
+            print(f"Market {market_id} already exists - skipping")
+            continue
+
+        clob_tokens_str = market.get('clobTokenIds', '[]')
+        clob_tokens = json.loads(clob_tokens_str) if isinstance(clob_tokens_str, str) else clob_tokens_str
+
+        if len(clob_tokens) < 2:
+            print(f"Invalid token data for market {market_id}")
+            continue
+
+        outcomes_str = market.get('outcomes', '[]')
+        outcomes = json.loads(outcomes_str) if isinstance(outcomes_str, str) else outcomes_str
+
+        new_markets_data.append({
+            'createdAt': market.get('createdAt', ''),
+            'id': market_id,
+            'question': market.get('question', '') or market.get('title', ''),
+            'answer1': outcomes[0] if len(outcomes) > 0 else 'YES',
+            'answer2': outcomes[1] if len(outcomes) > 1 else 'NO',
+            'neg_risk': market.get('negRiskAugmented', False) or market.get('negRiskOther', False),
+            'market_slug': market.get('slug', ''),
+            'token1': clob_tokens[0],
+            'token2': clob_tokens[1],
+            'condition_id': market.get('conditionId', ''),
+            'volume': market.get('volume', ''),
+            'ticker': market['events'][0].get('ticker', '') if market.get('events') else '',
+            'closedTime': market.get('closedTime', '')
+        })
+
+        processed_market_ids.add(market_id)
+        print(f"Successfully fetched market {market_id}")
+
     if not new_markets_data:
         print("No new markets to add")
         return
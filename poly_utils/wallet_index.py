@@ -0,0 +1,189 @@
+import os
+import shutil
+from datetime import datetime
+from typing import List
+
+import polars as pl
+import pyarrow.parquet as pq
+
+from poly_utils import compaction
+from poly_utils.dictionary import WalletDictionary, encode_wallets
+from poly_utils.schema import PROCESSED_SCHEMA, PROCESSED_SCHEMA_VERSION, encode_compact
+from poly_utils.utils import load_json_state, parquet_files, partition_dirs, save_json_state
+from poly_utils.writer import PartitionWriter
+
+WALLET_TRADES_ROOT = 'processed/wallet_trades'
+WALLET_TRADES_STATE = '_state.json'
+
+# Wallets are spread over this many `bucket=NN` partitions by wallet id
+WALLET_BUCKETS = 64
+
+# Small row groups so a lookup decodes little beyond the wallet's own rows
+WALLET_ROW_GROUP_SIZE = 65_536
+
+# Files smaller than this are merged together once a bucket has more than
+# MAX_SMALL_FILES of them; larger files are left alone
+MERGE_MAX_BYTES = 256 * 2**20
+MAX_SMALL_FILES = 8
+
+# Rows buffered in memory before they are spilled to the staging directory
+SPILL_EVERY_ROWS = 2_000_000
+
+WALLET_TRADE_COLUMNS = ['wallet_id'] + [c for c in PROCESSED_SCHEMA if c not in ('year', 'month')]
+
+
+def wallet_rows(trades: pl.DataFrame) -> pl.DataFrame:
+    """
+    Project processed trades (current schema) onto their wallets: one row per trade for the
+    maker and one for the taker, unless the trade is a self-trade.
+    """
+    trades = trades.select([c for c in WALLET_TRADE_COLUMNS if c != 'wallet_id'])
+    return pl.concat([
+        trades.with_columns(pl.col('maker_id').alias('wallet_id')),
+        trades.filter(pl.col('taker_id') != pl.col('maker_id')).with_columns(pl.col('taker_id').alias('wallet_id')),
+    ]).filter(pl.col('wallet_id').is_not_null()).select(WALLET_TRADE_COLUMNS)
+
+
+def wallet_index_initialized(root: str = WALLET_TRADES_ROOT) -> bool:
+    """
+    True once the wallet index covers the whole processed history (see
+    update_wallet_index) in the current processed schema; an index built with an
+    older schema has to be rebuilt.
+    """
+    state = load_json_state(os.path.join(root, WALLET_TRADES_STATE), default={})
+    return state.get('initialized', False) and state.get('schema_version', 2) == PROCESSED_SCHEMA_VERSION
+
+
+def mark_wallet_index_initialized(root: str = WALLET_TRADES_ROOT, through=None):
+    save_json_state(os.path.join(root, WALLET_TRADES_STATE), {
+        'initialized': True,
+        'schema_version': PROCESSED_SCHEMA_VERSION,
+        'through': str(through) if through is not None else None,
+        'updated_at': datetime.now().isoformat(),
+    })
+
+
+def mark_wallet_index_stale(root: str = WALLET_TRADES_ROOT, reason: str = None):
+    """
+    Flag the wallet index as missing trades: updates skip it until it is rebuilt
+    (`python -m update_utils.update_wallet_index --rebuild`).
+    """
+    save_json_state(os.path.join(root, WALLET_TRADES_STATE), {
+        'initialized': False,
+        'stale_reason': reason,
+        'updated_at': datetime.now().isoformat(),
+    })
+    print(f"⚠️  Wallet index marked for rebuild ({reason}); run `python -m update_utils.update_wallet_index --rebuild`")
+
+
+def merge_small_files(directory: str, staging_dir: str):
+    """Merge the small files of one bucket into a single file sorted by wallet and time."""
+    compaction.merge_small_files(directory, staging_dir, ['wallet_id', 'timestamp'], prefix='wallet_trades',
+                                 max_bytes=MERGE_MAX_BYTES, max_small_files=MAX_SMALL_FILES,
+                                 row_group_size=WALLET_ROW_GROUP_SIZE)
+
+
+class WalletTradeWriter:
+    """
+    Incrementally maintained wallet-sorted projection of processed/trades under `root`.
+
+    Every trade passed to write() is stored once under its maker and once under its
+    taker, in `bucket=NN` partitions by wallet id, in files sorted by wallet id and
+    time with small row groups. A lookup therefore opens one bucket and, through the
+    row-group statistics on wallet_id, only decodes row groups holding that wallet.
+    Rows are buffered in memory and spilled to a staging directory next to `root` when
+    the buffer fills up; close() publishes them, after the trades they come from are
+    committed, and merges buckets with many small files (merge_small_files()). A run
+    that never reaches close() leaves nothing in `root`, so its trades are not indexed
+    twice when they are processed again.
+
+    Batches may carry maker/taker addresses (new addresses are added to `wallets`) or
+    wallet ids (processed schema v2 and later); rows are stored in the current schema.
+
+    Args:
+        root: Root of the wallet index.
+        wallets: Wallet dictionary shared with the trades writer (one is opened if omitted).
+    """
+
+    def __init__(self, root: str = WALLET_TRADES_ROOT, wallets: WalletDictionary = None):
+        self.root = root
+        self.wallets = wallets if wallets is not None else WalletDictionary()
+        self._buffer: List[pl.DataFrame] = []
+        self._rows = 0
+        self.rows_written = 0
+        # Rows of uncommitted trades; whatever a crashed run left here is dropped
+        self.staging_dir = f"{os.path.realpath(root)}.pending"
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+    def write(self, trades: pl.DataFrame):
+        """Add a batch of processed trades to the index."""
+        if trades.is_empty():
+            return
+        rows = wallet_rows(encode_compact(encode_wallets(trades, self.wallets)))
+        self._buffer.append(rows)
+        self._rows += rows.height
+        if self._rows > SPILL_EVERY_ROWS:
+            self.spill()
+
+    def spill(self):
+        """Move the buffered rows to the staging directory, one file per bucket."""
+        if not self._buffer:
+            return
+        rows = pl.concat(self._buffer).sort(['wallet_id', 'timestamp'])
+        self._buffer = []
+        self._rows = 0
+
+        writer = PartitionWriter(self.staging_dir, ['bucket'], prefix='wallet_trades', compression='zstd',
+                                 target_rows=50_000_000, target_bytes=4096 * 2**20, memory_budget=8192 * 2**20,
+                                 row_group_size=WALLET_ROW_GROUP_SIZE)
+        writer.write(rows.with_columns((pl.col('wallet_id') % WALLET_BUCKETS).cast(pl.Int32).alias('bucket')))
+        writer.close()
+
+    def close(self):
+        """Publish the staged and buffered rows and merge buckets with many small files."""
+        self.spill()
+        if not os.path.isdir(self.staging_dir):
+            return
+        touched = []
+        for staged in partition_dirs(self.staging_dir, 1):
+            directory = os.path.join(self.root, os.path.basename(staged))
+            os.makedirs(directory, exist_ok=True)
+            for path in parquet_files(staged):
+                self.rows_written += pq.read_metadata(path).num_rows
+                os.replace(path, os.path.join(directory, os.path.basename(path)))
+            touched.append(directory)
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+        staging_dir = f"{os.path.realpath(self.root)}.merge"
+        for directory in sorted(touched):
+            if len(parquet_files(directory)) > MAX_SMALL_FILES:
+                os.makedirs(staging_dir, exist_ok=True)
+                merge_small_files(os.path.realpath(directory), staging_dir)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def mark_stale(self, reason: str = None):
+        mark_wallet_index_stale(self.root, reason)
+
+
+def scan_wallet_trades(wallet, root: str = WALLET_TRADES_ROOT, wallets: WalletDictionary = None) -> pl.LazyFrame:
+    """
+    Lazy scan of every trade a wallet address (or list of addresses) took part in, as
+    maker or taker, in the current processed schema plus `wallet_id` (the wallet it was found
+    under). Only the wallets' buckets are scanned; use with_addresses() for readable
+    addresses and hashes.
+    """
+    wallets = wallets or WalletDictionary()
+    addresses = [wallet] if isinstance(wallet, str) else list(wallet)
+    ids = [i for i in (wallets.lookup(a) for a in addresses) if i is not None]
+    files = []
+    for bucket in sorted({i % WALLET_BUCKETS for i in ids}):
+        directory = os.path.join(root, f"bucket={bucket}")
+        if os.path.isdir(directory):
+            files.extend(parquet_files(directory))
+    if not files:
+        schema = {'wallet_id': pl.UInt32, **{c: PROCESSED_SCHEMA[c] for c in WALLET_TRADE_COLUMNS[1:]}}
+        return pl.LazyFrame(schema=schema)
+    return (
+        pl.scan_parquet(files, hive_partitioning=False)
+        .filter(pl.col('wallet_id').is_in(ids))
+    )
@@ -0,0 +1,199 @@
+import os
+import threading
+import uuid
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import polars as pl
+import pyarrow.parquet as pq
+
+from poly_utils.event_index import event_fingerprints
+from poly_utils.schema import SCHEMA_VERSION_KEY
+
+
+class PartitionWriter:
+    """
+    Buffered writer for hive-partitioned parquet datasets (`root/year=2024/month=1/...`).
+
+    Rows are buffered per partition in memory and written as few, large files instead
+    of one file per page or batch. Every file gets a run-unique name, is written to a
+    hidden temporary file and atomically renamed into place, so readers globbing
+    `**/*.parquet` never see a partial file and a later run never overwrites an
+    earlier one.
+
+    A partition is flushed once it reaches `target_rows` or `target_bytes`, everything
+    is flushed once the total buffer exceeds `memory_budget`, and the rest is flushed
+    on close(). Flushing a partition also flushes every partition that sorts before it,
+    so a resume watermark read from disk never overtakes rows still in the buffer.
+
+    Args:
+        root: Dataset root directory.
+        partition_cols: Columns used as hive partition keys.
+        schema_metadata: Parquet key/value metadata stored in every file footer
+            (e.g. poly_utils.schema.schema_metadata()).
+        catalog: Optional poly_utils.catalog.Catalog that records every committed file.
+        keep_partition_cols: Also store the partition columns inside each file
+            (processed/trades files have always carried year/month).
+        prefix: File name prefix, e.g. 'trades'.
+        target_rows: Rows per partition that trigger a flush.
+        target_bytes: In-memory bytes per partition that trigger a flush.
+        memory_budget: Total buffered bytes that trigger a full flush.
+        run_id: Unique part of the file names (default: timestamp + random suffix).
+            Pass a deterministic value to make re-running the same work overwrite its own files.
+        defer_commit: Keep files hidden until close(), so a run is committed all at once.
+        compression: Parquet compression codec.
+        row_group_size: Maximum rows per row group (default: pyarrow's).
+        event_index: Optional poly_utils.event_index.EventIndex: rows whose event is
+            already stored (or buffered) are dropped on write(), and the events of
+            every committed file are recorded in it.
+    """
+
+    def __init__(self, root: str, partition_cols: List[str], prefix: str = 'part',
+                 target_rows: int = 2_000_000, target_bytes: int = 128 * 2**20,
+                 memory_budget: int = 512 * 2**20, run_id: str = None,
+                 defer_commit: bool = False, compression: str = 'zstd',
+                 schema_metadata: dict = None, catalog=None, keep_partition_cols: bool = False,
+                 row_group_size: int = None, event_index=None):
+        self.root = root
+        self.partition_cols = list(partition_cols)
+        self.prefix = prefix
+        self.target_rows = target_rows
+        self.target_bytes = target_bytes
+        self.memory_budget = memory_budget
+        self.run_id = run_id or f"{datetime.now().strftime('%Y%m%d_%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.defer_commit = defer_commit
+        self.compression = compression
+        self.schema_metadata = schema_metadata
+        self.catalog = catalog
+        self.keep_partition_cols = keep_partition_cols
+        self.row_group_size = row_group_size
+        self.event_index = event_index
+
+        self.files_written: List[str] = []
+        self.rows_written = 0
+        self._buffers: Dict[Tuple, List[pl.DataFrame]] = {}
+        self._buffer_rows: Dict[Tuple, int] = {}
+        self._buffer_bytes: Dict[Tuple, int] = {}
+        self._pending: List[Tuple[str, str, int, dict, pl.Series]] = []
+        self._seq = 0
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self.defer_commit:
+            self.abort()
+        else:
+            self.close()
+
+    @property
+    def buffered_bytes(self) -> int:
+        return sum(self._buffer_bytes.values())
+
+    @property
+    def schema_version(self):
+        """Schema version written to every file footer, or None without schema metadata."""
+        version = (self.schema_metadata or {}).get(SCHEMA_VERSION_KEY)
+        return int(version) if version else None
+
+    def partition_dir(self, key: Tuple) -> str:
+        parts = [f"{col}={value}" for col, value in zip(self.partition_cols, key)]
+        return os.path.join(self.root, *parts)
+
+    def write(self, df: pl.DataFrame) -> pl.DataFrame:
+        """
+        Buffer rows; `df` must contain the partition columns. Returns the rows buffered
+        (with an event index, those whose event was not stored yet).
+        """
+        if df.is_empty():
+            return df
+        with self._lock:
+            if self.event_index is not None:
+                df = self.event_index.filter_new(df)
+                if df.is_empty():
+                    return df
+            for key, group in df.partition_by(self.partition_cols, as_dict=True,
+                                               include_key=self.keep_partition_cols).items():
+                key = tuple(key) if isinstance(key, tuple) else (key,)
+                self._buffers.setdefault(key, []).append(group)
+                self._buffer_rows[key] = self._buffer_rows.get(key, 0) + group.height
+                self._buffer_bytes[key] = self._buffer_bytes.get(key, 0) + group.estimated_size()
+
+                if self._buffer_rows[key] >= self.target_rows or self._buffer_bytes[key] >= self.target_bytes:
+                    self.flush(key)
+
+            if self.buffered_bytes > self.memory_budget:
+                self.flush()
+        return df
+
+    def flush(self, upto: Tuple = None):
+        """Write buffered partitions; with `upto`, only partitions sorting at or before that key."""
+        with self._lock:
+            for key in sorted(self._buffers):
+                if upto is not None and key > upto:
+                    break
+                # Diagonal: batches may lack sparse columns (a page of open markets has no closedTime)
+                self._write_partition(key, pl.concat(self._buffers.pop(key), how='diagonal_relaxed'))
+                self._buffer_rows.pop(key)
+                self._buffer_bytes.pop(key)
+
+    def _write_partition(self, key: Tuple, df: pl.DataFrame):
+        directory = self.partition_dir(key)
+        os.makedirs(directory, exist_ok=True)
+
+        name = f"{self.prefix}-{self.run_id}-{self._seq:05d}.parquet"
+        self._seq += 1
+        final_path = os.path.join(directory, name)
+        tmp_path = os.path.join(directory, f".{name}.tmp")
+
+        table = df.to_arrow()
+        if self.schema_metadata:
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}), **self.schema_metadata})
+        pq.write_table(table, tmp_path, compression=self.compression, row_group_size=self.row_group_size)
+
+        entry = None
+        if self.catalog is not None:
+            entry = self.catalog.entry_for(final_path, df, self.schema_version, os.path.getsize(tmp_path))
+        fingerprints = event_fingerprints(df['id']) if self.event_index is not None else None
+        if self.defer_commit:
+            self._pending.append((tmp_path, final_path, df.height, entry, fingerprints))
+        else:
+            os.replace(tmp_path, final_path)
+            if entry is not None:
+                self.catalog.add_entries([entry])
+            if fingerprints is not None:
+                self.event_index.record(final_path, fingerprints)
+        self.files_written.append(final_path)
+        self.rows_written += df.height
+
+    def close(self):
+        """Flush everything that is still buffered and commit deferred files."""
+        with self._lock:
+            self.flush()
+            for tmp_path, final_path, _, _, fingerprints in self._pending:
+                os.replace(tmp_path, final_path)
+                if fingerprints is not None:
+                    self.event_index.record(final_path, fingerprints)
+            if self.catalog is not None:
+                self.catalog.add_entries([entry for _, _, _, entry, _ in self._pending])
+            self._pending = []
+            if self.event_index is not None:
+                self.event_index.save()
+
+    def abort(self):
+        """Drop buffered rows and remove uncommitted temporary files."""
+        with self._lock:
+            self._buffers.clear()
+            self._buffer_rows.clear()
+            self._buffer_bytes.clear()
+            for tmp_path, final_path, rows, _, _ in self._pending:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                self.files_written.remove(final_path)
+                self.rows_written -= rows
+            self._pending = []
+            if self.event_index is not None:
+                # Files committed before the abort (without defer_commit) stay indexed
+                self.event_index.discard()
+                self.event_index.save()
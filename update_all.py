@@ -1,11 +1,41 @@
+from contextlib import nullcontext
+
+from poly_utils.feed import FEED_SOCKET
+from poly_utils.metrics import METRICS
 from update_utils.update_markets import update_markets
 from update_utils.update_goldsky import update_goldsky
 from update_utils.process_live import process_live
+from update_utils.pipeline import run_pipeline
+from update_utils.daemon import LiveDaemon
 
 if __name__ == "__main__":
-    print("Updating markets")
-    update_markets()
-    print("Updating goldsky")
-    update_goldsky()
-    print("Processing live")
-    process_live()
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Update markets, scrape Goldsky and process new trades")
+    parser.add_argument('--pipelined', action='store_true',
+                        help="Run the three stages concurrently, processing Goldsky pages as they arrive")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Keep running: poll Goldsky continuously and commit new trades every few seconds "
+                             "(start it directly, not through run_update.sh, which already holds the update lock)")
+    parser.add_argument('--feed', nargs='?', const=FEED_SOCKET, metavar='SOCKET',
+                        help="With --daemon, publish new trades as an Arrow IPC stream on a Unix socket")
+    parser.add_argument('--profile', action='store_true',
+                        help="Write cProfile stats and the Polars query plans of process_live to the metrics directory")
+    args = parser.parse_args()
+
+    if args.daemon:
+        raise SystemExit(0 if LiveDaemon(feed_socket=args.feed).run() else 1)
+
+    with METRICS.stage('update_all'):
+        if args.pipelined:
+            print("Running markets, goldsky and processing as one pipeline")
+            with METRICS.profile('pipeline') if args.profile else nullcontext():
+                run_pipeline()
+        else:
+            print("Updating markets")
+            update_markets()
+            print("Updating goldsky")
+            update_goldsky()
+            print("Processing live")
+            with METRICS.profile('process_live') if args.profile else nullcontext():
+                process_live()
@@ -0,0 +1,495 @@
+"""
+Long-running update daemon: keeps the pipeline's state hot and lands trades in
+`processed/trades` within seconds.
+
+A cron run of update_all.py starts a cold process: it re-imports everything, reloads
+the markets lookup and the dictionaries, and rediscovers every watermark on disk. The
+daemon does that once. It then keeps in memory the token and wallet dictionaries, the
+Goldsky cursor, the pooled HTTP sessions and the open writers, and:
+
+- polls Goldsky continuously on a fetch thread (every `poll_seconds` once caught up);
+- persists each page to `goldsky/orderFilled` and enriches it right away (see
+  update_utils.pipeline.TradePipeline);
+- commits raw files, trades and the processing manifest every `flush_seconds`, or
+  sooner when `flush_rows` rows are buffered;
+- flushes bars, positions and the wallet index every `derived_seconds`, journaling
+  the trade files committed in between so a restart after a hard kill replays them;
+- runs update_markets every `markets_seconds` on a background thread;
+- merges its own small files once a partition has collected many of them.
+
+Lock files follow run_update.sh. `update_all.lock` is held for the daemon's whole
+lifetime, so cron runs exit straight away. `/tmp/poly-fetcher.lock` exists only
+while a commit is writing. The analyzer's safety check therefore passes between
+commits, and the power-down that follows stops the daemon with SIGTERM.
+SIGTERM/SIGINT (or `--stop`) end the daemon cleanly: it stops polling, processes
+and commits what it has, flushes the derived datasets and removes its locks.
+
+    python -m update_utils.daemon
+    python -m update_utils.daemon --stop
+"""
+import os
+import queue
+import shutil
+import signal
+import threading
+import time
+from contextlib import contextmanager
+
+import polars as pl
+
+from poly_utils.catalog import Catalog
+from poly_utils.compaction import merge_small_files
+from poly_utils.dictionary import TokenDictionary
+from poly_utils.event_index import EventIndex
+from poly_utils.feed import FEED_SOCKET, TradeFeed
+from poly_utils.manifest import MANIFEST_FILE, ProcessingManifest
+from poly_utils.markets import load_market_tokens
+from poly_utils.metrics import METRICS
+from poly_utils.resolver import GAMMA_MARKETS_URL, MarketResolver
+from poly_utils.schema import schema_metadata
+from poly_utils.utils import load_json_state, parquet_files, save_json_state
+from poly_utils.writer import PartitionWriter
+from update_utils.pipeline import BackgroundResolver, TradePipeline, _put, run_markets_update
+from update_utils.process_live import close_consumers, open_outputs, process_live
+from update_utils.update_goldsky import QUERY_URL, GoldskyClient, get_latest_timestamp
+from update_utils.update_markets import MARKETS_URL
+
+# Lock files shared with run_update.sh and the analyzer's safety check
+UPDATE_LOCK = 'update_all.lock'
+FETCHER_LOCK = '/tmp/poly-fetcher.lock'
+
+# Seconds between Goldsky polls once the fetch thread has caught up
+POLL_SECONDS = 2.0
+
+# Buffered pages are committed at most this often, or once FLUSH_ROWS are buffered
+FLUSH_SECONDS = 5.0
+FLUSH_ROWS = 200_000
+
+# How often bars, positions and the wallet index are flushed, and markets updated
+DERIVED_SECONDS = 60.0
+MARKETS_SECONDS = 300.0
+
+# A partition's small files written by the daemon are merged once there are more than this
+LIVE_MAX_SMALL_FILES = 32
+
+# Trade files committed since the derived datasets were last flushed, in processed/trades
+DERIVED_JOURNAL = '_derived_pending.json'
+
+# Trades held back for their market, saved as `<processed/trades>.waiting.parquet`
+WAITING_SUFFIX = '.waiting.parquet'
+
+PAGE_QUEUE_SIZE = 64
+
+
+def poll_pages(client: GoldskyClient, start_ts, pages: queue.Queue, stop: threading.Event,
+               poll_seconds: float = POLL_SECONDS):
+    """
+    Fetch thread: put every new Goldsky page on `pages`, forever. The (timestamp, id)
+    cursor of the last event is kept in memory, so polls resume exactly where the
+    previous one stopped; the first poll includes `start_ts` itself (the event index
+    drops what is already stored). Failed polls (after the client's own retries) are
+    reported and retried on the next poll.
+    """
+    cursor_ts, cursor_id = start_ts, ''
+    while not stop.is_set():
+        try:
+            for df in client.iter_pages(cursor_ts, cursor_id):
+                cursor_ts, cursor_id = df['timestamp'][-1], df['id'][-1]
+                if not _put(pages, df, stop):
+                    return
+        except Exception as e:
+            print(f"Goldsky poll failed: {e}")
+        stop.wait(poll_seconds)
+
+
+def acquire_lock(path: str) -> bool:
+    """Create `path` holding this process id, unless it already exists."""
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(os.getpid()))
+    return True
+
+
+def release_lock(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+@contextmanager
+def fetcher_busy(path: str = FETCHER_LOCK):
+    """Hold the analyzer-facing lock while data is being written, like run_update.sh."""
+    with open(path, 'w') as f:
+        f.write(str(os.getpid()))
+    try:
+        yield
+    finally:
+        release_lock(path)
+
+
+def stop_daemon(lock_path: str = UPDATE_LOCK, timeout: float = 300.0) -> bool:
+    """
+    Ask the daemon holding `lock_path` to stop (SIGTERM) and wait until it has
+    committed and released its locks. Returns True once it is gone.
+    """
+    try:
+        with open(lock_path) as f:
+            pid = int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        print("No daemon running.")
+        return True
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        print(f"Daemon {pid} is gone; removing its stale lock")
+        release_lock(lock_path)
+        return True
+    print(f"Stopping daemon {pid}...")
+    deadline = time.monotonic() + timeout
+    while os.path.exists(lock_path):
+        if time.monotonic() > deadline:
+            print(f"Daemon {pid} did not stop within {timeout:.0f}s")
+            return False
+        time.sleep(0.2)
+    print("Daemon stopped.")
+    return True
+
+
+class LiveDaemon:
+    """
+    Continuous Goldsky ingestion with the markets lookup, dictionaries, cursor and
+    HTTP sessions kept in memory (see the module docstring).
+
+    Trades whose token has no known market are held until the markets are synced and
+    the resolver is done with them. Their raw files are marked consumed when they are
+    committed, so every commit also saves the held rows next to processed/trades (see
+    WAITING_SUFFIX) and the next daemon picks them up again after a hard kill.
+
+    Bars, positions and the wallet index lag the committed trades by up to
+    `derived_seconds`. Every commit records its new trade files in DERIVED_JOURNAL,
+    and a derived flush clears it, so the next daemon feeds the files a hard kill left
+    there to those datasets before it starts. A dataset whose flush was cut short, or
+    whose journaled files were rewritten in the meantime (e.g. by compaction), is marked
+    for rebuild instead. The daemon only merges its small trade files right after a
+    flush, so journaled files stay in place.
+
+    Args:
+        poll_seconds: Pause between Goldsky polls once caught up.
+        flush_seconds: Longest time fetched trades stay uncommitted.
+        flush_rows: Buffered rows that trigger a commit before flush_seconds.
+        derived_seconds: How often bars, positions and the wallet index are flushed.
+        markets_seconds: How often update_markets runs.
+        memory_budget_mb: Approximate memory for the processed trades writer buffers.
+        resolve_missing: Look up markets of unknown tokens on gamma-api.
+        goldsky_url: Goldsky GraphQL endpoint.
+        markets_url: gamma-api markets endpoint used by update_markets.
+        resolver_url: gamma-api markets endpoint used for token lookups.
+        feed_socket: Also publish every batch of trades on this Unix socket (see
+            poly_utils.feed), or None.
+    """
+
+    def __init__(self, poll_seconds=POLL_SECONDS, flush_seconds=FLUSH_SECONDS, flush_rows=FLUSH_ROWS,
+                 derived_seconds=DERIVED_SECONDS, markets_seconds=MARKETS_SECONDS, memory_budget_mb=1024,
+                 resolve_missing=True, goldsky_url=QUERY_URL, markets_url=MARKETS_URL,
+                 resolver_url=GAMMA_MARKETS_URL, feed_socket=None):
+        self.poll_seconds = poll_seconds
+        self.flush_seconds = flush_seconds
+        self.flush_rows = flush_rows
+        self.derived_seconds = derived_seconds
+        self.markets_seconds = markets_seconds
+        self.memory_budget_mb = memory_budget_mb
+        self.resolve_missing = resolve_missing
+        self.goldsky_url = goldsky_url
+        self.markets_url = markets_url
+        self.resolver_url = resolver_url
+        self.feed_socket = feed_socket
+        self.feed = None
+        self.processed_dir = os.path.abspath('processed/trades')
+        self.raw_dir = 'goldsky/orderFilled'
+        self.stop_event = threading.Event()
+        self.rows_committed = 0
+
+    def request_stop(self, signum=None, frame=None):
+        if not self.stop_event.is_set():
+            print("🛑 Stop requested; committing and shutting down")
+        self.stop_event.set()
+
+    def run(self) -> bool:
+        """Run until stopped. Returns False if another update already holds the lock."""
+        if not acquire_lock(UPDATE_LOCK):
+            print("Update script is already running.")
+            return False
+        previous = {sig: signal.signal(sig, self.request_stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            with METRICS.stage('daemon'):
+                self._run()
+        finally:
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+            if self.feed is not None:
+                self.feed.stop()
+            release_lock(UPDATE_LOCK)
+        return True
+
+    def _start_markets_update(self) -> threading.Thread:
+        thread = threading.Thread(target=run_markets_update, args=(self.markets_url,),
+                                  name='update_markets', daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self):
+        print("=" * 60)
+        print("♾️  Live daemon")
+        print("=" * 60)
+
+        # Raw files left by earlier runs first, so the manifest only has to learn the daemon's own
+        with fetcher_busy():
+            process_live(memory_budget_mb=self.memory_budget_mb, resolve_missing=self.resolve_missing)
+
+        dictionary = TokenDictionary()
+        dictionary.sync_tokens(load_market_tokens())
+        dictionary.save()
+        self.manifest = ProcessingManifest(os.path.join(self.processed_dir, MANIFEST_FILE), raw_root=self.raw_dir)
+        self.writer, wallets, self.consumers = open_outputs(self.processed_dir, self.memory_budget_mb)
+        self.journal_path = os.path.join(self.processed_dir, DERIVED_JOURNAL)
+        with fetcher_busy():
+            self._replay_journal()
+        self._unflushed = []
+        if self.feed_socket:
+            self.feed = TradeFeed(self.feed_socket).start()
+            self.consumers.append(self.feed)
+        self.raw_writer = PartitionWriter(self.raw_dir, ['year', 'month', 'day'], prefix='orderFilled',
+                                          schema_metadata=schema_metadata(), catalog=Catalog(self.raw_dir),
+                                          event_index=EventIndex(self.raw_dir))
+        self.processed_metadata = self.writer.schema_metadata
+        resolver = BackgroundResolver(MarketResolver(url=self.resolver_url)) if self.resolve_missing else None
+        self.pipeline = TradePipeline(dictionary, self.raw_writer, self.writer, wallets, self.consumers,
+                                      self._start_markets_update(), resolver)
+        self.waiting_path = f"{os.path.realpath(self.processed_dir)}{WAITING_SUFFIX}"
+        if os.path.exists(self.waiting_path):
+            held = pl.read_parquet(self.waiting_path)
+            print(f"⏳ Picking up {held.height:,} trades the previous daemon held for their market")
+            self.pipeline.waiting = [held]
+        self._raw_recorded = 0
+        self._trades_seen = 0
+
+        pages = queue.Queue(maxsize=PAGE_QUEUE_SIZE)
+        poller = threading.Thread(target=poll_pages, name='goldsky', daemon=True,
+                                  args=(GoldskyClient(url=self.goldsky_url), get_latest_timestamp(), pages,
+                                        self.stop_event, self.poll_seconds))
+        poller.start()
+        print(f"👂 Polling Goldsky every {self.poll_seconds:g}s, committing every {self.flush_seconds:g}s")
+
+        batch, batch_rows = [], 0
+        last_commit = last_derived = last_markets = time.monotonic()
+        while not self.stop_event.is_set():
+            try:
+                page = pages.get(timeout=0.5)
+            except queue.Empty:
+                page = None
+            if page is not None:
+                raw = self.pipeline.persist(page)
+                batch.append(raw)
+                batch_rows += raw.height
+                self.last_event_ts = int(page['timestamp'][-1])
+
+            now = time.monotonic()
+            if (batch or self.pipeline.waiting) and (batch_rows >= self.flush_rows or now - last_commit >= self.flush_seconds):
+                self.commit(batch, derived=now - last_derived >= self.derived_seconds)
+                if now - last_derived >= self.derived_seconds:
+                    last_derived = now
+                batch, batch_rows = [], 0
+                last_commit = now
+            elif now - last_derived >= self.derived_seconds:
+                self.commit([], derived=True)
+                last_derived = now
+            if now - last_markets >= self.markets_seconds and not self.pipeline.markets_thread.is_alive():
+                self.pipeline.watch_markets(self._start_markets_update())
+                last_markets = now
+
+        poller.join(timeout=5)
+        # Pages fetched before the stop are committed too
+        while True:
+            try:
+                batch.append(self.pipeline.persist(pages.get_nowait()))
+            except queue.Empty:
+                break
+        self.pipeline.markets_thread.join()
+        if resolver is not None:
+            resolver.close()
+        self.commit(batch, derived=True, final=True)
+        print(f"✅ Daemon stopped after committing {self.rows_committed:,} trades")
+
+    def commit(self, batch, derived=False, final=False):
+        """
+        Process buffered pages and commit raw files, trades and the manifest (plus the
+        derived datasets with `derived`), then merge partitions crowded with small files.
+        """
+        with fetcher_busy():
+            if batch:
+                self.pipeline.process(batch)
+            self.pipeline.release_waiting(force=final)
+            self.raw_writer.close()
+            self.writer.close()
+            new_trades = self.writer.files_written[self._trades_seen:]
+            self._trades_seen = len(self.writer.files_written)
+            self._unflushed.extend(new_trades)
+            if new_trades:
+                self._save_journal()
+            self._save_waiting()
+            new_raw = self.raw_writer.files_written[self._raw_recorded:]
+            self._raw_recorded = len(self.raw_writer.files_written)
+            self.manifest.record([(os.path.relpath(os.path.dirname(p), self.raw_dir), p) for p in new_raw])
+            self.manifest.save()
+            flushed = []
+            if derived:
+                self._flush_derived()
+                flushed, self._unflushed = self._unflushed, []
+            self._merge_small_files(new_raw, flushed)
+
+        committed = self.pipeline.rows_processed - self.rows_committed
+        self.rows_committed = self.pipeline.rows_processed
+        METRICS.count('rows_processed', committed)
+        METRICS.files_written('goldsky/orderFilled', new_raw)
+        METRICS.files_written('processed/trades', new_trades)
+        if getattr(self, 'last_event_ts', None):
+            METRICS.set_gauge('live_lag_seconds', time.time() - self.last_event_ts)
+        METRICS.set_gauge('live_last_commit_timestamp_seconds', time.time())
+        METRICS.write_prometheus()
+        if committed or new_raw:
+            print(f"💾 Committed {committed:,} trades, {len(new_raw)} raw files"
+                  f"{' (derived datasets flushed)' if derived else ''}")
+
+    def _save_waiting(self):
+        """
+        Save the held-back trades before their raw files are recorded in the manifest
+        (rows released since the last save are already in the committed trades).
+        """
+        if self.pipeline.waiting:
+            tmp_path = f"{self.waiting_path}.tmp"
+            pl.concat(self.pipeline.waiting, how='vertical_relaxed').write_parquet(tmp_path)
+            os.replace(tmp_path, self.waiting_path)
+        elif os.path.exists(self.waiting_path):
+            os.remove(self.waiting_path)
+
+    def _save_journal(self, flushed=(), flushing=None):
+        save_json_state(self.journal_path, {
+            'files': [os.path.relpath(p, self.processed_dir) for p in self._unflushed],
+            'flushed': list(flushed),
+            'flushing': flushing,
+        })
+
+    def _flush_derived(self):
+        """
+        Close the consumers, recording in the journal which dataset is being published
+        and which are done, then clear the journal. A consumer that fails is marked for
+        rebuild and dropped.
+        """
+        flushed = []
+        for consumer in list(self.consumers):
+            name = type(consumer).__name__
+            durable = hasattr(consumer, 'mark_stale')
+            if durable and self._unflushed:
+                self._save_journal(flushed, flushing=name)
+            if not close_consumers([consumer]):
+                self.consumers.remove(consumer)
+            elif durable:
+                flushed.append(name)
+        self._clear_journal()
+
+    def _clear_journal(self):
+        try:
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass
+
+    def _replay_journal(self):
+        """
+        Feed the trade files a previous daemon committed but never flushed to the
+        derived datasets (see DERIVED_JOURNAL), then clear the journal.
+        """
+        journal = load_json_state(self.journal_path)
+        if not journal:
+            return
+        files = [os.path.join(self.processed_dir, f) for f in journal['files']]
+        missing = [f for f in files if not os.path.exists(f)]
+        replay = []
+        for consumer in list(self.consumers):
+            name = type(consumer).__name__
+            if name in journal['flushed']:
+                continue
+            if name == journal['flushing'] or missing:
+                consumer.mark_stale(f"the daemon stopped while flushing {name}" if name == journal['flushing']
+                                    else f"{len(missing)} unflushed trade files were rewritten")
+                self.consumers.remove(consumer)
+            else:
+                replay.append(consumer)
+        if replay:
+            print(f"🔁 Replaying {len(files)} trade files the previous daemon did not flush to "
+                  f"{', '.join(type(c).__name__ for c in replay)}")
+            for path in files:
+                trades = pl.read_parquet(path, hive_partitioning=False)
+                for consumer in replay:
+                    consumer.write(trades)
+            for consumer in replay:
+                if not close_consumers([consumer]):
+                    self.consumers.remove(consumer)
+        self._clear_journal()
+
+    def _merge_small_files(self, new_raw, new_trades):
+        """Merge the daemon's own small files in partitions it just wrote to."""
+        for files, writer, sort_by, metadata in (
+            (new_raw, self.raw_writer, 'timestamp', schema_metadata()),
+            (new_trades, self.writer, 'timestamp', self.processed_metadata),
+        ):
+            staging_dir = f"{os.path.realpath(writer.root)}.merge"
+            name_prefix = f"{writer.prefix}-{writer.run_id}"
+            for directory in sorted({os.path.dirname(p) for p in files}):
+                os.makedirs(staging_dir, exist_ok=True)
+                merged = merge_small_files(os.path.realpath(directory), staging_dir, sort_by, prefix=name_prefix,
+                                           match=name_prefix, max_small_files=LIVE_MAX_SMALL_FILES,
+                                           metadata=metadata)
+                if merged is None:
+                    continue
+                old_files = [os.path.join(directory, os.path.basename(p)) for p in merged[0]]
+                new_file = os.path.join(directory, os.path.basename(merged[1]))
+                writer.catalog.remove_files(old_files)
+                writer.catalog.add_file(new_file)
+                if writer is self.raw_writer:
+                    writer.event_index.replace_files(old_files, new_file)
+                    writer.event_index.save()
+                    key = os.path.relpath(directory, self.raw_dir)
+                    self.manifest.replace_files(key, parquet_files(directory), os.stat(directory).st_mtime_ns)
+                    self.manifest.save()
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Run the pipeline continuously with hot in-memory state")
+    parser.add_argument('--stop', action='store_true', help="Stop the running daemon cleanly and wait for it")
+    parser.add_argument('--poll-seconds', type=float, default=POLL_SECONDS)
+    parser.add_argument('--flush-seconds', type=float, default=FLUSH_SECONDS)
+    parser.add_argument('--flush-rows', type=int, default=FLUSH_ROWS)
+    parser.add_argument('--derived-seconds', type=float, default=DERIVED_SECONDS)
+    parser.add_argument('--markets-seconds', type=float, default=MARKETS_SECONDS)
+    parser.add_argument('--memory-budget-mb', type=int, default=1024)
+    parser.add_argument('--no-resolve', action='store_true', help="Leave trades of unknown tokens without a market")
+    parser.add_argument('--feed', nargs='?', const=FEED_SOCKET, metavar='SOCKET',
+                        help=f"Publish new trades as an Arrow IPC stream on a Unix socket (default {FEED_SOCKET})")
+    args = parser.parse_args()
+
+    if args.stop:
+        sys.exit(0 if stop_daemon() else 1)
+
+    daemon = LiveDaemon(poll_seconds=args.poll_seconds, flush_seconds=args.flush_seconds, flush_rows=args.flush_rows,
+                        derived_seconds=args.derived_seconds, markets_seconds=args.markets_seconds,
+                        memory_budget_mb=args.memory_budget_mb, resolve_missing=not args.no_resolve,
+                        feed_socket=args.feed)
+    sys.exit(0 if daemon.run() else 1)
@@ -0,0 +1,391 @@
+"""
+Overlapped update: markets, Goldsky scraping and trade processing run concurrently.
+
+`update_all.py` runs the three stages one after another, and process_live reads back
+from disk what scrape just had in memory. Here the stages are connected by bounded
+queues instead:
+
+- `update_markets` runs on its own thread.
+- A fetch thread pages through Goldsky into a bounded queue, so it never runs more
+  than `queue_size` pages ahead of processing.
+- The main thread persists every page to `goldsky/orderFilled` and immediately runs
+  it through get_processed_df into `processed/trades` and the derived datasets. The
+  raw files it wrote are recorded in the processing manifest, so process_live never
+  reads them again.
+- Trades of tokens with no known market are held back. Once the markets update has
+  finished and been synced, their tokens are resolved on gamma-api by a background
+  thread, and the trades are processed as soon as their markets are known (or with a
+  null market at the end of the run, like process_live).
+
+Wall time is roughly that of the slowest stage instead of the sum of all three.
+
+    python -m update_utils.pipeline
+    python update_all.py --pipelined
+"""
+import os
+import queue
+import threading
+
+import polars as pl
+
+from poly_utils.catalog import Catalog
+from poly_utils.dictionary import USDC_IDX, TokenDictionary
+from poly_utils.event_index import EventIndex
+from poly_utils.manifest import MANIFEST_FILE, ProcessingManifest
+from poly_utils.markets import load_market_tokens
+from poly_utils.metrics import METRICS
+from poly_utils.resolver import GAMMA_MARKETS_URL, MarketResolver
+from poly_utils.schema import schema_metadata
+from poly_utils.writer import PartitionWriter
+from update_utils.process_live import (
+    close_consumers, get_processed_df, open_outputs, prepare_raw, process_live, write_processed,
+)
+from update_utils.update_goldsky import QUERY_URL, GoldskyClient, get_latest_timestamp
+from update_utils.update_goldsky import add_partition_columns as add_raw_partition_columns
+from update_utils.update_markets import MARKETS_URL, update_markets
+
+# Goldsky pages the fetch thread may run ahead of processing
+PAGE_QUEUE_SIZE = 16
+
+# Most rows enriched as one batch (a batch is whatever was queued when processing got to it)
+BATCH_ROWS = 50_000
+
+_DONE = object()
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """Put on a bounded queue, giving up once `stop` is set. Returns False if it gave up."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def fetch_pages(client: GoldskyClient, start_ts, pages: queue.Queue, stop: threading.Event):
+    """
+    Fetch thread: put every Goldsky page after `start_ts` on `pages`, then _DONE. A
+    failure is put on the queue as the exception, so the consumer decides what to do.
+    """
+    try:
+        # Inclusive of start_ts: events of that second already stored are dropped by the event index
+        for df in client.iter_pages(start_ts, ''):
+            if not _put(pages, df, stop):
+                return
+    except Exception as e:
+        _put(pages, e, stop)
+        return
+    _put(pages, _DONE, stop)
+
+
+class BackgroundResolver:
+    """
+    Resolves unknown tokens on a worker thread, so neither fetching nor processing waits
+    on gamma-api. submit() queues token IDs (each one only once per run); drain()
+    returns the markets found since the previous call.
+
+    Args:
+        resolver: MarketResolver doing the lookups.
+    """
+
+    def __init__(self, resolver: MarketResolver):
+        self.resolver = resolver
+        self._requests = queue.Queue()
+        self._results = queue.Queue()
+        self._submitted = set()
+        self._thread = threading.Thread(target=self._run, name='resolver', daemon=True)
+        self._thread.start()
+
+    @property
+    def idle(self) -> bool:
+        """True when every submitted lookup has finished."""
+        return self._requests.unfinished_tasks == 0
+
+    def _run(self):
+        while True:
+            token_ids = self._requests.get()
+            try:
+                if token_ids is None:
+                    return
+                found = self.resolver.resolve(token_ids)
+                if not found.is_empty():
+                    self._results.put(found)
+            except Exception as e:
+                print(f"Market resolution failed: {e}")
+            finally:
+                self._requests.task_done()
+
+    def submit(self, token_ids):
+        new = [t for t in token_ids if t not in self._submitted]
+        if new:
+            self._submitted.update(new)
+            self._requests.put(new)
+
+    def drain(self):
+        found = []
+        while True:
+            try:
+                found.append(self._results.get_nowait())
+            except queue.Empty:
+                return found
+
+    def close(self):
+        """Wait for the queued lookups; their results are left for drain()."""
+        self._requests.put(None)
+        self._thread.join()
+
+
+class TradePipeline:
+    """
+    Main-thread half of the pipeline: persists raw pages and turns them into trades.
+
+    The token dictionary is only touched from this thread; the markets update and the
+    resolver report back through `markets_thread` and a BackgroundResolver.
+
+    Args:
+        dictionary: Token dictionary (synced from the markets snapshot).
+        raw_writer: Writer for goldsky/orderFilled.
+        writer, wallets, consumers: Processed outputs, as returned by open_outputs().
+        markets_thread: Thread running update_markets.
+        resolver: BackgroundResolver, or None to leave unknown tokens without a market.
+    """
+
+    def __init__(self, dictionary, raw_writer, writer, wallets, consumers, markets_thread, resolver=None):
+        self.dictionary = dictionary
+        self.raw_writer = raw_writer
+        self.writer = writer
+        self.wallets = wallets
+        self.consumers = consumers
+        self.markets_thread = markets_thread
+        self.resolver = resolver
+        self.markets_synced = False
+        self.waiting = []
+        self.rows_processed = 0
+        self._refresh_lookup()
+
+    def _refresh_lookup(self):
+        self.lookup = self.dictionary.lookup_frame()
+        self.known = self.lookup.filter(pl.col('market_id').is_not_null())['asset_idx']
+
+    def sync_markets(self):
+        """Pick up markets from a finished markets update and from the resolver."""
+        changed = False
+        if not self.markets_synced and not self.markets_thread.is_alive():
+            self.markets_synced = True
+            changed = self.dictionary.sync_tokens(load_market_tokens()) > 0
+        if self.resolver is not None:
+            for found in self.resolver.drain():
+                changed = self.dictionary.sync_markets(found) > 0 or changed
+        if changed:
+            self.dictionary.save()
+            self._refresh_lookup()
+
+    def persist(self, page: pl.DataFrame) -> pl.DataFrame:
+        """
+        Encode one Goldsky page to the raw schema and buffer it in the raw writer.
+        Returns the events that were not stored yet.
+        """
+        return self.raw_writer.write(add_raw_partition_columns(page.unique(), self.dictionary))
+
+    def _split(self, raw: pl.DataFrame):
+        """(trades whose market is known, the rest)."""
+        raw = raw.with_columns(
+            pl.when(pl.col('makerAssetIdx') != USDC_IDX)
+            .then(pl.col('makerAssetIdx'))
+            .otherwise(pl.col('takerAssetIdx'))
+            .is_in(self.known)
+            .alias('_known')
+        )
+        return raw.filter(pl.col('_known')).drop('_known'), raw.filter(~pl.col('_known')).drop('_known')
+
+    def _request_markets(self, raw: pl.DataFrame):
+        asset_idx = raw.select(
+            pl.when(pl.col('makerAssetIdx') != USDC_IDX)
+            .then(pl.col('makerAssetIdx'))
+            .otherwise(pl.col('takerAssetIdx'))
+            .unique()
+        ).to_series()
+        token_ids = self.dictionary.frame.filter(pl.col('idx').is_in(asset_idx))['token_id']
+        self.resolver.submit(token_ids.to_list())
+
+    def _process(self, raw: pl.DataFrame):
+        trades = get_processed_df(prepare_raw(raw), self.lookup)
+        if not trades.is_empty():
+            self.rows_processed += write_processed(trades, self.writer, self.wallets, self.consumers)
+
+    def process(self, frames):
+        """
+        Enrich persisted raw pages into trades. Trades of tokens without a market wait
+        until the markets update has been synced and the resolver had a go at them.
+        """
+        self.sync_markets()
+        frames = self.waiting + frames
+        if not frames:
+            return
+        ready, waiting = self._split(pl.concat(frames, how='vertical_relaxed'))
+        self.waiting = [waiting] if not waiting.is_empty() else []
+        if self.waiting and self.markets_synced and self.resolver is not None:
+            self._request_markets(waiting)
+        if not ready.is_empty():
+            self._process(ready)
+
+    def watch_markets(self, markets_thread):
+        """Sync the markets of another markets update once `markets_thread` finishes."""
+        self.markets_thread = markets_thread
+        self.markets_synced = False
+
+    def release_waiting(self, force=False):
+        """
+        Process held-back trades once nothing more can be learned about their markets:
+        the markets update is synced and the resolver has finished every lookup (or
+        `force`). Tokens nobody knows a market for yet are written with a null market_id.
+        """
+        if not self.waiting:
+            return
+        self.process([])
+        if not self.waiting:
+            return
+        if not force and (not self.markets_synced or (self.resolver is not None and not self.resolver.idle)):
+            return
+        self._process(pl.concat(self.waiting, how='vertical_relaxed'))
+        self.waiting = []
+
+    def finish(self):
+        """Wait for the markets update and the resolver, then process every held-back trade."""
+        self.markets_thread.join()
+        self.process([])
+        if self.resolver is not None:
+            self.resolver.close()
+        self.release_waiting(force=True)
+
+
+def run_markets_update(base_url: str = MARKETS_URL):
+    """update_markets for a background thread: errors are reported, not raised."""
+    try:
+        update_markets(base_url=base_url)
+    except Exception as e:
+        print(f"Error updating markets: {e}")
+
+
+@METRICS.stage('pipeline')
+def run_pipeline(batch_rows=BATCH_ROWS, queue_size=PAGE_QUEUE_SIZE, memory_budget_mb=1024,
+                 resolve_missing=True, goldsky_url=QUERY_URL, markets_url=MARKETS_URL,
+                 resolver_url=GAMMA_MARKETS_URL):
+    """
+    Update markets, scrape Goldsky and process the new trades as one overlapped run.
+
+    Args:
+        batch_rows: Most rows enriched at once; smaller batches are processed whenever
+            processing has caught up with the fetch thread.
+        queue_size: Goldsky pages the fetch thread may run ahead.
+        memory_budget_mb: Approximate memory for the processed trades writer buffers.
+        resolve_missing: Look up markets for tokens still unknown after the markets
+            update on gamma-api, instead of leaving market_id null.
+        goldsky_url: Goldsky GraphQL endpoint.
+        markets_url: gamma-api markets endpoint used by update_markets.
+        resolver_url: gamma-api markets endpoint used for token lookups.
+    """
+    processed_dir = os.path.abspath('processed/trades')
+    raw_dir = 'goldsky/orderFilled'
+    print("=" * 60)
+    print("🔀 Pipelined update: markets | goldsky | processing")
+    print("=" * 60)
+
+    stop = threading.Event()
+    markets_thread = threading.Thread(target=run_markets_update, args=(markets_url,), name='update_markets', daemon=True)
+    markets_thread.start()
+
+    client = GoldskyClient(url=goldsky_url)
+    pages = queue.Queue(maxsize=queue_size)
+    fetcher = threading.Thread(target=fetch_pages, args=(client, get_latest_timestamp(), pages, stop),
+                               name='goldsky', daemon=True)
+    fetcher.start()
+
+    try:
+        # Raw files left over from earlier runs are processed first (the fetch thread
+        # fills the queue meanwhile), so the manifest only has to learn about this run's files
+        process_live(memory_budget_mb=memory_budget_mb, resolve_missing=resolve_missing)
+
+        dictionary = TokenDictionary()
+        dictionary.sync_tokens(load_market_tokens())
+        dictionary.save()
+        manifest = ProcessingManifest(os.path.join(processed_dir, MANIFEST_FILE), raw_root=raw_dir)
+        writer, wallets, consumers = open_outputs(processed_dir, memory_budget_mb)
+        raw_writer = PartitionWriter(raw_dir, ['year', 'month', 'day'], prefix='orderFilled',
+                                     schema_metadata=schema_metadata(), catalog=Catalog(raw_dir),
+                                     event_index=EventIndex(raw_dir))
+        resolver = BackgroundResolver(MarketResolver(url=resolver_url)) if resolve_missing else None
+        pipeline = TradePipeline(dictionary, raw_writer, writer, wallets, consumers, markets_thread, resolver)
+
+        fetched = 0
+        try:
+            done = False
+            while not done:
+                # Everything queued meanwhile is enriched as one batch: batches stay small
+                # while processing keeps up with the fetch thread and grow when it falls behind
+                batch, batch_size = [], 0
+                item = pages.get()
+                while True:
+                    if item is _DONE:
+                        done = True
+                        break
+                    if isinstance(item, Exception):
+                        # Like update_goldsky: keep (and process) what was fetched before the error
+                        print(f"Error scraping orderFilledEvents: {item}")
+                        done = True
+                        break
+                    raw = pipeline.persist(item)
+                    fetched += raw.height
+                    batch.append(raw)
+                    batch_size += raw.height
+                    if batch_size >= batch_rows:
+                        break
+                    try:
+                        item = pages.get_nowait()
+                    except queue.Empty:
+                        break
+                if batch:
+                    pipeline.process(batch)
+                    print(f"✓ Fetched {fetched:,} events, processed {pipeline.rows_processed:,} trades "
+                          f"({pages.qsize()} pages queued, {sum(w.height for w in pipeline.waiting):,} "
+                          f"waiting for markets)")
+            pipeline.finish()
+        except BaseException:
+            # Fetched pages are kept, as by scrape(); the next run processes them
+            raw_writer.close()
+            writer.abort()
+            raise
+    finally:
+        stop.set()
+
+    # Trades and the manifest entries of their raw files first, then the derived
+    # datasets (as in the daemon's commit), so no trade is ever committed twice
+    raw_writer.close()
+    writer.close()
+    manifest.record([(os.path.relpath(os.path.dirname(path), raw_dir), path) for path in raw_writer.files_written])
+    manifest.save()
+    close_consumers(consumers)
+
+    METRICS.count('rows_processed', pipeline.rows_processed)
+    METRICS.count('duplicate_events_dropped', raw_writer.event_index.duplicates_dropped)
+    METRICS.files_written('goldsky/orderFilled', raw_writer.files_written)
+    METRICS.files_written('processed/trades', writer.files_written)
+    print(f"\n💾 Wrote {len(raw_writer.files_written)} raw and {len(writer.files_written)} processed files")
+    print(f"✅ Fetched {fetched:,} events, processed {pipeline.rows_processed:,} new trades")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Update markets, scrape Goldsky and process trades concurrently")
+    parser.add_argument('--batch-rows', type=int, default=BATCH_ROWS)
+    parser.add_argument('--queue-size', type=int, default=PAGE_QUEUE_SIZE)
+    parser.add_argument('--memory-budget-mb', type=int, default=1024)
+    parser.add_argument('--no-resolve', action='store_true', help="Leave trades of unknown tokens without a market")
+    args = parser.parse_args()
+
+    run_pipeline(batch_rows=args.batch_rows, queue_size=args.queue_size, memory_budget_mb=args.memory_budget_mb,
+                 resolve_missing=not args.no_resolve)
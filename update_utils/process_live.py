@@ -7,191 +7,444 @@ import datetime
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
 import polars as pl
-from poly_utils.utils import get_markets, update_missing_tokens
-
-def get_processed_df(df, markets_long):
-
-    # 2) Identify the non-USDC asset for each trade (the one that isn't 0)
+from poly_utils.utils import partition_dirs, stream_batches
+from poly_utils.bars import BarWriter, bars_initialized, mark_bars_initialized
+from poly_utils.catalog import Catalog
+from poly_utils.markets import load_market_tokens
+from poly_utils.positions import PositionWriter, mark_positions_initialized, positions_initialized
+from poly_utils.wallet_index import WalletTradeWriter, mark_wallet_index_initialized, wallet_index_initialized
+from poly_utils.resolver import MarketResolver
+from poly_utils.dictionary import USDC_IDX, TokenDictionary, WalletDictionary, encode_raw, encode_wallets
+from poly_utils.manifest import MANIFEST_FILE, ProcessingManifest
+from poly_utils.metrics import METRICS
+from poly_utils.schema import (
+    DIRECTION, PROCESSED_SCHEMA, PROCESSED_SCHEMA_VERSION, conform_processed, dataset_version, is_canonical_dataset,
+    mark_canonical, scan_raw, schema_metadata,
+)
+from poly_utils.writer import PartitionWriter
+
+def get_processed_df(df, token_lookup):
+
+    # 2) Identify the non-USDC asset for each trade (the one that isn't USDC_IDX)
     df = df.with_columns(
-        pl.when(pl.col("makerAssetId") != "0")
-        .then(pl.col("makerAssetId"))
-        .otherwise(pl.col("takerAssetId"))
-        .alias("nonusdc_asset_id")
+        pl.when(pl.col("makerAssetIdx") != USDC_IDX)
+        .then(pl.col("makerAssetIdx"))
+        .otherwise(pl.col("takerAssetIdx"))
+        .alias("nonusdc_asset_idx")
     )
 
-    # 3) Join once on that non-USDC asset to recover the market + side ("token1" or "token2")
+    # 3) Integer join on that asset's dictionary index to recover the market + side ("token1" or "token2")
     df = df.join(
-        markets_long,
-        left_on="nonusdc_asset_id",
-        right_on="asset_id",
+        token_lookup,
+        left_on="nonusdc_asset_idx",
+        right_on="asset_idx",
         how="left",
     )
 
-    # 4) label columns and keep market_id
-    df = df.with_columns([
-        pl.when(pl.col("makerAssetId") == "0").then(pl.lit("USDC")).otherwise(pl.col("side")).alias("makerAsset"),
-        pl.when(pl.col("takerAssetId") == "0").then(pl.lit("USDC")).otherwise(pl.col("side")).alias("takerAsset"),
-        pl.col("market_id"),
-    ])
-
-    df = df.select(['timestamp', 'market_id', 'maker', 'makerAsset', 'makerAmountFilled', 'taker', 'takerAsset', 'takerAmountFilled', 'transactionHash'])
-
+    # 4) The taker buys outcome tokens when it pays USDC; the maker takes the other side.
+    # Directions and side come out as Enums and amounts stay exact integer micro-units
+    # (processed schema v3); write_processed converts for datasets not migrated yet
+    taker_pays_usdc = pl.col("takerAssetIdx") == USDC_IDX
     df = df.with_columns([
-        (pl.col("makerAmountFilled") / 10**6).alias("makerAmountFilled"),
-        (pl.col("takerAmountFilled") / 10**6).alias("takerAmountFilled"),
-    ])
-
-    df = df.with_columns([
-        pl.when(pl.col("takerAsset") == "USDC")
-        .then(pl.lit("BUY"))
-        .otherwise(pl.lit("SELL"))
-        .alias("taker_direction"),
+        pl.col("timestamp").cast(PROCESSED_SCHEMA['timestamp']),
+        pl.col("side").alias("nonusdc_side"),
 
-        # reverse of taker_direction
-        pl.when(pl.col("takerAsset") == "USDC")
+        pl.when(taker_pays_usdc)
         .then(pl.lit("SELL"))
         .otherwise(pl.lit("BUY"))
+        .cast(DIRECTION)
         .alias("maker_direction"),
-    ])
-
-    df = df.with_columns([
-        pl.when(pl.col("makerAsset") != "USDC")
-        .then(pl.col("makerAsset"))
-        .otherwise(pl.col("takerAsset"))
-        .alias("nonusdc_side"),
 
-        pl.when(pl.col("takerAsset") == "USDC")
-        .then(pl.col("takerAmountFilled"))
-        .otherwise(pl.col("makerAmountFilled"))
-        .alias("usd_amount"),
+        pl.when(taker_pays_usdc)
+        .then(pl.lit("BUY"))
+        .otherwise(pl.lit("SELL"))
+        .cast(DIRECTION)
+        .alias("taker_direction"),
 
-        pl.when(pl.col("takerAsset") != "USDC")
+        pl.when(taker_pays_usdc)
         .then(pl.col("takerAmountFilled"))
         .otherwise(pl.col("makerAmountFilled"))
-        .alias("token_amount"),
+        .alias("usd_amount_e6"),
 
-        pl.when(pl.col("takerAsset") == "USDC")
-        .then(pl.col("takerAmountFilled") / pl.col("makerAmountFilled"))
-        .otherwise(pl.col("makerAmountFilled") / pl.col("takerAmountFilled"))
-        .cast(pl.Float64)
-        .alias("price")
+        pl.when(taker_pays_usdc)
+        .then(pl.col("makerAmountFilled"))
+        .otherwise(pl.col("takerAmountFilled"))
+        .alias("token_amount_e6"),
     ])
 
-    df = df.select(['timestamp', 'market_id', 'maker', 'taker', 'nonusdc_side', 'maker_direction', 'taker_direction', 'price', 'usd_amount', 'token_amount', 'transactionHash'])
+    df = df.select(['timestamp', 'market_id', 'maker', 'taker', 'nonusdc_side', 'maker_direction', 'taker_direction', 'usd_amount_e6', 'token_amount_e6', 'transactionHash'])
     return df
 
-def process_live():
-    processed_dir = os.path.abspath('processed/trades')
-    print("=" * 60)
-    print("🔄 Processing Live Trades")
-    print("=" * 60)
+FILE_CHUNK_SIZE = 10  # Process 10 files at a time to keep memory low
 
-    last_processed_timestamp = 0
-    if os.path.exists(processed_dir):
-        print(f"✓ Found existing processed directory: {processed_dir}")
-        try:
-            # Scan for the max timestamp in the *output* directory
-            latest_output_ts = pl.scan_parquet(f"{processed_dir}/**/*.parquet").select(pl.max('timestamp')).collect().item()
-            if latest_output_ts:
-                # Convert polars datetime to python datetime if necessary
-                if isinstance(latest_output_ts, datetime.datetime):
-                    last_processed_timestamp = latest_output_ts
-                else:
-                    # Assuming it's already a suitable datetime object or parsable string
-                    last_processed_timestamp = pl.from_epoch(latest_output_ts, time_unit='us')
+# Rough in-memory size of one processed trade row, used to size streaming batches
+PROCESSED_ROW_BYTES = 400
 
-                print(f"📍 Resuming from after: {last_processed_timestamp}")
-        except Exception as e:
-            print(f"Could not read last processed timestamp, processing from beginning: {e}")
+def scan_encoded(files, dictionary, raw_is_canonical):
+    """Scan raw files with asset indices; files from before raw schema v2 are encoded on the fly."""
+    if raw_is_canonical:
+        return scan_raw(files, canonical=True)
+    return encode_raw(scan_raw(files), dictionary, assign=False)
 
-    import glob
-    print(f"\n📂 Reading: goldsky/orderFilled")
-    all_files = sorted(glob.glob("goldsky/orderFilled/**/*.parquet", recursive=True))
+def register_raw_tokens(files, dictionary):
+    """Give every asset ID in pre-v2 raw files a dictionary index, so they can be encoded lazily."""
+    tokens = (
+        scan_raw(files)
+        .select(pl.concat([pl.col('makerAssetId'), pl.col('takerAssetId')]).unique().alias('token_id'))
+        .collect()
+    )
+    if dictionary.add(tokens['token_id']):
+        dictionary.save()
+
+def nonusdc_asset_idx(frame):
+    """Distinct non-USDC asset index of each trade in a raw frame (what get_processed_df joins on)."""
+    return frame.select(
+        pl.when(pl.col("makerAssetIdx") != USDC_IDX)
+        .then(pl.col("makerAssetIdx"))
+        .otherwise(pl.col("takerAssetIdx"))
+        .unique()
+        .alias("asset_idx")
+    )
 
-    if not all_files:
-        print("No orderFilled parquet files found. Exiting.")
-        return
+def resolve_unknown_tokens(asset_idx, dictionary, resolver):
+    """
+    Look up markets for assets the dictionary has no market for, and sync what the
+    resolver finds. Returns True if the dictionary changed.
+    """
+    unknown = dictionary.frame.filter(
+        pl.col('idx').is_in(asset_idx.drop_nulls())
+        & (pl.col('idx') != USDC_IDX)
+        & pl.col('market_id').is_null()
+    )['token_id']
+    if unknown.is_empty():
+        return False
+    resolved = resolver.resolve(unknown.to_list())
+    if resolved.is_empty():
+        return False
+    dictionary.sync_markets(resolved)
+    dictionary.save()
+    return True
+
+def prepare_raw(lf, last_processed_timestamp=None):
+    """Convert raw epoch seconds to datetimes and drop rows at or before the watermark."""
+    lf = lf.with_columns(
+        pl.from_epoch(pl.col('timestamp'), time_unit='s').alias('timestamp')
+    )
+    if last_processed_timestamp:
+        lf = lf.filter(pl.col('timestamp') > last_processed_timestamp)
+    return lf
+
+def add_partition_columns(df):
+    """Add year/month for partitioning."""
+    return df.with_columns([
+        pl.col('timestamp').dt.year().alias('year'),
+        pl.col('timestamp').dt.month().alias('month'),
+    ])
 
-    FILE_CHUNK_SIZE = 10  # Process 10 files at a time to keep memory low
+def write_processed(df, writer, wallets=None, consumers=(), partitioned=False):
+    """
+    Buffer processed trades in the trades writer and hand them to each of `consumers`.
+    With `wallets`, the batch is converted to wallet ids and binary hashes, and it is
+    cast to the schema version of the writer's files, once, before any of them sees it.
+    Adds the year/month partition columns unless `partitioned`. Returns the number of rows.
+    """
+    if not partitioned:
+        df = add_partition_columns(df)
+    if wallets is not None:
+        df = encode_wallets(df, wallets)
+    df = conform_processed(df, writer.schema_version)
+    for consumer in consumers:
+        consumer.write(df)
+    writer.write(df)
+    return df.height
+
+def close_consumers(consumers):
+    """
+    Close each of `consumers` (commit its derived dataset) once the trades it was fed and
+    the manifest are committed. Those trades will never be fed to it again, so a
+    consumer that fails is marked for rebuild instead of failing the run. Returns the
+    consumers that closed cleanly.
+    """
+    closed = []
+    for consumer in consumers:
+        try:
+            consumer.close()
+            closed.append(consumer)
+        except Exception as e:
+            print(f"❌ Could not update {type(consumer).__name__}: {e}")
+            if hasattr(consumer, 'mark_stale'):
+                consumer.mark_stale(f"{type(e).__name__}: {e}")
+    return closed
+
+def process_streaming(files, dictionary, writer, raw_is_canonical, last_processed_timestamp=None,
+                      memory_budget_mb=1024, wallets=None, resolver=None, consumers=()):
+    """
+    Process raw files as one lazy query on the streaming engine.
+
+    Cast, watermark filter, the `nonusdc_asset_idx` join against the token dictionary and the
+    price/amount derivation all run inside a single plan, and the result is pulled in
+    batches sized from `memory_budget_mb` straight into the partition writer. With
+    `wallets`, each batch is converted to wallet ids and binary hashes on the way.
+    With a `resolver`, unknown tokens in all files are resolved before the query runs.
+    Every batch is also passed to each of `consumers` (objects with write(df)).
+
+    Returns the number of rows written.
+    """
+    lf = prepare_raw(scan_encoded(files, dictionary, raw_is_canonical), last_processed_timestamp)
+    if resolver is not None:
+        resolve_unknown_tokens(nonusdc_asset_idx(lf).collect()['asset_idx'], dictionary, resolver)
+    lf = add_partition_columns(get_processed_df(lf, dictionary.lookup_frame().lazy()))
+    METRICS.record_plan('process_live_streaming', lf)
+
+    # Half the budget for in-flight batches, half for the writer's buffers
+    batch_rows = max(10_000, memory_budget_mb * 2**20 // 2 // PROCESSED_ROW_BYTES)
+    total_rows = 0
+    for batch in stream_batches(lf, batch_rows):
+        total_rows += write_processed(batch, writer, wallets, consumers, partitioned=True)
+        print(f"✓ Streamed {total_rows:,} rows")
+    return total_rows
+
+def process_chunks(pending, dictionary, writer, raw_is_canonical, last_processed_timestamp=None,
+                   wallets=None, resolver=None, consumers=()):
+    """
+    Process (partition, path) raw files in chunks of FILE_CHUNK_SIZE, collecting each chunk.
+    With `wallets`, output is converted to wallet ids and binary hashes. With a
+    `resolver`, each chunk's unknown tokens are resolved before it is enriched. Every
+    processed chunk is also passed to each of `consumers` (objects with write(df)).
+
+    Returns (rows written, files consumed).
+    """
     total_processed_rows = 0
+    consumed = []
+    token_lookup = dictionary.lookup_frame()
 
-    print("\n🚀 Loading markets data once...")
-    markets_df = get_markets()
-    markets_df = markets_df.rename({'id': 'market_id'})
-    markets_long = (
-        markets_df
-        .select(["market_id", "token1", "token2"])
-        .melt(id_vars="market_id", value_vars=["token1", "token2"],
-            variable_name="side", value_name="asset_id")
-    )
-    print("✅ Markets data loaded and prepared.")
-
-    for i in range(0, len(all_files), FILE_CHUNK_SIZE):
-        file_chunk = all_files[i:i + FILE_CHUNK_SIZE]
-        print(f"\n--- Processing file chunk {i//FILE_CHUNK_SIZE + 1} of {len(all_files)//FILE_CHUNK_SIZE + 1} ---")
-
-        lazy_frames = []
-        for file_path in file_chunk:
-            try:
-                lf = pl.scan_parquet(file_path).with_columns([
-                    pl.col("timestamp").cast(pl.Int64),
-                    pl.col("takerAssetId").cast(pl.Utf8),
-                    pl.col("makerAssetId").cast(pl.Utf8),
-                    pl.col("makerAmountFilled").cast(pl.Int64),
-                    pl.col("takerAmountFilled").cast(pl.Int64),
-                ])
-                lazy_frames.append(lf)
-            except Exception as e:
-                print(f"Could not process file {file_path}: {e}")
-                continue
-
-        if not lazy_frames:
-            continue
+    for i in range(0, len(pending), FILE_CHUNK_SIZE):
+        chunk = pending[i:i + FILE_CHUNK_SIZE]
+        file_chunk = [path for _, path in chunk]
+        print(f"\n--- Processing file chunk {i//FILE_CHUNK_SIZE + 1} of {(len(pending) - 1)//FILE_CHUNK_SIZE + 1} ---")
 
-        chunk_df_lazy = pl.concat(lazy_frames)
+        try:
+            chunk_df_lazy = scan_encoded(file_chunk, dictionary, raw_is_canonical)
+        except Exception as e:
+            print(f"Could not scan file chunk: {e}")
+            continue
         
         # Convert timestamp and filter
-        chunk_df_lazy = chunk_df_lazy.with_columns(
-            pl.from_epoch(pl.col('timestamp'), time_unit='s').alias('timestamp')
-        )
-        if last_processed_timestamp:
-            chunk_df_lazy = chunk_df_lazy.filter(pl.col('timestamp') > last_processed_timestamp)
+        chunk_df_lazy = prepare_raw(chunk_df_lazy, last_processed_timestamp)
+        if i == 0:
+            METRICS.record_plan('process_live_chunk', chunk_df_lazy)
 
         # Collect only the small, filtered chunk
         collected_chunk = chunk_df_lazy.collect()
+        consumed.extend(chunk)
         if collected_chunk.is_empty():
             print("No new rows in this chunk.")
             continue
             
         print(f"📦 Processing batch of {len(collected_chunk):,} rows...")
+
+        if resolver is not None:
+            if resolve_unknown_tokens(nonusdc_asset_idx(collected_chunk)['asset_idx'], dictionary, resolver):
+                token_lookup = dictionary.lookup_frame()
         
         # Get the fully processed dataframe
-        new_df = get_processed_df(collected_chunk, markets_long)
+        new_df = get_processed_df(collected_chunk, token_lookup)
         if new_df.is_empty():
             print("No processable trades in this chunk after joining with markets.")
             continue
 
-        # Add year/month for partitioning
-        new_df = new_df.with_columns([
-            pl.col('timestamp').dt.year().alias('year'),
-            pl.col('timestamp').dt.month().alias('month'),
-        ])
-        
-        # Manually partition and write the chunk to avoid pyarrow issues
-        for (year, month), group in new_df.group_by(['year', 'month'], maintain_order=True):
-            partition_dir = os.path.join(processed_dir, f"year={year}", f"month={month}")
-            os.makedirs(partition_dir, exist_ok=True)
-            file_path = os.path.join(partition_dir, f"trades_chunk_{i//FILE_CHUNK_SIZE}.parquet")
-            group.write_parquet(file_path)
+        write_processed(new_df, writer, wallets, consumers)
 
         print(f"✓ Appended {len(new_df):,} rows")
         total_processed_rows += len(new_df)
 
+    return total_processed_rows, consumed
+
+def open_outputs(processed_dir, memory_budget_mb=1024):
+    """
+    Open the processed trades writer and the derived-dataset consumers fed from it.
+
+    Returns (writer, wallets, consumers): `wallets` is the wallet dictionary to encode
+    trades with, or None while processed/trades still stores string addresses.
+    """
+    # New datasets start in the current schema (wallet ids, binary hashes, typed
+    # columns); an existing one keeps the schema its files have until
+    # `python -m poly_utils.migrate processed` ran, so every file under
+    # processed/trades always shares one schema
+    if not os.path.isdir(processed_dir) or not partition_dirs(processed_dir, 1):
+        mark_canonical(processed_dir, PROCESSED_SCHEMA_VERSION)
+        # Derived datasets built alongside an empty dataset cover its whole history
+        mark_bars_initialized()
+        mark_positions_initialized()
+        mark_wallet_index_initialized()
+    version = dataset_version(processed_dir)
+    wallets = None
+    if version is None:
+        print("⚠️  processed/trades not migrated; writing maker/taker as strings "
+              "(run `python -m poly_utils.migrate processed`)")
+    else:
+        wallets = WalletDictionary()
+        print(f"👛 Writing processed schema v{version} ({len(wallets):,} known wallets)")
+    if version is not None and version < PROCESSED_SCHEMA_VERSION:
+        print(f"⚠️  processed/trades is at schema v{version}; run `python -m poly_utils.migrate processed` "
+              f"to convert it to v{PROCESSED_SCHEMA_VERSION}")
+
+    # Buffer output across chunks so each month gets a few large, run-unique files.
+    # Files are committed together on close, right before the manifest is saved, so a
+    # crash mid-run leaves neither output nor manifest entries behind (a crash between
+    # the two is the only window in which trades can be committed twice).
+    writer = PartitionWriter(processed_dir, ['year', 'month'], prefix='trades',
+                             keep_partition_cols=True, defer_commit=True,
+                             memory_budget=memory_budget_mb * 2**20 // 2,
+                             schema_metadata=schema_metadata(version) if version is not None else None,
+                             catalog=Catalog(processed_dir, stats_column='timestamp'))
+
+    # OHLCV bars, wallet positions and the wallet index are updated from the same
+    # batches once they cover the full history
+    consumers = []
+    if bars_initialized():
+        consumers.append(BarWriter())
+    else:
+        print("⚠️  Bars not built yet; skipping bar updates (run `python -m update_utils.update_bars --rebuild`)")
+    # Consumers share the trades writer's wallet dictionary so all assign the same ids
+    consumer_wallets = wallets if wallets is not None else WalletDictionary()
+    if positions_initialized():
+        consumers.append(PositionWriter(wallets=consumer_wallets))
+    else:
+        print("⚠️  Positions not built yet; skipping position updates "
+              "(run `python -m update_utils.update_positions --rebuild`)")
+    if wallet_index_initialized():
+        consumers.append(WalletTradeWriter(wallets=consumer_wallets))
+    else:
+        print("⚠️  Wallet index not built yet (or built with an older schema); skipping wallet index updates "
+              "(run `python -m update_utils.update_wallet_index --rebuild`)")
+
+    return writer, wallets, consumers
+
+@METRICS.stage('process_live')
+def process_live(streaming=False, memory_budget_mb=1024, resolve_missing=True):
+    """
+    Process new raw orderFilled files into processed/trades.
+
+    Args:
+        streaming: Run the whole transform as one lazy streaming query instead of
+            collecting 10-file chunks.
+        memory_budget_mb: Approximate peak memory for streaming batches and write buffers.
+        resolve_missing: Look up markets for tokens that are not in the markets snapshot
+            on gamma-api before enriching trades, instead of leaving market_id null.
+    """
+    processed_dir = os.path.abspath('processed/trades')
+    raw_dir = 'goldsky/orderFilled'
+    print("=" * 60)
+    print("🔄 Processing Live Trades")
+    print("=" * 60)
+
+    # The manifest records which raw files were already consumed, so each run only
+    # opens new input instead of rescanning the whole history
+    manifest = ProcessingManifest(os.path.join(processed_dir, MANIFEST_FILE), raw_root=raw_dir)
+
+    last_processed_timestamp = 0
+    if manifest.is_empty and os.path.exists(processed_dir):
+        print(f"✓ Found existing processed directory without a manifest: {processed_dir}")
+        try:
+            # Max timestamp in the *output* directory (one-time bootstrap), from the
+            # catalog when one is complete, else by scanning the output
+            catalog = Catalog(processed_dir, stats_column='timestamp')
+            if catalog.complete and catalog.latest_watermark():
+                latest_output_ts = datetime.datetime.fromisoformat(catalog.latest_watermark())
+            else:
+                latest_output_ts = pl.scan_parquet(f"{processed_dir}/**/*.parquet").select(pl.max('timestamp')).collect().item()
+            if latest_output_ts:
+                # Convert polars datetime to python datetime if necessary
+                if isinstance(latest_output_ts, datetime.datetime):
+                    last_processed_timestamp = latest_output_ts
+                else:
+                    # Assuming it's already a suitable datetime object or parsable string
+                    last_processed_timestamp = pl.from_epoch(latest_output_ts, time_unit='us')
+
+                print(f"📍 Resuming from after: {last_processed_timestamp}")
+                # Raw partitions from before the watermark day were consumed by earlier runs
+                manifest.bootstrap(before=last_processed_timestamp.date())
+        except Exception as e:
+            print(f"Could not read last processed timestamp, processing from beginning: {e}")
+
+    print(f"\n📂 Reading: {raw_dir}")
+    pending = manifest.pending_files()
+
+    if not pending:
+        print("No new orderFilled parquet files found. Exiting.")
+        manifest.save()
+        return
+    print(f"📄 {len(pending):,} new raw files")
+
+    # Once migrated, all raw files share one schema and can be read with a single scan
+    raw_is_canonical = is_canonical_dataset(raw_dir)
+    if not raw_is_canonical:
+        print("⚠️  Raw files not migrated to the canonical schema; casting file by file "
+              "(run `python -m poly_utils.migrate raw`)")
+
+    print("\n🚀 Loading markets data once...")
+    # Trades are enriched through the token dictionary: asset indices -> market + side,
+    # synced from the token lookup of the memory-mapped markets snapshot
+    dictionary = TokenDictionary()
+    updated = dictionary.sync_tokens(load_market_tokens())
+    dictionary.save()
+    print(f"✅ Markets data loaded and prepared ({len(dictionary):,} tokens, {updated:,} added or updated).")
+
+    if not raw_is_canonical:
+        register_raw_tokens([path for _, path in pending], dictionary)
+    resolver = MarketResolver() if resolve_missing else None
+
+    writer, wallets, consumers = open_outputs(processed_dir, memory_budget_mb)
+
+    try:
+        if streaming:
+            print(f"\n🌊 Streaming {len(pending):,} files (memory budget {memory_budget_mb} MB)...")
+            total_processed_rows = process_streaming(
+                [path for _, path in pending], dictionary, writer, raw_is_canonical,
+                last_processed_timestamp, memory_budget_mb, wallets, resolver, consumers
+            )
+            consumed = pending
+
+        else:
+            total_processed_rows, consumed = process_chunks(
+                pending, dictionary, writer, raw_is_canonical, last_processed_timestamp, wallets, resolver,
+                consumers
+            )
+    except BaseException:
+        # Nothing of a failed run is committed, and no raw file is marked consumed
+        writer.abort()
+        raise
+
+    # Trades first, then the manifest that marks their raw files consumed, and only
+    # then the derived datasets, so no trade is ever committed twice
+    writer.close()
+    manifest.record(consumed)
+    manifest.save()
+    close_consumers(consumers)
+    METRICS.count('raw_files_consumed', len(consumed))
+    METRICS.count('rows_processed', total_processed_rows)
+    METRICS.files_written('processed/trades', writer.files_written)
+    print(f"\n💾 Wrote {len(writer.files_written)} files, consumed {len(consumed):,} raw files")
     print(f"\n✅ Total processed: {total_processed_rows:,} new rows")
     print("=" * 60)
     print("✅ Processing complete!")
     print("=" * 60)
 
 if __name__ == "__main__":
-    process_live()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Process raw orderFilled events into trades")
+    parser.add_argument('--streaming', action='store_true', help="Run as one lazy streaming query")
+    parser.add_argument('--memory-budget-mb', type=int, default=1024)
+    parser.add_argument('--no-resolve', action='store_true', help="Leave trades of unknown tokens without a market")
+    parser.add_argument('--profile', action='store_true',
+                        help="Write cProfile stats and the Polars query plans to the metrics directory")
+    args = parser.parse_args()
+
+    from contextlib import nullcontext
+
+    with METRICS.profile('process_live') if args.profile else nullcontext():
+        process_live(streaming=args.streaming, memory_budget_mb=args.memory_budget_mb,
+                     resolve_missing=not args.no_resolve)
 
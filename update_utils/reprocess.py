@@ -0,0 +1,362 @@
+"""
+Partition-parallel rebuild of `processed/trades` from the raw goldsky history.
+
+process_live only ever appends trades for raw files it has not consumed yet. After
+get_processed_df changes, or once markets for previously unknown tokens are known
+(missing_markets.parquet), the affected months have to be rebuilt. This module does
+that on every core:
+
+- the raw `year=/month=/day=` partitions of the requested months are split into
+  tasks, one per day (or per month with `by='month'`), largest first;
+- a first pass over a process pool collects the wallet addresses, unknown tokens and
+  trade count of every task, and the addresses and tokens are added to the
+  dictionaries (and resolved on gamma-api) here, in one process;
+- a second pass enriches each task in a worker that loaded the token lookup and the
+  wallet dictionary once, and writes its trades to a staging tree next to
+  `processed/trades`;
+- as soon as every task of a month is done, the staged month is swapped in with
+  exchange_dirs, and the catalog and the processing manifest are updated.
+
+Readers see either the old or the rebuilt month, never a mix. A month with a task
+that failed in either pass, or wrote fewer trades than its count, keeps its old trades. An interrupted run is repaired by running it again. The
+run holds `update_all.lock`, so no update runs at the same time. Bars, positions and
+the wallet index are derived from the old trades; rebuild them afterwards
+(`rebuild_derived=True` does it).
+
+    python -m update_utils.reprocess --from 2024-01 --to 2024-03
+"""
+import multiprocessing
+import os
+import shutil
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+import polars as pl
+
+from poly_utils.bars import bars_initialized
+from poly_utils.catalog import Catalog
+from poly_utils.compaction import exchange_dirs
+from poly_utils.dictionary import TokenDictionary, WalletDictionary, encode_wallets
+from poly_utils.manifest import MANIFEST_FILE, ProcessingManifest
+from poly_utils.markets import load_market_tokens
+from poly_utils.metrics import METRICS
+from poly_utils.positions import positions_initialized
+from poly_utils.resolver import MarketResolver
+from poly_utils.schema import (
+    PROCESSED_SCHEMA_VERSION, dataset_version, is_canonical_dataset, mark_canonical, schema_metadata,
+)
+from poly_utils.utils import parquet_files, partition_dirs, stream_batches
+from poly_utils.wallet_index import wallet_index_initialized
+from poly_utils.writer import PartitionWriter
+from update_utils.daemon import UPDATE_LOCK, acquire_lock, fetcher_busy, release_lock
+from update_utils.process_live import (
+    PROCESSED_ROW_BYTES, add_partition_columns, get_processed_df, nonusdc_asset_idx, prepare_raw,
+    register_raw_tokens, resolve_unknown_tokens, scan_encoded, write_processed,
+)
+
+# Task granularities: raw partitions per task
+SPLITS = ('day', 'month')
+
+# Token lookup, dictionaries and options of a worker process, loaded once by _init_worker
+_worker = {}
+
+
+def _init_worker(raw_is_canonical: bool, version, memory_budget_mb: int):
+    dictionary = TokenDictionary()
+    _worker.update(
+        dictionary=dictionary,
+        lookup=dictionary.lookup_frame().lazy(),
+        wallets=WalletDictionary() if version is not None else None,
+        raw_is_canonical=raw_is_canonical,
+        version=version,
+        memory_budget_mb=memory_budget_mb,
+    )
+
+
+def collect_task_keys(files: List[str]) -> Tuple[List[str], List[int], int]:
+    """
+    Distinct maker/taker addresses and non-USDC asset indices of a task's raw files,
+    and the number of trades process_task has to write for them.
+    """
+    lf = scan_encoded(files, _worker['dictionary'], _worker['raw_is_canonical'])
+    addresses, assets, rows = pl.collect_all([
+        lf.select(pl.concat([pl.col('maker'), pl.col('taker')]).unique().alias('address')),
+        nonusdc_asset_idx(lf),
+        lf.select(pl.len().alias('rows')),
+    ])
+    return addresses['address'].drop_nulls().to_list(), assets['asset_idx'].drop_nulls().to_list(), rows['rows'].item()
+
+
+def process_task(files: List[str], staging_root: str) -> int:
+    """
+    Enrich a task's raw files and write the trades under `staging_root`, partitioned
+    like processed/trades. Every address must already be in the wallet dictionary.
+    Returns the number of trades written.
+    """
+    version, wallets = _worker['version'], _worker['wallets']
+    lf = prepare_raw(scan_encoded(files, _worker['dictionary'], _worker['raw_is_canonical']))
+    lf = add_partition_columns(get_processed_df(lf, _worker['lookup']))
+
+    # Half the budget for in-flight batches, half for the writer's buffers
+    budget = _worker['memory_budget_mb'] * 2**20 // 2
+    writer = PartitionWriter(staging_root, ['year', 'month'], prefix='trades', keep_partition_cols=True,
+                             memory_budget=budget,
+                             schema_metadata=schema_metadata(version) if version is not None else None)
+    rows = 0
+    for batch in stream_batches(lf, max(10_000, budget // PROCESSED_ROW_BYTES)):
+        if wallets is not None:
+            batch = encode_wallets(batch, wallets, assign=False)
+        rows += write_processed(batch, writer, partitioned=True)
+    writer.close()
+    return rows
+
+
+def _month_of(value, default):
+    """(year, month) of a 'YYYY-MM' / 'YYYY-MM-DD' string or a date."""
+    if value is None:
+        return default
+    if isinstance(value, str):
+        parts = value.split('-')
+        return int(parts[0]), int(parts[1])
+    return value.year, value.month
+
+
+def plan_months(raw_dir: str, start=None, end=None) -> Dict[Tuple[int, int], List[str]]:
+    """Raw day partitions of every month in [start, end] (whole months), by (year, month)."""
+    first, last = _month_of(start, (0, 0)), _month_of(end, (9999, 12))
+    months = defaultdict(list)
+    for directory in partition_dirs(raw_dir, 3):
+        parts = dict(p.split('=', 1) for p in os.path.relpath(directory, raw_dir).split(os.sep))
+        month = (int(parts['year']), int(parts['month']))
+        if first <= month <= last and parquet_files(directory):
+            months[month].append(directory)
+    return dict(sorted(months.items()))
+
+
+def plan_tasks(months: Dict[Tuple[int, int], List[str]], by: str = 'day') -> List[Tuple[Tuple[int, int], List[str]]]:
+    """(month, raw files) per task, largest first so the pool finishes evenly."""
+    tasks = []
+    for month, directories in months.items():
+        groups = [[d] for d in directories] if by == 'day' else [directories]
+        for group in groups:
+            tasks.append((month, [f for d in group for f in parquet_files(d)]))
+    return sorted(tasks, key=lambda task: -sum(os.path.getsize(f) for f in task[1]))
+
+
+@contextmanager
+def worker_pool(workers: int, initargs: tuple):
+    """
+    Spawned worker processes (forking a process running Polars' thread pool can
+    deadlock), each with an even share of the cores for its own Polars threads.
+    """
+    previous = os.environ.get('POLARS_MAX_THREADS')
+    os.environ['POLARS_MAX_THREADS'] = str(max(1, (os.cpu_count() or 1) // workers))
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=initargs) as executor:
+            yield executor
+    finally:
+        if previous is None:
+            os.environ.pop('POLARS_MAX_THREADS', None)
+        else:
+            os.environ['POLARS_MAX_THREADS'] = previous
+
+
+def swap_month(staging_root: str, processed_dir: str, month: Tuple[int, int], catalog: Catalog) -> int:
+    """
+    Swap the staged partition of `month` in for the live one and update the catalog.
+    Returns the number of files now in the partition.
+    """
+    relpath = os.path.join(f"year={month[0]}", f"month={month[1]}")
+    staged = os.path.join(staging_root, relpath)
+    live = os.path.join(processed_dir, relpath)
+    os.makedirs(staged, exist_ok=True)
+    old_files = parquet_files(live) if os.path.isdir(live) else []
+    if os.path.isdir(live):
+        exchange_dirs(staged, os.path.realpath(live))
+        shutil.rmtree(staged)
+    else:
+        os.makedirs(os.path.dirname(live), exist_ok=True)
+        os.rename(staged, live)
+    new_files = parquet_files(live)
+    catalog.remove_files(old_files)
+    catalog.add_entries([catalog.entry_for(path) for path in new_files])
+    return len(new_files)
+
+
+@METRICS.stage('reprocess')
+def reprocess(start=None, end=None, by: str = 'day', workers: int = None, memory_budget_mb: int = 1024,
+              resolve_missing: bool = True, rebuild_derived: bool = False,
+              processed_dir: str = 'processed/trades', raw_dir: str = 'goldsky/orderFilled') -> bool:
+    """
+    Rebuild the processed trades of every month in [start, end] from the raw history,
+    in parallel (see the module docstring). Returns False if another update holds the
+    lock or a month could not be rebuilt.
+
+    Args:
+        start: First month to rebuild ('YYYY-MM', 'YYYY-MM-DD' or a date; default: the
+            oldest raw partition). Whole months are always rebuilt.
+        end: Last month to rebuild (default: the newest raw partition).
+        by: Split the raw history into one task per 'day' or per 'month' partition.
+        workers: Worker processes (default: CPU count).
+        memory_budget_mb: Approximate peak memory per worker.
+        resolve_missing: Look up markets on gamma-api for tokens the markets snapshot
+            does not know, instead of leaving their trades without a market.
+        rebuild_derived: Rebuild bars, positions and the wallet index afterwards.
+        processed_dir: Processed trades dataset.
+        raw_dir: Raw orderFilled dataset.
+    """
+    print("=" * 60)
+    print("🔁 Reprocessing Trades")
+    print("=" * 60)
+    if not acquire_lock(UPDATE_LOCK):
+        print(f"❌ {UPDATE_LOCK} exists: another update is running (stop the daemon with "
+              f"`python -m update_utils.daemon --stop`)")
+        return False
+    try:
+        with fetcher_busy():
+            ok = _reprocess(start, end, by, workers or os.cpu_count() or 1, memory_budget_mb,
+                            resolve_missing, processed_dir, raw_dir)
+    finally:
+        release_lock(UPDATE_LOCK)
+
+    if rebuild_derived:
+        from update_utils.update_bars import rebuild_bars
+        from update_utils.update_positions import rebuild_positions
+        from update_utils.update_wallet_index import rebuild_wallet_index
+
+        rebuild_bars(processed_dir)
+        rebuild_positions(processed_dir)
+        rebuild_wallet_index(processed_dir)
+    elif bars_initialized() or positions_initialized() or wallet_index_initialized():
+        print("⚠️  Bars, positions and the wallet index still reflect the old trades; rebuild them "
+              "(`--rebuild-derived`, or each module's `--rebuild`)")
+    return ok
+
+
+def _reprocess(start, end, by, workers, memory_budget_mb, resolve_missing, processed_dir, raw_dir) -> bool:
+    months = plan_months(raw_dir, start, end) if os.path.isdir(raw_dir) else {}
+    if not months:
+        print(f"No raw partitions in {raw_dir} between {start or 'the start'} and {end or 'the end'}.")
+        return True
+    tasks = plan_tasks(months, by)
+    print(f"📂 {len(months)} months ({min(months)[0]}-{min(months)[1]:02d} to {max(months)[0]}-{max(months)[1]:02d}), "
+          f"{len(tasks):,} tasks by {by}, {workers} workers")
+
+    # A new dataset starts in the current schema; an existing one keeps its own
+    if not os.path.isdir(processed_dir) or not partition_dirs(processed_dir, 1):
+        mark_canonical(processed_dir, PROCESSED_SCHEMA_VERSION)
+    version = dataset_version(processed_dir)
+    raw_is_canonical = is_canonical_dataset(raw_dir)
+
+    dictionary = TokenDictionary()
+    dictionary.sync_tokens(load_market_tokens())
+    dictionary.save()
+    failed = set()
+    if not raw_is_canonical:
+        for month in months:
+            try:
+                register_raw_tokens([f for task_month, files in tasks if task_month == month for f in files],
+                                    dictionary)
+            except Exception as e:
+                failed.add(month)
+                print(f"Failed to read the raw files of {month[0]}-{month[1]:02d}: {e}")
+
+    # Pass 1: new addresses and unknown tokens are added here, in one process, so the
+    # workers only ever read the dictionaries. Each task's trade count is checked
+    # against what pass 2 writes before its month is swapped in.
+    print("\n🔎 Collecting wallets and tokens...")
+    addresses, assets, expected_rows = set(), set(), {}
+    with worker_pool(workers, (raw_is_canonical, None, memory_budget_mb)) as executor:
+        futures = {executor.submit(collect_task_keys, files): i
+                   for i, (month, files) in enumerate(tasks) if month not in failed}
+        for future in as_completed(futures):
+            i = futures[future]
+            month = tasks[i][0]
+            try:
+                task_addresses, task_assets, expected_rows[i] = future.result()
+            except Exception as e:
+                if month not in failed:
+                    print(f"Failed to read a task of {month[0]}-{month[1]:02d}: {e}")
+                failed.add(month)
+                continue
+            addresses.update(task_addresses)
+            assets.update(task_assets)
+    if version is not None:
+        wallets = WalletDictionary()
+        if wallets.add(list(addresses)):
+            wallets.save()
+        print(f"👛 {len(addresses):,} wallets ({len(wallets):,} known)")
+    if resolve_missing:
+        resolve_unknown_tokens(pl.Series('asset_idx', sorted(assets), dtype=pl.UInt32), dictionary,
+                               MarketResolver())
+
+    # Pass 2: staged next to the resolved dataset root so every swap is a rename
+    staging_root = f"{os.path.realpath(processed_dir)}.reprocess"
+    shutil.rmtree(staging_root, ignore_errors=True)
+    catalog = Catalog(processed_dir, stats_column='timestamp')
+    manifest = ProcessingManifest(os.path.join(processed_dir, MANIFEST_FILE), raw_root=raw_dir)
+    # Raw partition mtimes as planned; the update lock keeps them unchanged
+    raw_mtimes = {d: os.stat(d).st_mtime_ns for directories in months.values() for d in directories}
+
+    print(f"\n🚀 Rebuilding {len(months) - len(failed)} months...")
+    remaining = defaultdict(int)
+    for month, _ in tasks:
+        remaining[month] += 1
+    rows, total_rows = defaultdict(int), 0
+    with worker_pool(workers, (raw_is_canonical, version, memory_budget_mb)) as executor:
+        futures = {executor.submit(process_task, files, staging_root): i
+                   for i, (month, files) in enumerate(tasks) if month not in failed}
+        for future in as_completed(futures):
+            i = futures[future]
+            month = tasks[i][0]
+            remaining[month] -= 1
+            if month in failed:
+                continue
+            try:
+                written = future.result()
+                if written != expected_rows[i]:
+                    raise RuntimeError(f"wrote {written:,} of {expected_rows[i]:,} trades")
+                rows[month] += written
+            except Exception as e:
+                failed.add(month)
+                print(f"Failed to rebuild a task of {month[0]}-{month[1]:02d}: {e}")
+                continue
+            if remaining[month]:
+                continue
+            files = swap_month(staging_root, processed_dir, month, catalog)
+            for directory in months[month]:
+                manifest.replace_files(os.path.relpath(directory, raw_dir), parquet_files(directory),
+                                       raw_mtimes[directory])
+            manifest.save()
+            total_rows += rows[month]
+            METRICS.count('rows_reprocessed', rows[month])
+            print(f"✓ {month[0]}-{month[1]:02d}: {rows[month]:,} trades in {files} files")
+    shutil.rmtree(staging_root, ignore_errors=True)
+
+    print(f"\n✅ Rebuilt {len(months) - len(failed)} of {len(months)} months ({total_rows:,} trades)")
+    if failed:
+        print(f"❌ Kept the old trades of {', '.join(f'{y}-{m:02d}' for y, m in sorted(failed))}; run again to retry")
+    return not failed
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Rebuild processed trades from the raw history on every core")
+    parser.add_argument('--from', dest='start', help="First month to rebuild (YYYY-MM; default: the oldest)")
+    parser.add_argument('--to', dest='end', help="Last month to rebuild (YYYY-MM; default: the newest)")
+    parser.add_argument('--by', choices=SPLITS, default='day', help="Raw partitions per task")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--memory-budget-mb', type=int, default=1024, help="Approximate peak memory per worker")
+    parser.add_argument('--no-resolve', action='store_true', help="Leave trades of unknown tokens without a market")
+    parser.add_argument('--rebuild-derived', action='store_true',
+                        help="Rebuild bars, positions and the wallet index afterwards")
+    args = parser.parse_args()
+
+    ok = reprocess(args.start, args.end, by=args.by, workers=args.workers, memory_budget_mb=args.memory_budget_mb,
+                   resolve_missing=not args.no_resolve, rebuild_derived=args.rebuild_derived)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,62 @@
+import os
+import shutil
+
+import polars as pl
+
+from poly_utils.bars import BARS_ROOT, RESOLUTIONS, BarWriter, mark_bars_initialized
+from poly_utils.schema import decode_compact
+from poly_utils.utils import parquet_files, partition_dirs
+
+
+def rebuild_bars(processed_dir: str = 'processed/trades', root: str = BARS_ROOT, resolutions=None):
+    """
+    Build the bar datasets from the full processed trade history, one month at a time.
+
+    Needed once for an existing datalake; afterwards process_live keeps the bars up to
+    date with every batch it writes. Existing bars under `root` are replaced.
+
+    Args:
+        processed_dir: Processed trades dataset.
+        root: Root of the bar datasets.
+        resolutions: Keys of RESOLUTIONS to build (default: all).
+    """
+    resolutions = resolutions or list(RESOLUTIONS)
+    for resolution in resolutions:
+        shutil.rmtree(os.path.join(root, resolution), ignore_errors=True)
+
+    through = None
+    months = partition_dirs(processed_dir, 2) if os.path.isdir(processed_dir) else []
+    print(f"Building {', '.join(resolutions)} bars from {len(months)} months of trades")
+    for directory in months:
+        files = parquet_files(directory)
+        if not files:
+            continue
+        trades = (
+            decode_compact(pl.scan_parquet(files, hive_partitioning=False))
+            .select(['timestamp', 'market_id', 'nonusdc_side', 'price', 'usd_amount', 'token_amount'])
+            .collect()
+        )
+        bars = BarWriter(root, resolutions)
+        bars.write(trades)
+        bars.close()
+        if not trades.is_empty():
+            latest = trades['timestamp'].max()
+            through = latest if through is None else max(through, latest)
+        print(f"  {os.path.relpath(directory, processed_dir)}: {trades.height:,} trades -> {bars.bars_written:,} bars")
+
+    mark_bars_initialized(root, through)
+    print(f"✅ Bars built through {through}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build OHLCV bars from processed trades")
+    parser.add_argument('--rebuild', action='store_true', help="Rebuild all bars from the processed trade history")
+    parser.add_argument('--resolutions', nargs='*', default=list(RESOLUTIONS), choices=list(RESOLUTIONS))
+    args = parser.parse_args()
+
+    if args.rebuild:
+        rebuild_bars(resolutions=args.resolutions)
+    else:
+        parser.print_help()
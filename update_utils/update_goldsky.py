@@ -1,29 +1,51 @@
 import os
-from gql import gql, Client
-from gql.transport.requests import RequestsHTTPTransport
-from flatten_json import flatten
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
 import time
 import polars as pl
-import pyarrow.parquet as pq
-import pyarrow.dataset as ds
+
+from poly_utils.catalog import Catalog
+from poly_utils.dictionary import TokenDictionary, encode_raw
+from poly_utils.event_index import EventIndex
+from poly_utils.http import RateLimiter, backoff_delay, make_session
+from poly_utils.metrics import METRICS
+from poly_utils.utils import load_json_state, save_json_state
+from poly_utils.schema import DERIVED_RAW_COLUMNS, RAW_SCHEMA, schema_metadata
+from poly_utils.writer import PartitionWriter
 
 # Global runtime timestamp - set once when program starts
 RUNTIME_TIMESTAMP = datetime.now().strftime('%Y%m%d_%H%M%S')
 
-# Columns to save
-COLUMNS_TO_SAVE = ['timestamp', 'maker', 'makerAssetId', 'makerAmountFilled', 'taker', 'takerAssetId', 'takerAmountFilled', 'transactionHash']
+QUERY_URL = "https://api.goldsky.com/api/public/project_cl6mb8i9h0003e201j6li0diw/subgraphs/orderbook-subgraph/0.0.1/gn"
+
+# Columns to save (the canonical raw schema, see poly_utils.schema.RAW_SCHEMA, minus
+# the asset indices that are filled in locally from the token dictionary)
+COLUMNS_TO_SAVE = [c for c in RAW_SCHEMA if c not in DERIVED_RAW_COLUMNS]
 
 if not os.path.isdir('goldsky'):
     os.mkdir('goldsky')
 
 def get_latest_timestamp():
-    """Get the latest timestamp by scanning only the most recent partition (tail scan)."""
+    """
+    Get the latest timestamp from the dataset catalog, falling back to scanning only
+    the most recent partition (tail scan) when there is no complete catalog yet
+    (build one with `python -m poly_utils.catalog`).
+    """
     cache_dir = 'goldsky/orderFilled'
     if not os.path.isdir(cache_dir):
         print("No existing data found, starting from timestamp 0")
         return 0
 
+    # Only a complete catalog is trusted; one started on existing data may only
+    # know about files written since (e.g. by a backfill of older windows)
+    catalog = Catalog(cache_dir)
+    max_ts = catalog.latest_watermark() if catalog.complete else None
+    if max_ts:
+        readable = datetime.fromtimestamp(int(max_ts), tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+        print(f'Resuming from timestamp {max_ts} ({readable}) [catalog]')
+        return int(max_ts)
+
     try:
         # Step 1: Find latest year
         years = sorted([d for d in os.listdir(cache_dir) if d.startswith('year=')], reverse=True)
@@ -73,14 +95,139 @@ def get_latest_timestamp():
         print(f"Error in tail scan: {e}. Starting from timestamp 0.")
         return 0
 
-def scrape(at_once=1000):
-    QUERY_URL = "https://api.goldsky.com/api/public/project_cl6mb8i9h0003e201j6li0diw/subgraphs/orderbook-subgraph/0.0.1/gn"
-    print(f"Query URL: {QUERY_URL}")
+class GoldskyClient:
+    """
+    Reusable orderFilledEvents fetcher.
+
+    Keeps one pooled keep-alive session for every request, pages on the compound
+    (timestamp, id) key so events sharing a boundary timestamp are never skipped,
+    adapts the page size to observed latency and errors, and retries with jittered
+    exponential backoff. Only the saved columns are requested.
+
+    Args:
+        url: GraphQL endpoint.
+        page_size: Initial page size.
+        min_page_size: Smallest page size the client will shrink to.
+        max_page_size: Largest page size (the subgraph caps `first` at 1000).
+        target_latency: Seconds per request above which the page size shrinks.
+        max_retries: Attempts per page before giving up.
+        limiter: Optional shared RateLimiter.
+        pool_size: Connection pool size (set to the number of threads sharing the client).
+    """
+
+    def __init__(self, url=QUERY_URL, page_size=1000, min_page_size=100, max_page_size=1000,
+                 target_latency=2.0, max_retries=8, limiter=None, pool_size=10):
+        self.url = url
+        self.page_size = page_size
+        self.min_page_size = min_page_size
+        self.max_page_size = max_page_size
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.limiter = limiter
+        self.session = make_session(pool_size)
+        self.fields = '\n'.join(COLUMNS_TO_SAVE)
+        self._lock = threading.Lock()
+
+    def build_query(self, first, cursor_ts, cursor_id=None, end_ts=None):
+        """Build one keyset page query: rows strictly after (cursor_ts, cursor_id) and before end_ts."""
+        upper = f', timestamp_lt: "{end_ts}"' if end_ts is not None else ''
+        after_ts = f'{{timestamp_gt: "{cursor_ts}"{upper}}}'
+        if cursor_id is None:
+            where = after_ts
+        else:
+            # The subgraph breaks timestamp ties by id, so (timestamp, id) is a total order
+            where = f'{{or: [{after_ts}, {{timestamp: "{cursor_ts}", id_gt: "{cursor_id}"}}]}}'
+        return f'''query {{
+                    orderFilledEvents(orderBy: timestamp, orderDirection: asc, first: {first}, where: {where}) {{
+                        {self.fields}
+                    }}
+                }}'''
+
+    def _adapt(self, latency, full_page):
+        with self._lock:
+            if latency > self.target_latency:
+                self.page_size = max(self.min_page_size, self.page_size // 2)
+            elif full_page and latency < self.target_latency / 2:
+                self.page_size = min(self.max_page_size, int(self.page_size * 1.5))
+
+    def _shrink(self):
+        with self._lock:
+            self.page_size = max(self.min_page_size, self.page_size // 2)
+
+    def fetch_page(self, cursor_ts, cursor_id=None, end_ts=None):
+        """
+        Fetch the next page after the (cursor_ts, cursor_id) cursor.
+
+        Returns:
+            (events, requested_page_size): the raw event dicts and the page size asked for,
+            so callers can tell a short (final) page from a full one.
+        """
+        for attempt in range(self.max_retries):
+            first = self.page_size
+            if self.limiter:
+                self.limiter.acquire()
+            started = time.monotonic()
+            try:
+                response = self.session.post(
+                    self.url, json={'query': self.build_query(first, cursor_ts, cursor_id, end_ts)}, timeout=60
+                )
+                if response.status_code != 200:
+                    raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+                payload = response.json()
+                if payload.get('errors'):
+                    raise RuntimeError(f"GraphQL error: {payload['errors']}")
+            except Exception as e:
+                self._shrink()
+                delay = backoff_delay(attempt)
+                print(f"Query error: {e}. Retrying in {delay:.1f}s (page size {self.page_size})")
+                time.sleep(delay)
+                continue
+
+            events = payload['data']['orderFilledEvents']
+            METRICS.count('pages_fetched', 1, source='goldsky')
+            METRICS.count('rows_fetched', len(events), source='goldsky')
+            self._adapt(time.monotonic() - started, len(events) >= first)
+            return events, first
+
+        raise RuntimeError(f"Goldsky query failed after {self.max_retries} attempts")
+
+    def iter_pages(self, start_ts, start_id=None, end_ts=None):
+        """
+        Yield DataFrames of events after the (start_ts, start_id) cursor until exhausted.
+
+        Pass start_id='' to include every event at start_ts; None resumes strictly after it.
+        """
+        cursor_ts, cursor_id = start_ts, start_id
+        while True:
+            events, requested = self.fetch_page(cursor_ts, cursor_id, end_ts)
+            if not events:
+                return
+            df = pl.DataFrame(events)
+            yield df
+            cursor_ts, cursor_id = events[-1]['timestamp'], events[-1]['id']
+            if len(events) < requested:
+                return
+
+def add_partition_columns(df, dictionary):
+    """
+    Cast to the canonical raw schema, encode the asset IDs with the token dictionary
+    and add the year/month/day partition keys.
+    """
+    df = encode_raw(df, dictionary)
+    ts = pl.from_epoch(pl.col('timestamp'), time_unit='s')
+    return df.with_columns([
+        ts.dt.year().alias('year'),
+        ts.dt.month().alias('month'),
+        ts.dt.day().alias('day'),
+    ])
+
+@METRICS.stage('goldsky_scrape')
+def scrape(at_once=1000, url=QUERY_URL):
+    print(f"Query URL: {url}")
     print(f"Runtime timestamp: {RUNTIME_TIMESTAMP}")
 
     last_value = get_latest_timestamp()
     count = 0
-    total_records = 0
 
     print(f"\nStarting scrape for orderFilledEvents")
 
@@ -91,80 +238,124 @@ def scrape(at_once=1000):
     print(f"Output directory: {output_dir}")
     print(f"Saving columns: {COLUMNS_TO_SAVE}")
 
-    while True:
-        q_string = '''query MyQuery {
-                        orderFilledEvents(orderBy: timestamp
-                                             first: ''' + str(at_once) + '''
-                                             where: {timestamp_gt: "''' + str(last_value) + '''"}) {
-                            fee
-                            id
-                            maker
-                            makerAmountFilled
-                            makerAssetId
-                            orderHash
-                            taker
-                            takerAmountFilled
-                            takerAssetId
-                            timestamp
-                            transactionHash
-                        }
-                    }
-                '''
-
-        query = gql(q_string)
-        transport = RequestsHTTPTransport(url=QUERY_URL, verify=True, retries=3)
-        client = Client(transport=transport)
-
-        try:
-            res = client.execute(query)
-        except Exception as e:
-            print(f"Query error: {e}")
-            print("Retrying in 5 seconds...")
-            time.sleep(5)
-            continue
-
-        if not res['orderFilledEvents'] or len(res['orderFilledEvents']) == 0:
-            print(f"No more data for orderFilledEvents")
-            break
-
-        df = pl.DataFrame([flatten(x) for x in res['orderFilledEvents']])
-
-        if df.height == 0:
-            break
-            
-        df = df.sort('timestamp')
-        last_value = df.select(pl.col('timestamp')).tail(1).item()
-
-        readable_time = datetime.fromtimestamp(int(last_value), tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-        print(f"Batch {count + 1}: Last timestamp {last_value} ({readable_time}), Records: {len(df)}")
-
-        count += 1
-        total_records += len(df)
-
-        df = df.unique()
-
-        df_to_save = df.select(COLUMNS_TO_SAVE)
-        
-        df_to_save = df_to_save.with_columns([
-            pl.from_epoch(pl.col('timestamp'), time_unit='s').dt.year().alias('year'),
-            pl.from_epoch(pl.col('timestamp'), time_unit='s').dt.month().alias('month'),
-            pl.from_epoch(pl.col('timestamp'), time_unit='s').dt.day().alias('day'),
-        ])
-        
-        table = df_to_save.to_arrow()
+    client = GoldskyClient(url=url, page_size=at_once)
+    dictionary = TokenDictionary()
+    event_index = EventIndex(output_dir)
+    new_records = 0
 
-        pq.write_to_dataset(
-            table,
-            root_path=output_dir,
-            partition_cols=['year', 'month', 'day'],
-            existing_data_behavior='overwrite_or_ignore'
-        )
+    # Pages are buffered and written as large day-partition files; the writer also
+    # flushes whatever is buffered if the loop is interrupted. Events already on disk
+    # are dropped by the event index, so the scrape can resume *at* the latest
+    # timestamp and pick up events of that second a previous run did not get to.
+    with PartitionWriter(output_dir, ['year', 'month', 'day'], prefix='orderFilled',
+                         schema_metadata=schema_metadata(), catalog=Catalog(output_dir),
+                         event_index=event_index) as writer:
+        for df in client.iter_pages(last_value, ''):
+            last_value = df['timestamp'][-1]
 
-        if len(df) < at_once:
-            break
+            readable_time = datetime.fromtimestamp(int(last_value), tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print(f"Batch {count + 1}: Last timestamp {last_value} ({readable_time}), Records: {len(df)}, "
+                  f"Next page size: {client.page_size}")
 
+            count += 1
+
+            df = df.unique()
+
+            new_records += writer.write(add_partition_columns(df, dictionary)).height
+
+    METRICS.files_written('goldsky/orderFilled', writer.files_written)
+    METRICS.count('duplicate_events_dropped', event_index.duplicates_dropped)
+    print(f"Files written: {len(writer.files_written)}")
     print(f"Finished scraping orderFilledEvents")
-    print(f"Total new records: {total_records}")
+    print(f"Total new records: {new_records} ({event_index.duplicates_dropped} already stored)")
+
+def split_windows(start_ts, end_ts, window_seconds):
+    """Split [start_ts, end_ts) into consecutive [start, end) windows."""
+    return [(ws, min(ws + window_seconds, end_ts)) for ws in range(start_ts, end_ts, window_seconds)]
+
+def fetch_window(window, client):
+    """
+    Fetch every orderFilledEvent in one [start, end) window with its own cursor.
+
+    Returns a single DataFrame with the saved columns; nothing is written here so
+    that a window is only committed once it has been fetched completely.
+    """
+    start_ts, end_ts = window
+    frames = [df.select(COLUMNS_TO_SAVE) for df in client.iter_pages(start_ts, '', end_ts)]
+    if not frames:
+        return pl.DataFrame()
+    return pl.concat(frames, how='vertical_relaxed').unique()
+
+def commit_window(window, df, dictionary, output_dir='goldsky/orderFilled', catalog=None, event_index=None):
+    """
+    Write a fully fetched window into the year/month/day partitions. With an
+    `event_index`, events already stored (e.g. by the scraper or an earlier attempt
+    at the window) are skipped.
+    """
+    if df.is_empty():
+        return
+    start_ts, end_ts = window
+    # Deterministic run id: re-running a window after a crash overwrites its own files
+    with PartitionWriter(output_dir, ['year', 'month', 'day'], prefix='backfill',
+                         run_id=f"{start_ts}-{end_ts}", defer_commit=True,
+                         schema_metadata=schema_metadata(), catalog=catalog,
+                         event_index=event_index) as writer:
+        writer.write(add_partition_columns(df, dictionary))
+
+@METRICS.stage('goldsky_backfill')
+def backfill(start_ts, end_ts=None, window_seconds=6 * 3600, workers=8, max_rps=10.0,
+             at_once=1000, state_file='goldsky/backfill_state.json'):
+    """
+    Backfill orderFilledEvents for [start_ts, end_ts) using concurrent time windows.
+
+    The range is split into independent windows that are fetched in parallel under a
+    global requests-per-second cap. A window is written to the partitions only after
+    it has been fetched completely and is then recorded in `state_file`, so re-running
+    after a crash only fetches the unfinished windows.
+
+    Args:
+        start_ts: First unix timestamp (inclusive) to fetch.
+        end_ts: Last unix timestamp (exclusive); defaults to now.
+        window_seconds: Length of each independent window.
+        workers: Number of windows fetched concurrently.
+        max_rps: Global cap on Goldsky requests per second across all workers.
+        at_once: Initial page size per request (adapted to observed latency).
+        state_file: JSON file recording completed windows.
+    """
+    if end_ts is None:
+        end_ts = int(time.time())
+
+    state = load_json_state(state_file, default={'done': []})
+    done = set(state['done'])
+    windows = [w for w in split_windows(start_ts, end_ts, window_seconds) if f"{w[0]}-{w[1]}" not in done]
+
+    print(f"Backfilling {start_ts} -> {end_ts}: {len(windows)} windows pending "
+          f"({len(done)} already done), {workers} workers, {max_rps} req/s")
+
+    client = GoldskyClient(page_size=at_once, limiter=RateLimiter(max_rps), pool_size=workers)
+    catalog = Catalog('goldsky/orderFilled')
+    event_index = EventIndex('goldsky/orderFilled')
+    dictionary = TokenDictionary()
+    total_records = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch_window, w, client): w for w in windows}
+        for future in as_completed(futures):
+            window = futures[future]
+            try:
+                df = future.result()
+                commit_window(window, df, dictionary, catalog=catalog, event_index=event_index)
+            except Exception as e:
+                print(f"Window {window[0]}-{window[1]} failed: {e}")
+                continue
+
+            done.add(f"{window[0]}-{window[1]}")
+            save_json_state(state_file, {'done': sorted(done)})
+            total_records += len(df)
+            readable = datetime.fromtimestamp(window[0], tz=timezone.utc).strftime('%Y-%m-%d %H:%M UTC')
+            print(f"Window {readable}: {len(df)} records ({len(done)} windows done)")
+
+    METRICS.count('duplicate_events_dropped', event_index.duplicates_dropped)
+    print(f"Backfill finished. Total records: {total_records} ({event_index.duplicates_dropped} already stored)")
 
 def update_goldsky():
     """Run scraping for orderFilledEvents"""
@@ -177,3 +368,21 @@ def update_goldsky():
         print(f"Successfully completed orderFilledEvents")
     except Exception as e:
         print(f"Error scraping orderFilledEvents: {str(e)}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Scrape Goldsky orderFilledEvents")
+    parser.add_argument('--backfill', action='store_true', help="Run a parallel time-windowed backfill")
+    parser.add_argument('--start', type=int, default=0, help="Backfill start unix timestamp (inclusive)")
+    parser.add_argument('--end', type=int, default=None, help="Backfill end unix timestamp (exclusive)")
+    parser.add_argument('--window', type=int, default=6 * 3600, help="Window length in seconds")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--max-rps', type=float, default=10.0)
+    args = parser.parse_args()
+
+    if args.backfill:
+        backfill(args.start, args.end, window_seconds=args.window, workers=args.workers, max_rps=args.max_rps)
+    else:
+        update_goldsky()
@@ -1,11 +1,93 @@
 import requests
 import json
 import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
 import polars as pl
-import pyarrow.parquet as pq
 
-def update_markets(base_dir: str = "markets_partitioned", batch_size: int = 500):
+from poly_utils.catalog import Catalog
+from poly_utils.compaction import exchange_dirs
+from poly_utils.http import RateLimiter, backoff_delay, make_session
+from poly_utils.markets import RESOLVED_DIR
+from poly_utils.metrics import METRICS
+from poly_utils.utils import parquet_files, partition_dirs
+from poly_utils.writer import PartitionWriter
+
+MARKETS_URL = "https://gamma-api.polymarket.com/markets"
+
+def transform_markets(markets: List[Dict]) -> pl.DataFrame:
+    """
+    Turn raw gamma-api market dicts into markets_partitioned rows: parse the
+    `outcomes`/`clobTokenIds` JSON, derive neg_risk, question_text and ticker, and add
+    the year/month partition keys. Works on one page or many pages combined.
+    """
+    # Infer the schema from every row, since combined pages may disagree on sparse fields
+    df = pl.from_dicts(markets, infer_schema_length=None)
+    expressions = []
+
+    # The 'outcomes' and 'clobTokenIds' columns are JSON strings, so we parse them first.
+    if 'outcomes' in df.columns:
+        df = df.with_columns(pl.col('outcomes').str.json_decode(dtype=pl.List(pl.Utf8)).alias('outcomes_parsed'))
+        expressions.extend([
+            pl.col("outcomes_parsed").list.get(0).alias("answer1"),
+            pl.col("outcomes_parsed").list.get(1).alias("answer2"),
+        ])
+    else:
+        expressions.extend([pl.lit(None, dtype=pl.Utf8).alias("answer1"), pl.lit(None, dtype=pl.Utf8).alias("answer2")])
+
+    if 'clobTokenIds' in df.columns:
+        df = df.with_columns(pl.col('clobTokenIds').str.json_decode(dtype=pl.List(pl.Utf8)).alias('clobTokenIds_parsed'))
+        expressions.extend([
+            pl.col("clobTokenIds_parsed").list.get(0).alias("token1"),
+            pl.col("clobTokenIds_parsed").list.get(1).alias("token2"),
+        ])
+    else:
+        expressions.extend([pl.lit(None, dtype=pl.Utf8).alias("token1"), pl.lit(None, dtype=pl.Utf8).alias("token2")])
+
+    if 'negRiskAugmented' in df.columns and 'negRiskOther' in df.columns:
+        expressions.append((pl.col('negRiskAugmented') | pl.col('negRiskOther')).alias('neg_risk'))
+    elif 'negRiskAugmented' in df.columns:
+        expressions.append(pl.col('negRiskAugmented').alias('neg_risk'))
+    elif 'negRiskOther' in df.columns:
+        expressions.append(pl.col('negRiskOther').alias('neg_risk'))
+    else:
+        expressions.append(pl.lit(False).alias('neg_risk'))
+
+    if 'question' in df.columns and 'title' in df.columns:
+        expressions.append(pl.coalesce(pl.col('question'), pl.col('title')).alias('question_text'))
+    elif 'question' in df.columns:
+        expressions.append(pl.col('question').alias('question_text'))
+    elif 'title' in df.columns:
+        expressions.append(pl.col('title').alias('question_text'))
+    else:
+        expressions.append(pl.lit('').alias('question_text'))
+
+    if 'events' in df.columns and df["events"].dtype == pl.List:
+        expressions.append(pl.col('events').list.get(0).struct.field('ticker').alias('ticker'))
+    else:
+        expressions.append(pl.lit('').alias('ticker'))
+
+    df = df.with_columns(expressions)
+
+    df = df.with_columns([
+        pl.col("createdAt").str.to_datetime(time_zone="UTC").dt.year().alias("year"),
+        pl.col("createdAt").str.to_datetime(time_zone="UTC").dt.month().alias("month"),
+    ])
+
+    final_columns_ideal = [
+        'createdAt', 'id', 'question_text', 'answer1', 'answer2', 'neg_risk',
+        'slug', 'token1', 'token2', 'conditionId', 'volume', 'ticker', 'closedTime',
+        'year', 'month'
+    ]
+
+    columns_to_select = [col for col in final_columns_ideal if col in df.columns]
+    df = df.select(columns_to_select)
+    return df
+
+@METRICS.stage('update_markets')
+def update_markets(base_dir: str = "markets_partitioned", batch_size: int = 500, base_url: str = MARKETS_URL):
     """
     Fetch markets ordered by creation date and save to a partitioned parquet dataset.
     Automatically resumes from the last fetched market.
@@ -13,18 +95,25 @@ def update_markets(base_dir: str = "markets_partitioned", batch_size: int = 500)
     Args:
         base_dir: The base directory to store the partitioned parquet dataset.
         batch_size: Number of markets to fetch per request.
+        base_url: gamma-api markets endpoint.
     """
-    base_url = "https://gamma-api.polymarket.com/markets"
-    
     os.makedirs(base_dir, exist_ok=True)
 
     latest_created_at = None
-    if os.path.exists(base_dir) and any(os.scandir(base_dir)):
+    catalog = Catalog(base_dir)
+    if catalog.complete and catalog.latest_watermark():
+        latest_created_at = catalog.latest_watermark()
+        print(f"Found existing data. Resuming from after: {latest_created_at} [catalog]")
+    elif os.path.exists(base_dir) and any(os.scandir(base_dir)):
         try:
-            latest_created_at = pl.scan_parquet(f"{base_dir}/**/*.parquet") \
+            # Only the year/month partitions: markets added by the resolver (`_resolved`)
+            # are often newer than the last page fetched here
+            files = [f for d in partition_dirs(base_dir, 2) for f in parquet_files(d)]
+            latest_created_at = pl.concat([pl.scan_parquet(f).select("createdAt") for f in files],
+                                          how="vertical_relaxed") \
                                     .select(pl.max("createdAt")) \
                                     .collect() \
-                                    .item()
+                                    .item() if files else None
             if latest_created_at:
                 print(f"Found existing data. Resuming from after: {latest_created_at}")
         except Exception as e:
@@ -34,6 +123,10 @@ def update_markets(base_dir: str = "markets_partitioned", batch_size: int = 500)
     current_offset = 0
     found_overlap = False
 
+    # Batches are buffered and each year/month partition is written once at the end
+    writer = PartitionWriter(base_dir, ["year", "month"], prefix="markets", catalog=catalog)
+    session = make_session(1)
+
     while True:
         print(f"Fetching batch of newest markets (offset: {current_offset})...")
         
@@ -45,7 +138,8 @@ def update_markets(base_dir: str = "markets_partitioned", batch_size: int = 500)
                 'offset': current_offset,
             }
 
-            response = requests.get(base_url, params=params, timeout=30)
+            response = session.get(base_url, params=params, timeout=30)
+            METRICS.count('pages_fetched', 1, source='markets')
             
             if response.status_code != 200:
                 print(f"API error {response.status_code}: {response.text}")
@@ -77,75 +171,11 @@ def update_markets(base_dir: str = "markets_partitioned", batch_size: int = 500)
                     continue
 
             # --- Start Processing the new markets from this batch ---
-            df = pl.from_dicts(new_markets_to_process)
-            expressions = []
-
-            # The 'outcomes' and 'clobTokenIds' columns are JSON strings, so we parse them first.
-            if 'outcomes' in df.columns:
-                df = df.with_columns(pl.col('outcomes').str.json_decode(dtype=pl.List(pl.Utf8)).alias('outcomes_parsed'))
-                expressions.extend([
-                    pl.col("outcomes_parsed").list.get(0).alias("answer1"),
-                    pl.col("outcomes_parsed").list.get(1).alias("answer2"),
-                ])
-            else:
-                expressions.extend([pl.lit(None, dtype=pl.Utf8).alias("answer1"), pl.lit(None, dtype=pl.Utf8).alias("answer2")])
-
-            if 'clobTokenIds' in df.columns:
-                df = df.with_columns(pl.col('clobTokenIds').str.json_decode(dtype=pl.List(pl.Utf8)).alias('clobTokenIds_parsed'))
-                expressions.extend([
-                    pl.col("clobTokenIds_parsed").list.get(0).alias("token1"),
-                    pl.col("clobTokenIds_parsed").list.get(1).alias("token2"),
-                ])
-            else:
-                expressions.extend([pl.lit(None, dtype=pl.Utf8).alias("token1"), pl.lit(None, dtype=pl.Utf8).alias("token2")])
-
-            if 'negRiskAugmented' in df.columns and 'negRiskOther' in df.columns:
-                expressions.append((pl.col('negRiskAugmented') | pl.col('negRiskOther')).alias('neg_risk'))
-            elif 'negRiskAugmented' in df.columns:
-                expressions.append(pl.col('negRiskAugmented').alias('neg_risk'))
-            elif 'negRiskOther' in df.columns:
-                expressions.append(pl.col('negRiskOther').alias('neg_risk'))
-            else:
-                expressions.append(pl.lit(False).alias('neg_risk'))
-
-            if 'question' in df.columns and 'title' in df.columns:
-                expressions.append(pl.coalesce(pl.col('question'), pl.col('title')).alias('question_text'))
-            elif 'question' in df.columns:
-                expressions.append(pl.col('question').alias('question_text'))
-            elif 'title' in df.columns:
-                expressions.append(pl.col('title').alias('question_text'))
-            else:
-                expressions.append(pl.lit('').alias('question_text'))
-
-            if 'events' in df.columns and df["events"].dtype == pl.List:
-                expressions.append(pl.col('events').list.get(0).struct.field('ticker').alias('ticker'))
-            else:
-                expressions.append(pl.lit('').alias('ticker'))
-
-            df = df.with_columns(expressions)
-            
-            df = df.with_columns([
-                pl.col("createdAt").str.to_datetime(time_zone="UTC").dt.year().alias("year"),
-                pl.col("createdAt").str.to_datetime(time_zone="UTC").dt.month().alias("month"),
-            ])
-
-            final_columns_ideal = [
-                'createdAt', 'id', 'question_text', 'answer1', 'answer2', 'neg_risk',
-                'slug', 'token1', 'token2', 'conditionId', 'volume', 'ticker', 'closedTime',
-                'year', 'month'
-            ]
-            
-            columns_to_select = [col for col in final_columns_ideal if col in df.columns]
-            df = df.select(columns_to_select)
-            
-            pq.write_to_dataset(
-                table=df.to_arrow(),
-                root_path=base_dir,
-                partition_cols=["year", "month"],
-                existing_data_behavior='overwrite_or_ignore'
-            )
+            df = transform_markets(new_markets_to_process)
+            writer.write(df)
 
             total_saved += len(df)
+            METRICS.count('rows_fetched', len(df), source='markets')
             print(f"Saved {len(df)} new markets. Total saved in this run: {total_saved}")
             # --- End Processing ---
 
@@ -177,7 +207,110 @@ def update_markets(base_dir: str = "markets_partitioned", batch_size: int = 500)
             time.sleep(3)
             continue
 
-    print(f"\nCompleted! Saved a total of {total_saved} new markets.")
+    writer.close()
+    METRICS.files_written('markets_partitioned', writer.files_written)
+    print(f"\nCompleted! Saved a total of {total_saved} new markets in {len(writer.files_written)} files.")
+
+def fetch_markets_page(session, limiter, offset: int, batch_size: int, base_url: str = MARKETS_URL,
+                       max_retries: int = 8) -> List[Dict]:
+    """One oldest-first page of markets, retried with jittered backoff."""
+    params = {'order': 'createdAt', 'ascending': 'true', 'limit': batch_size, 'offset': offset}
+    for attempt in range(max_retries):
+        limiter.acquire()
+        try:
+            response = session.get(base_url, params=params, timeout=30)
+            if response.status_code == 200:
+                return response.json()
+            error = f"API error {response.status_code}"
+        except requests.exceptions.RequestException as e:
+            error = f"Network error: {e}"
+        delay = backoff_delay(attempt, base=1.0)
+        print(f"{error} at offset {offset}. Retrying in {delay:.1f}s")
+        time.sleep(delay)
+    raise RuntimeError(f"Markets page at offset {offset} failed after {max_retries} attempts")
+
+@METRICS.stage('sync_all_markets')
+def sync_all_markets(base_dir: str = "markets_partitioned", batch_size: int = 500, workers: int = 8,
+                     max_rps: float = 10.0, base_url: str = MARKETS_URL):
+    """
+    Rebuild the whole markets dataset from the API (e.g. after a schema change).
+
+    Offset pages are fetched oldest first, `workers` at a time, over one pooled session
+    under a shared rate limit; oldest-first order keeps offsets stable while new markets
+    are created. All pages are parsed in one vectorized pass, every year/month partition
+    is written once into a staging directory, and the staging directory is swapped in
+    for `base_dir` only after it is complete. Markets found by the token resolver are
+    carried over.
+
+    Args:
+        base_dir: The base directory of the partitioned parquet dataset.
+        batch_size: Number of markets per request.
+        workers: Number of pages fetched concurrently.
+        max_rps: Requests per second across all workers.
+        base_url: gamma-api markets endpoint.
+    """
+    session = make_session(workers)
+    limiter = RateLimiter(max_rps)
+    started = time.monotonic()
+
+    markets = []
+    offset = 0
+    finished = False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while not finished:
+            offsets = [offset + k * batch_size for k in range(workers)]
+            pages = executor.map(lambda o: fetch_markets_page(session, limiter, o, batch_size, base_url), offsets)
+            for page in pages:
+                markets.extend(page)
+                if len(page) < batch_size:
+                    finished = True
+            offset += workers * batch_size
+            print(f"Fetched {len(markets):,} markets ({time.monotonic() - started:.0f}s)")
+
+    if not markets:
+        print("No markets returned by the API; keeping the existing dataset.")
+        return
+
+    df = transform_markets(markets).unique(subset=['id'], keep='last').sort('createdAt')
+    print(f"Parsed {len(df):,} unique markets")
+
+    real_dir = os.path.realpath(base_dir)
+    staging_dir = f"{real_dir}.sync"
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)
+    os.makedirs(staging_dir)
+
+    # Everything is written on close, so each partition gets its files in one go
+    writer = PartitionWriter(staging_dir, ["year", "month"], prefix="markets",
+                             memory_budget=max(512 * 2**20, df.estimated_size() * 2),
+                             catalog=Catalog(staging_dir, stats_column='createdAt'))
+    writer.write(df)
+    writer.close()
+    METRICS.count('rows_fetched', len(df), source='markets')
+    METRICS.files_written('markets_partitioned', writer.files_written)
+
+    resolved_dir = os.path.join(real_dir, RESOLVED_DIR)
+    if os.path.isdir(resolved_dir):
+        shutil.copytree(resolved_dir, os.path.join(staging_dir, RESOLVED_DIR))
+
+    if os.path.isdir(real_dir):
+        exchange_dirs(staging_dir, real_dir)
+        shutil.rmtree(staging_dir)
+    else:
+        os.rename(staging_dir, real_dir)
+    print(f"\nCompleted! Rebuilt {base_dir} with {len(df):,} markets in {len(writer.files_written)} files "
+          f"({time.monotonic() - started:.0f}s).")
 
 if __name__ == "__main__":
-    update_markets(batch_size=500)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fetch Polymarket markets into markets_partitioned")
+    parser.add_argument('--full-sync', action='store_true', help="Rebuild the whole dataset with concurrent requests")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--max-rps', type=float, default=10.0)
+    args = parser.parse_args()
+
+    if args.full_sync:
+        sync_all_markets(workers=args.workers, max_rps=args.max_rps)
+    else:
+        update_markets(batch_size=500)
@@ -0,0 +1,63 @@
+import os
+import shutil
+
+import polars as pl
+
+from poly_utils.dictionary import WalletDictionary
+from poly_utils.positions import POSITIONS_ROOT, PositionWriter, mark_positions_initialized
+from poly_utils.schema import decode_compact
+from poly_utils.utils import parquet_files, partition_dirs
+
+POSITION_COLUMNS = ['timestamp', 'market_id', 'nonusdc_side', 'maker_direction', 'taker_direction',
+                    'usd_amount', 'token_amount']
+
+
+def rebuild_positions(processed_dir: str = 'processed/trades', root: str = POSITIONS_ROOT):
+    """
+    Build the positions store from the full processed trade history, one month at a time.
+
+    Needed once for an existing datalake; afterwards process_live keeps the positions up
+    to date with every batch it writes. Existing positions under `root` are replaced.
+
+    Args:
+        processed_dir: Processed trades dataset.
+        root: Root of the positions dataset.
+    """
+    if os.path.isdir(root):
+        for name in os.listdir(root):
+            if name.startswith('bucket='):
+                shutil.rmtree(os.path.join(root, name))
+
+    through = None
+    months = partition_dirs(processed_dir, 2) if os.path.isdir(processed_dir) else []
+    print(f"Building positions from {len(months)} months of trades")
+    positions = PositionWriter(root, WalletDictionary())
+    for directory in months:
+        files = parquet_files(directory)
+        if not files:
+            continue
+        lf = decode_compact(pl.scan_parquet(files, hive_partitioning=False))
+        wallet_columns = ['maker_id', 'taker_id'] if 'maker_id' in lf.collect_schema().names() else ['maker', 'taker']
+        trades = lf.select(POSITION_COLUMNS + wallet_columns).collect()
+        positions.write(trades)
+        if not trades.is_empty():
+            latest = trades['timestamp'].max()
+            through = latest if through is None else max(through, latest)
+        print(f"  {os.path.relpath(directory, processed_dir)}: {trades.height:,} trades")
+    positions.close()
+
+    mark_positions_initialized(root, through)
+    print(f"✅ Positions built through {through} ({positions.rows_written:,} rows written)")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build wallet positions from processed trades")
+    parser.add_argument('--rebuild', action='store_true', help="Rebuild all positions from the processed trade history")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        rebuild_positions()
+    else:
+        parser.print_help()
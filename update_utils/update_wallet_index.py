@@ -0,0 +1,59 @@
+import os
+import shutil
+
+import polars as pl
+
+from poly_utils.dictionary import WalletDictionary
+from poly_utils.utils import parquet_files, partition_dirs
+from poly_utils.wallet_index import WALLET_TRADES_ROOT, WalletTradeWriter, mark_wallet_index_initialized
+
+
+def rebuild_wallet_index(processed_dir: str = 'processed/trades', root: str = WALLET_TRADES_ROOT):
+    """
+    Build the wallet index from the full processed trade history, one month at a time.
+
+    Needed once for an existing datalake; afterwards process_live keeps the index up to
+    date with every batch it writes. An existing index under `root` is replaced.
+
+    Args:
+        processed_dir: Processed trades dataset.
+        root: Root of the wallet index.
+    """
+    if os.path.isdir(root):
+        for name in os.listdir(root):
+            if name.startswith('bucket='):
+                shutil.rmtree(os.path.join(root, name))
+
+    through = None
+    months = partition_dirs(processed_dir, 2) if os.path.isdir(processed_dir) else []
+    print(f"Indexing wallets in {len(months)} months of trades")
+    index = WalletTradeWriter(root, WalletDictionary())
+    for directory in months:
+        files = parquet_files(directory)
+        if not files:
+            continue
+        trades = pl.read_parquet(files, hive_partitioning=False)
+        index.write(trades)
+        # One set of files per month keeps memory bounded by the largest month
+        index.spill()
+        if not trades.is_empty():
+            latest = trades['timestamp'].max()
+            through = latest if through is None else max(through, latest)
+        print(f"  {os.path.relpath(directory, processed_dir)}: {trades.height:,} trades")
+    index.close()
+
+    mark_wallet_index_initialized(root, through)
+    print(f"✅ Wallet index built through {through} ({index.rows_written:,} rows written)")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the wallet-sorted trade index from processed trades")
+    parser.add_argument('--rebuild', action='store_true', help="Rebuild the index from the processed trade history")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        rebuild_wallet_index()
+    else:
+        parser.print_help()